@@ -8,7 +8,16 @@ import os
 import csv
 import sys
 import json
+import zlib
+import mmap
+import array
+import bisect
 import shutil
+import threading
+import http.client
+import urllib.error
+import urllib.parse
+import urllib.request
 import multiprocessing as mp
 #multiprocessing.set_start_method('fork')
 import concurrent.futures
@@ -25,6 +34,21 @@ dict_path = os.path.join(pipe_dir, "dictionaries")
 tmp_db_path = os.path.join(os.getcwd(), 'tmp_config.json')
 
 class GeneralFunctions:
+    @staticmethod
+    def cpu_count():
+        # cores this process may use, targets that run concurrently
+        # are limited to their share of the cores (cpu affinity)
+        if hasattr(os, "sched_getaffinity"):
+            return len(os.sched_getaffinity(0))
+        return mp.cpu_count()
+
+    @staticmethod
+    def available_memory():
+        try:
+            return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+        except (ValueError, OSError, AttributeError):
+            return None
+
     @staticmethod
     def logger(string_to_log):
         logging.info(time.strftime(
@@ -153,7 +177,8 @@ class GeneralFunctions:
         outputlist = []
         total = len(input_list)
         start = None
-        ProcessPool = concurrent.futures.ProcessPoolExecutor()
+        ProcessPool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=GeneralFunctions.cpu_count())
         bar = 0
         if verbosity == "bar":
             ending = 50 * " "
@@ -203,6 +228,26 @@ class GeneralFunctions:
                 if not os.path.isdir(path_to_dir):
                     raise
 
+    @staticmethod
+    def gunzip_file(filepath):
+        # decompress to a temporary file and replace it in one step
+        # so an interrupted run never leaves a truncated genome behind
+        outfile = filepath.split(".gz")[0]
+        stream = GzipStream(outfile)
+        try:
+            with open(filepath, "rb") as f:
+                while True:
+                    chunk = f.read(1024 * 1024)
+                    if not chunk:
+                        break
+                    stream.write(chunk)
+        except BaseException:
+            stream.close(complete=False)
+            raise
+        stream.close()
+        os.remove(filepath)
+        return outfile
+
     @staticmethod
     def csv_writer(filepath, inputlist, header=None):
         with open(filepath, "w") as f:
@@ -544,6 +589,614 @@ class BlastDBError(Exception):
     pass
 
 
+class GzipStream:
+    """ Decompresses gzip data while it is written, the output is
+    moved to its final name when the stream is closed """
+    def __init__(self, outfile):
+        self.outfile = outfile
+        self.tmpfile = outfile + ".part"
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.finished = False
+        self.out = open(self.tmpfile, "wb")
+
+    def write(self, data):
+        while data:
+            self.finished = False
+            self.out.write(self.decompressor.decompress(data))
+            data = b""
+            if self.decompressor.eof:
+                # concatenated gzip members
+                self.finished = True
+                data = self.decompressor.unused_data
+                self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def close(self, complete=True):
+        self.out.write(self.decompressor.flush())
+        self.out.close()
+        if complete and self.finished:
+            os.replace(self.tmpfile, self.outfile)
+            return
+        if os.path.isfile(self.tmpfile):
+            os.remove(self.tmpfile)
+        if complete:
+            raise EOFError(
+                "Compressed file ended before the "
+                "end-of-stream marker was reached")
+
+
+class FastaStats:
+    """ Contig count, total length, N50 and GC content of fasta files,
+    kept in a json table and reused while size and mtime are unchanged """
+    def __init__(self, table_file):
+        self.table_file = table_file
+        self.table = {}
+        self.changed = False
+        if os.path.isfile(table_file):
+            try:
+                with open(table_file) as f:
+                    self.table = json.load(f)
+            except ValueError:
+                self.table = {}
+
+    @staticmethod
+    def scan(filepath):
+        lengths = []
+        gc = 0
+        with open(filepath, "rb") as f:
+            if os.fstat(f.fileno()).st_size > 0:
+                with mmap.mmap(
+                        f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    start = data.find(b">")
+                    while start != -1:
+                        seq_start = data.find(b"\n", start)
+                        if seq_start == -1:
+                            lengths.append(0)
+                            break
+                        end = data.find(b"\n>", seq_start)
+                        if end == -1:
+                            seq = data[seq_start:]
+                        else:
+                            seq = data[seq_start:end]
+                        lengths.append(
+                            len(seq) - seq.count(b"\n") - seq.count(b"\r"))
+                        gc += (
+                            seq.count(b"G") + seq.count(b"C")
+                            + seq.count(b"g") + seq.count(b"c"))
+                        start = -1 if end == -1 else end + 1
+
+        total = sum(lengths)
+        n50 = 0
+        cumulative = 0
+        for length in sorted(lengths, reverse=True):
+            cumulative += length
+            if cumulative * 2 >= total:
+                n50 = length
+                break
+        if total > 0:
+            gc_content = round(100 * gc / total, 2)
+        else:
+            gc_content = 0.0
+        return {
+            "contigs": len(lengths), "length": total, "n50": n50,
+            "gc": gc_content}
+
+    def get(self, filepath):
+        filepath = os.path.abspath(filepath)
+        stat = os.stat(filepath)
+        if filepath in self.table:
+            entry = self.table[filepath]
+            if entry["size"] == stat.st_size and (
+                    entry["mtime"] == stat.st_mtime):
+                return entry["stats"]
+        stats = self.scan(filepath)
+        self.table.update({filepath: {
+            "size": stat.st_size, "mtime": stat.st_mtime, "stats": stats}})
+        self.changed = True
+        return stats
+
+    def save(self):
+        if not self.changed:
+            return
+        for filepath in list(self.table.keys()):
+            if not os.path.isfile(filepath):
+                self.table.pop(filepath)
+        GeneralFunctions.create_directory(os.path.dirname(self.table_file))
+        tmp_file = self.table_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(self.table, f)
+        os.replace(tmp_file, self.table_file)
+        self.changed = False
+
+
+class TaxidSet:
+    """ Sorted taxid list (one taxid per line) with a binary sidecar of
+    unsigned 32 bit integers that is memory-mapped for lookups, the sidecar
+    is rebuilt whenever the text file is newer """
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.binfile = filepath + ".bin"
+        if not os.path.isfile(self.binfile) or (
+                os.path.getmtime(self.binfile)
+                < os.path.getmtime(self.filepath)):
+            self.build()
+        with open(self.binfile, "rb") as f:
+            if os.fstat(f.fileno()).st_size > 0:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self.taxids = memoryview(self.map).cast("I")
+            else:
+                self.map = None
+                self.taxids = []
+
+    def build(self):
+        taxids = array.array("I")
+        with open(self.filepath) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    taxids.append(int(line))
+        self.write_binary(sorted(set(taxids)), self.binfile)
+
+    @staticmethod
+    def write_binary(taxids, binfile):
+        tmp_file = binfile + ".tmp" + str(os.getpid())
+        with open(tmp_file, "wb") as f:
+            array.array("I", taxids).tofile(f)
+        os.replace(tmp_file, binfile)
+
+    @staticmethod
+    def write(taxids, filepath):
+        """ writes a taxid list and its binary sidecar """
+        taxids = sorted(set(int(taxid) for taxid in taxids))
+        tmp_file = filepath + ".tmp" + str(os.getpid())
+        with open(tmp_file, "w") as f:
+            f.write("".join(str(taxid) + "\n" for taxid in taxids))
+        os.replace(tmp_file, filepath)
+        TaxidSet.write_binary(taxids, filepath + ".bin")
+
+    def __len__(self):
+        return len(self.taxids)
+
+    def __contains__(self, taxid):
+        taxid = int(taxid)
+        i = bisect.bisect_left(self.taxids, taxid)
+        return i < len(self.taxids) and self.taxids[i] == taxid
+
+    def difference(self, taxids):
+        """ sorted taxids of the set without taxids """
+        remove = sorted(set(int(taxid) for taxid in taxids))
+        result = []
+        start = 0
+        for taxid in remove:
+            i = bisect.bisect_left(self.taxids, taxid)
+            result.extend(self.taxids[start:i])
+            if i < len(self.taxids) and self.taxids[i] == taxid:
+                i += 1
+            start = i
+        result.extend(self.taxids[start:])
+        return result
+
+    def write_difference(self, taxids, filepath):
+        with open(filepath, "w") as f:
+            f.write("".join(
+                str(taxid) + "\n" for taxid in self.difference(taxids)))
+
+    def close(self):
+        if self.map:
+            self.taxids.release()
+            self.map.close()
+            self.map = None
+
+
+class FastaIndex:
+    """ faidx style index (<fasta>.fai) with name, length, offset, bases
+    per line and bytes per line of every record, used to read single
+    sequences without parsing the whole file. The index is rebuilt whenever
+    the fasta file is newer """
+    def __init__(self, filepath, fai=None):
+        self.filepath = filepath
+        self.fai = fai if fai else filepath + ".fai"
+        self.index = {}
+        if not os.path.isfile(self.fai) or (
+                os.path.getmtime(self.fai) < os.path.getmtime(filepath)):
+            self.build()
+        else:
+            with open(self.fai) as f:
+                for line in f:
+                    name, length, offset, linebases, linewidth = (
+                        line.rstrip("\n").split("\t"))
+                    self.index.update({name: (
+                        int(length), int(offset), int(linebases),
+                        int(linewidth))})
+
+    def build(self):
+        entries = []
+        entry = None
+        short = False
+        offset = 0
+        with open(self.filepath, "rb") as f:
+            for line in f:
+                if line.startswith(b">"):
+                    if entry:
+                        entries.append(entry)
+                    name = line[1:].split(None, 1)
+                    name = name[0].decode() if name else ""
+                    entry = [name, 0, offset + len(line), 0, 0]
+                    short = False
+                elif entry is not None:
+                    bases = len(line.rstrip(b"\r\n"))
+                    newline = line.endswith(b"\n")
+                    if bases == 0:
+                        short = True
+                    elif short or (entry[3] != 0 and (
+                            bases > entry[3] or newline and (
+                                len(line) - bases != entry[4] - entry[3]))):
+                        raise ValueError(
+                            "Different line length in sequence " + entry[0]
+                            + " of " + self.filepath)
+                    else:
+                        if entry[3] == 0:
+                            entry[3] = bases
+                            entry[4] = len(line)
+                        if bases < entry[3] or not newline:
+                            short = True
+                        entry[1] += bases
+                offset += len(line)
+        if entry:
+            entries.append(entry)
+
+        tmp_file = self.fai + ".tmp" + str(os.getpid())
+        with open(tmp_file, "w") as f:
+            for entry in entries:
+                f.write("\t".join(str(item) for item in entry) + "\n")
+        os.replace(tmp_file, self.fai)
+        self.index = {
+            entry[0]: tuple(entry[1:]) for entry in reversed(entries)}
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def fetch(self, names):
+        """ {name: sequence} of all names found in the index, read in file
+        order """
+        found = sorted(
+            (self.index[name][1], name) for name in set(names)
+            if name in self.index)
+        sequences = {}
+        with open(self.filepath, "rb") as f:
+            for offset, name in found:
+                length, offset, linebases, linewidth = self.index[name]
+                if length == 0:
+                    sequences.update({name: ""})
+                    continue
+                f.seek(offset)
+                data = f.read(
+                    length // linebases * linewidth + length % linebases)
+                seq = data.replace(b"\n", b"").replace(b"\r", b"")
+                sequences.update({name: seq[:length].decode()})
+        return sequences
+
+
+class ProcessGroup:
+    """ Subprocesses started by the worker threads of a pool. terminate()
+    stops the running processes and no new ones are started, so the output
+    of unfinished jobs can be removed without a process still writing """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.processes = set()
+        self.stopped = False
+
+    def run(self, cmd, timeout=None, **kwargs):
+        """ runs cmd (Popen arguments in kwargs) and returns the exit code,
+        the process is killed after timeout seconds (TimeoutExpired) """
+        with self.lock:
+            if self.stopped:
+                raise ChildProcessError(
+                    "Process group stopped, not started: " + " ".join(cmd))
+            process = subprocess.Popen(cmd, **kwargs)
+            self.processes.add(process)
+        try:
+            return process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+            raise
+        finally:
+            with self.lock:
+                self.processes.discard(process)
+
+    def terminate(self, timeout=10):
+        with self.lock:
+            self.stopped = True
+            processes = list(self.processes)
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+
+
+class DownloadManager:
+    """ Concurrent and resumable downloads, http(s) connections to the
+    same host are kept alive and shared between the download threads.
+    A partial file is only resumed while the ETag or Last-Modified date
+    of the first response (<file>.part.validator) is unchanged (If-Range).
+    With decompress=True .gz files are extracted while they arrive """
+    def __init__(
+            self, max_workers=4, retries=3, backoff=2, timeout=60,
+            decompress=False, max_redirects=5):
+        self.max_workers = max_workers
+        self.max_redirects = max_redirects
+        self.decompress = decompress
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.chunksize = 1024 * 1024
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+        self.connections = {}
+        self.stats = []
+        self.start = time.time()
+
+    @staticmethod
+    def get_url(url):
+        # the NCBI FTP server provides the same files via https
+        # which allows persistent connections and range requests
+        if url.startswith("ftp://ftp.ncbi.nlm.nih.gov/"):
+            url = "https://" + url.split("ftp://")[1]
+        return url
+
+    def get_connection(self, scheme, host):
+        with self.lock:
+            idle = self.connections.get((scheme, host), [])
+            if len(idle) > 0:
+                return idle.pop()
+        if scheme == "https":
+            return http.client.HTTPSConnection(host, timeout=self.timeout)
+        return http.client.HTTPConnection(host, timeout=self.timeout)
+
+    def release_connection(self, scheme, host, connection):
+        with self.lock:
+            if (scheme, host) not in self.connections.keys():
+                self.connections.update({(scheme, host): []})
+            self.connections[(scheme, host)].append(connection)
+
+    def close(self):
+        with self.lock:
+            for idle in self.connections.values():
+                for connection in idle:
+                    connection.close()
+            self.connections = {}
+
+    def get_stream(self, part, mode):
+        if not (self.decompress and part.endswith(".gz.part")):
+            return None
+        stream = GzipStream(part.split(".gz.part")[0])
+        if mode == "ab" and os.path.isfile(part):
+            # resumed download, extract the bytes received before
+            with open(part, "rb") as f:
+                while True:
+                    chunk = f.read(self.chunksize)
+                    if not chunk:
+                        break
+                    stream.write(chunk)
+        return stream
+
+    def write_stream(self, response, part, mode):
+        received = 0
+        stream = self.get_stream(part, mode)
+        try:
+            with open(part, mode) as f:
+                while True:
+                    if self.stop.is_set():
+                        raise SystemExit("Download stopped")
+                    chunk = response.read(self.chunksize)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    if stream:
+                        stream.write(chunk)
+                    received += len(chunk)
+        except BaseException:
+            if stream:
+                stream.close(complete=False)
+            raise
+        if stream:
+            stream.close()
+        return received
+
+    @staticmethod
+    def save_validator(response, validator_file):
+        # weak ETags can not be used in If-Range
+        validator = response.getheader("ETag")
+        if not validator or validator.startswith("W/"):
+            validator = response.getheader("Last-Modified")
+        if validator:
+            with open(validator_file, "w") as f:
+                f.write(validator)
+        elif os.path.isfile(validator_file):
+            os.remove(validator_file)
+
+    def http_download(self, url, part, offset, redirects=0):
+        parsed = urllib.parse.urlsplit(url)
+        path = parsed.path
+        if parsed.query:
+            path = path + "?" + parsed.query
+        headers = {"User-Agent": "SpeciesPrimer pipeline"}
+        validator_file = part + ".validator"
+        if offset > 0 and os.path.isfile(validator_file):
+            # without validator the partial file is downloaded again
+            with open(validator_file) as f:
+                validator = f.read().strip()
+            headers.update({
+                "Range": "bytes=" + str(offset) + "-",
+                "If-Range": validator})
+        connection = self.get_connection(parsed.scheme, parsed.netloc)
+        try:
+            connection.request("GET", path, headers=headers)
+            response = connection.getresponse()
+            if response.status in [301, 302, 303, 307, 308]:
+                response.read()
+                connection.close()
+                if redirects >= self.max_redirects:
+                    raise urllib.error.HTTPError(
+                        url, response.status, "Too many redirects",
+                        response.headers, None)
+                location = urllib.parse.urljoin(
+                    url, response.getheader("Location"))
+                return self.http_download(
+                    location, part, offset, redirects + 1)
+            if response.status == 416:
+                # range not satisfiable, the partial file is complete
+                response.read()
+                received = 0
+            elif response.status in [200, 206]:
+                # 200: range ignored or the file changed, start again
+                if response.status == 200:
+                    self.save_validator(response, validator_file)
+                mode = "ab" if response.status == 206 else "wb"
+                received = self.write_stream(response, part, mode)
+            else:
+                response.read()
+                raise urllib.error.HTTPError(
+                    url, response.status, response.reason,
+                    response.headers, None)
+        except BaseException:
+            connection.close()
+            raise
+        if response.will_close:
+            connection.close()
+        else:
+            self.release_connection(parsed.scheme, parsed.netloc, connection)
+        return received
+
+    def url_download(self, url, part):
+        # ftp:// and file:// sources do not support range requests
+        response = urllib.request.urlopen(url, None, self.timeout)
+        try:
+            received = self.write_stream(response, part, "wb")
+        finally:
+            response.close()
+        return received
+
+    def retry_download(self, url, part):
+        for attempt in range(0, self.retries):
+            if os.path.isfile(part):
+                offset = os.path.getsize(part)
+            else:
+                offset = 0
+            try:
+                if url.startswith("http://") or url.startswith("https://"):
+                    return self.http_download(url, part, offset)
+                return self.url_download(url, part)
+            except urllib.error.HTTPError as exc:
+                # client errors will not be fixed by trying again
+                if exc.code < 500 and exc.code not in [408, 429]:
+                    raise
+                if attempt == self.retries - 1:
+                    raise
+                error = exc
+            except (OSError, http.client.HTTPException) as exc:
+                if attempt == self.retries - 1:
+                    raise
+                error = exc
+            wait = self.backoff * 2 ** attempt
+            info = (
+                "Download of " + os.path.basename(url) + " failed ("
+                + str(error) + "), try again in " + str(wait) + " s")
+            GeneralFunctions().logger(info)
+            time.sleep(wait)
+
+    def download(self, url, filepath):
+        url = self.get_url(url)
+        part = filepath + ".part"
+        resumed = os.path.isfile(part)
+        start = time.time()
+        received = self.retry_download(url, part)
+        if self.decompress and filepath.endswith(".gz"):
+            outfile = filepath.split(".gz")[0]
+            if not os.path.isfile(outfile):
+                # nothing was streamed (partial file was already complete)
+                os.replace(part, filepath)
+                GeneralFunctions().gunzip_file(filepath)
+            elif os.path.isfile(part):
+                os.remove(part)
+            filepath = outfile
+        else:
+            os.replace(part, filepath)
+        if os.path.isfile(part + ".validator"):
+            os.remove(part + ".validator")
+        duration = max(time.time() - start, 0.001)
+        stat = {
+            "file": os.path.basename(filepath), "bytes": received,
+            "seconds": duration, "resumed": resumed}
+        with self.lock:
+            self.stats.append(stat)
+        info = (
+            "Downloaded " + stat["file"] + " ("
+            + str(round(received / 1048576, 2)) + " MB, "
+            + str(round(received / 1048576 / duration, 2)) + " MB/s)")
+        if resumed:
+            info = info + " resumed"
+        GeneralFunctions().logger(info)
+        return filepath
+
+    def download_all(self, jobs, callback=None, skip_failed=False):
+        """ jobs: list of [url, filepath], returns the downloaded files,
+        the first failed download cancels all pending downloads unless
+        skip_failed is set (optional files, failures are only logged).
+        callback is called with each file as soon as it is ready """
+        downloaded = []
+        self.start = time.time()
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.max_workers)
+        future_job = {
+            executor.submit(self.download, url, filepath): filepath
+            for url, filepath in jobs}
+        try:
+            for future in concurrent.futures.as_completed(future_job):
+                try:
+                    filepath = future.result()
+                except (OSError, http.client.HTTPException) as exc:
+                    if not skip_failed:
+                        raise
+                    GeneralFunctions().logger(
+                        "Download of " + os.path.basename(future_job[future])
+                        + " failed (" + str(exc) + ")")
+                    continue
+                downloaded.append(filepath)
+                if callback:
+                    callback(filepath)
+                print(
+                    '\rDownloaded ' + str(len(downloaded)) + " of "
+                    + str(len(jobs)), end='')
+        except BaseException:
+            self.stop.set()
+            for future in future_job:
+                future.cancel()
+            raise
+        finally:
+            executor.shutdown(wait=True)
+            print("\n")
+        return downloaded
+
+    def summary(self):
+        total = sum([stat["bytes"] for stat in self.stats])
+        duration = max(time.time() - self.start, 0.001)
+        resumed = len([stat for stat in self.stats if stat["resumed"]])
+        info = (
+            "downloaded files: " + str(len(self.stats)) + " (resumed: "
+            + str(resumed) + "), " + str(round(total / 1048576, 2))
+            + " MB in " + str(timedelta(seconds=duration)).split(".")[0]
+            + " (" + str(round(total / 1048576 / duration, 2)) + " MB/s)")
+        return info
+
+
 class ParallelFunctions:
 
     @staticmethod
@@ -407,7 +407,17 @@ class Output:
             "customdb": None,
             "blastseqs": 1000,
             "probe": False,
-            "blastdbv5": False}
+            "blastdbv5": False,
+            "preqc": False,
+            "annotation": "prokka",
+            "pangenome": "keep",
+            "dereplicate": 0.0,
+            "max_genomes": 0,
+            "annotation_cores": 0,
+            "prokka_cores": 4,
+            "prank_workers": 0,
+            "prank_timeout": 21600,
+            "prank_retries": 1}
 
     def get_path(self):
         inpath = input(
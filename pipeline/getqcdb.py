@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import json
+import time
+import shutil
+import hashlib
+import logging
+import argparse
+import subprocess
+from basicfunctions import GeneralFunctions as G
+
+pipe_dir = os.path.dirname(os.path.abspath(__file__))
+dict_path = os.path.join(pipe_dir, "dictionaries")
+
+# sequence titles of the QC genes, the annotations used by QualityControl
+# and the NCBI gene and product names
+qc_patterns = {
+    "rRNA": r"16S ribosomal RNA|16S rRNA",
+    "tuf": (
+        r"translation initiation factor IF-1|\binfA\b"
+        r"|elongation factor Tu|\btuf[AB]?\b"),
+    "dnaK": r"\bdnaK\b|chaperone (protein )?DnaK",
+    "recA": r"\brecA\b|recombinase A|recombinase RecA|protein RecA",
+    "pheS": (
+        r"\bpheS\b|phenylalanine--tRNA ligase "
+        r"(subunit alpha|alpha subunit)")}
+qc_genes = ["rRNA", "tuf", "dnaK", "recA", "pheS"]
+statefile = "qcdb.json"
+
+
+def commandline():
+    parser = argparse.ArgumentParser(
+        prog="QC database",
+        formatter_class=argparse.MetavarTypeHelpFormatter,
+        description="Builds small BLAST databases of the QC gene sequences "
+        "(bacteria) from a local BLAST database, the quality control of "
+        "speciesprimer.py searches these databases instead of the full "
+        "database",
+        allow_abbrev=False)
+    parser.add_argument(
+        "-dbpath", "--dbpath", type=str,
+        help="Path of the source BLAST DB, default=current directory")
+    parser.add_argument(
+        "-db", "--database", type=str, default="nt",
+        help="Name of the source BLAST DB (nt or a custom DB), default=nt")
+    parser.add_argument(
+        "-qc_gene", "--qc_gene", type=str, nargs="*", choices=qc_genes,
+        default=qc_genes, help="QC genes, default=all")
+    parser.add_argument(
+        "-all_taxa", "--all_taxa", action="store_true", default=False,
+        help="Keep the QC gene sequences of all taxa, default: only "
+        "sequences of bacteria (dictionaries/2.txids)")
+    return parser
+
+
+def logger(string_to_log):
+    print("\n" + string_to_log)
+    logging.info(
+        time.strftime(" %a, %d %b %Y %H:%M:%S: ", time.localtime())
+        + string_to_log)
+
+
+def get_qcdb_dir(db_dir):
+    return os.path.join(db_dir, "qcdb")
+
+
+def get_volumes(db_dir, db):
+    """ volumes of a BLAST DB from the DBLIST of the alias file """
+    nal_file = os.path.join(db_dir, db + ".nal")
+    volumes = []
+    if os.path.isfile(nal_file):
+        with open(nal_file, "r") as f:
+            for line in f:
+                if line.startswith("DBLIST"):
+                    for volume in line.split()[1:]:
+                        volumes.append(volume.strip('"'))
+    if len(volumes) == 0:
+        volumes = [db]
+    return volumes
+
+
+def volume_version(db_dir, volume):
+    """ hash of the getblastdb md5 file of a volume or else of the size
+    and mtime of the volume files """
+    sha = hashlib.sha256()
+    md5_file = os.path.join(db_dir, "md5_files", volume + ".tar.gz.md5")
+    if os.path.isfile(md5_file):
+        with open(md5_file, "rb") as f:
+            sha.update(f.read())
+        return sha.hexdigest()
+    db_files = sorted(
+        files for files in os.listdir(db_dir)
+        if files.startswith(volume + ".") and not files.endswith((
+            ".tar.gz", ".md5", ".nal")))
+    for files in db_files:
+        stat = os.stat(os.path.join(db_dir, files))
+        sha.update((
+            files + "\0" + str(stat.st_size) + "\0"
+            + str(stat.st_mtime) + "\0").encode())
+    return sha.hexdigest()
+
+
+def get_settings_key(genes, all_taxa):
+    sha = hashlib.sha256()
+    for gene in genes:
+        sha.update((gene + "\0" + qc_patterns[gene] + "\0").encode())
+    sha.update(str(all_taxa).encode())
+    return sha.hexdigest()
+
+
+def read_taxids(filepath):
+    taxids = set()
+    with open(filepath, "r") as f:
+        for line in f:
+            if line.strip():
+                taxids.add(line.strip())
+    return taxids
+
+
+def match_qc_genes(title, genes):
+    return [
+        gene for gene in genes
+        if re.search(qc_patterns[gene], title, re.IGNORECASE)]
+
+
+def run_blastdbcmd(cmd):
+    """ lines of the blastdbcmd output, read while blastdbcmd runs """
+    process = subprocess.Popen(
+        cmd, stdout=subprocess.PIPE, universal_newlines=True)
+    for line in process.stdout:
+        yield line.rstrip("\n")
+    process.stdout.close()
+    if process.wait() != 0:
+        raise subprocess.CalledProcessError(process.returncode, cmd)
+
+
+def scan_volume(db_dir, volume, genes, taxids=None):
+    """ {qc_gene: [accessions]} of the sequences in a volume with a QC gene
+    title, sequences without taxid (custom DB) are kept """
+    selected = {gene: [] for gene in genes}
+    cmd = [
+        "blastdbcmd", "-db", os.path.join(db_dir, volume),
+        "-entry", "all", "-outfmt", "%a\t%T\t%t"]
+    for line in run_blastdbcmd(cmd):
+        row = line.split("\t", 2)
+        if len(row) != 3:
+            continue
+        accession, taxid, title = row
+        if taxids and taxid not in ["0", "N/A"] and taxid not in taxids:
+            continue
+        for gene in match_qc_genes(title, genes):
+            selected[gene].append(accession)
+    return selected
+
+
+def fasta_header(accession, gi, title):
+    # keep the GI, the QC excludes hits by the GIs in no_blast.gi
+    if gi not in ["0", "N/A", ""]:
+        return ">gi|" + gi + "|gb|" + accession + "| " + title
+    return ">" + accession + " " + title
+
+
+def extract_sequences(db_dir, volume, accessions, outfile):
+    """ writes <outfile>.fas and the taxid map <outfile>.taxid """
+    if len(accessions) == 0:
+        for ext in [".fas", ".taxid"]:
+            open(outfile + ext, "w").close()
+        return 0
+    batchfile = outfile + ".acc"
+    with open(batchfile, "w") as f:
+        for accession in accessions:
+            f.write(accession + "\n")
+    cmd = [
+        "blastdbcmd", "-db", os.path.join(db_dir, volume),
+        "-entry_batch", batchfile, "-outfmt", "%a\t%g\t%T\t%t\t%s"]
+    count = 0
+    with open(outfile + ".fas.tmp", "w") as fas, open(
+            outfile + ".taxid.tmp", "w") as taxmap:
+        for line in run_blastdbcmd(cmd):
+            row = line.split("\t")
+            if len(row) < 5:
+                continue
+            accession, gi, taxid, seq = row[0], row[1], row[2], row[-1]
+            title = "\t".join(row[3:-1])
+            fas.write(fasta_header(accession, gi, title) + "\n" + seq + "\n")
+            if taxid not in ["0", "N/A"]:
+                taxmap.write(accession + " " + taxid + "\n")
+            count += 1
+    os.replace(outfile + ".fas.tmp", outfile + ".fas")
+    os.replace(outfile + ".taxid.tmp", outfile + ".taxid")
+    os.remove(batchfile)
+    return count
+
+
+def update_volume(db_dir, volume, genes, taxids, volume_dir):
+    logger("Search QC gene sequences in " + volume)
+    selected = scan_volume(db_dir, volume, genes, taxids)
+    counts = {}
+    for gene in genes:
+        outfile = os.path.join(volume_dir, volume + "_" + gene)
+        counts.update({gene: extract_sequences(
+            db_dir, volume, selected[gene], outfile)})
+    logger(volume + ": " + ", ".join(
+        gene + " " + str(counts[gene]) for gene in genes))
+    return counts
+
+
+def remove_volume(volume_dir, volume, genes):
+    for gene in genes:
+        for ext in [".fas", ".taxid"]:
+            filepath = os.path.join(volume_dir, volume + "_" + gene + ext)
+            if os.path.isfile(filepath):
+                os.remove(filepath)
+
+
+def make_qcdb(qcdb_dir, gene, volumes, source):
+    """ BLAST DB <qcdb_dir>/<gene>_qc of the sequences of all volumes """
+    volume_dir = os.path.join(qcdb_dir, "volumes")
+    dbname = os.path.join(qcdb_dir, gene + "_qc")
+    fasta = dbname + ".fas"
+    taxid_map = dbname + ".taxid"
+    with open(fasta, "w") as fas, open(taxid_map, "w") as taxmap:
+        for volume in volumes:
+            for outfile, ext in [[fas, ".fas"], [taxmap, ".taxid"]]:
+                filepath = os.path.join(volume_dir, volume + "_" + gene + ext)
+                if os.path.isfile(filepath):
+                    with open(filepath, "r") as f:
+                        shutil.copyfileobj(f, outfile)
+    if os.path.getsize(fasta) == 0:
+        logger("Warning: no " + gene + " sequences found in " + source)
+        for files in os.listdir(qcdb_dir):
+            if files.startswith(gene + "_qc."):
+                os.remove(os.path.join(qcdb_dir, files))
+        return False
+    cmd = [
+        "makeblastdb", "-in", fasta, "-dbtype", "nucl", "-parse_seqids",
+        "-taxid_map", taxid_map, "-title", gene + " QC sequences " + source,
+        "-out", dbname]
+    G.run_subprocess(cmd, True, True, False)
+    os.remove(fasta)
+    os.remove(taxid_map)
+    return True
+
+
+def load_state(qcdb_dir):
+    filepath = os.path.join(qcdb_dir, statefile)
+    if os.path.isfile(filepath):
+        with open(filepath, "r") as f:
+            return json.load(f)
+    return {}
+
+
+def save_state(qcdb_dir, state):
+    sha = hashlib.sha256()
+    for volume in sorted(state["volumes"]):
+        sha.update((volume + "\0" + state["volumes"][volume] + "\0").encode())
+    sha.update(state["key"].encode())
+    state.update({"version": sha.hexdigest()})
+    filepath = os.path.join(qcdb_dir, statefile)
+    with open(filepath + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(filepath + ".tmp", filepath)
+
+
+def get_changes(state, versions, key):
+    """ changed and removed volumes since the last build """
+    if state.get("key") != key:
+        return list(versions.keys()), []
+    built = state.get("volumes", {})
+    changed = [
+        volume for volume in versions
+        if built.get(volume) != versions[volume]]
+    removed = [volume for volume in built if volume not in versions]
+    return changed, removed
+
+
+def build_qcdb(db_dir, db, genes=qc_genes, all_taxa=False):
+    qcdb_dir = get_qcdb_dir(db_dir)
+    volume_dir = os.path.join(qcdb_dir, "volumes")
+    G.create_directory(volume_dir)
+    volumes = get_volumes(db_dir, db)
+    versions = {
+        volume: volume_version(db_dir, volume) for volume in volumes}
+    key = get_settings_key(genes, all_taxa)
+    state = load_state(qcdb_dir)
+    if state.get("source") != db:
+        state = {}
+    changed, removed = get_changes(state, versions, key)
+    if state.get("key") != key:
+        state = {}
+        for files in os.listdir(volume_dir):
+            os.remove(os.path.join(volume_dir, files))
+    if len(changed) == 0 and len(removed) == 0:
+        logger("QC databases are up to date")
+        return state
+
+    taxids = None
+    if not all_taxa:
+        taxids = read_taxids(os.path.join(dict_path, "2.txids"))
+    state.update({
+        "source": db, "qc_genes": genes, "key": key,
+        "volumes": state.get("volumes", {}),
+        "counts": state.get("counts", {})})
+    logger(
+        "Update QC databases: " + str(len(changed)) + " changed and "
+        + str(len(removed)) + " removed volume(s) of " + db)
+    for volume in removed:
+        remove_volume(volume_dir, volume, genes)
+        state["volumes"].pop(volume)
+        state["counts"].pop(volume, None)
+    for volume in changed:
+        counts = update_volume(db_dir, volume, genes, taxids, volume_dir)
+        state["volumes"].update({volume: versions[volume]})
+        state["counts"].update({volume: counts})
+        # a stopped build continues with the remaining volumes
+        save_state(qcdb_dir, dict(state, complete=False))
+    built = []
+    for gene in genes:
+        if make_qcdb(qcdb_dir, gene, volumes, db):
+            built.append(gene)
+    state.update({"databases": built, "complete": True})
+    save_state(qcdb_dir, state)
+    logger("QC databases ready: " + ", ".join(built))
+    return state
+
+
+def get_QCDB():
+    today = time.strftime("%Y_%m_%d", time.localtime())
+    parser = commandline()
+    args = parser.parse_args()
+    if args.dbpath:
+        db_dir = os.path.abspath(args.dbpath)
+    else:
+        db_dir = os.getcwd()
+    G.create_directory(get_qcdb_dir(db_dir))
+    logging.basicConfig(
+        filename=os.path.join(
+            get_qcdb_dir(db_dir), "qcdb_build_" + today + ".log"),
+        level=logging.DEBUG, format="%(message)s")
+    logger("Build QC databases from " + os.path.join(db_dir, args.database))
+    build_qcdb(db_dir, args.database, args.qc_gene, args.all_taxa)
+
+
+if __name__ == "__main__":
+    get_QCDB()
@@ -7,6 +7,7 @@ from app.forms import LoginForm, StartForm, NewForm, PipeConfig
 from app.forms import PipeOptions, DownloadDB
 from app.forms import SettingsForm, ChangeSettingsForm, ControlRunForm, DBForm
 import os
+import sys
 import time
 import json
 import subprocess
@@ -21,6 +22,9 @@ pipe_dir = app_dir.split('gui')[0]
 dict_path = os.path.join(pipe_dir, "dictionaries")
 tmp_db_path = os.path.join(pipe_dir, 'tmp_config.json')
 daemon_path = os.path.join(pipe_dir, "gui", "daemon", "daemonize.py")
+if pipe_dir not in sys.path:
+    sys.path.append(pipe_dir)
+from basicfunctions import TaxidSet
 
 
 @app.errorhandler(OSError)
@@ -554,11 +558,9 @@ def get_bacteria_taxids():
             db="taxonomy", term="txid2[orgn]", retmax="500000")
     taxidresult = Entrez.read(searchtaxid)
     taxids = taxidresult["IdList"]
-    taxids.sort(key=int)
     filename = os.path.join(dict_path, "2.txids")
-    with open(filename, "w") as f:
-        for txid in taxids:
-            f.write(txid + "\n")
+    # sorted list and binary sidecar for the pipeline
+    TaxidSet.write(taxids, filename)
 
 
 @app.route('/blastdb', methods=['GET', 'POST'])
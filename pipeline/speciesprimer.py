@@ -6,27 +6,42 @@ import sys
 import argparse
 import time
 import logging
+import logging.handlers
 import csv
 import fnmatch
 import signal
 import re
 import shutil
+import subprocess
+import hashlib
+import gzip
+import urllib.parse
+import sqlite3
+import threading
 import multiprocessing
-import wget
 import json
-import urllib
+import queue
+import http.client
+import concurrent.futures
 import itertools
+import math
+import array
+import numpy as np
 from itertools import islice
 from datetime import timedelta
 from Bio import SeqIO
 from Bio.Seq import Seq
-from Bio.SeqRecord import SeqRecord
 from Bio.Blast import NCBIXML
 from Bio import Entrez
 from basicfunctions import GeneralFunctions as G
 from basicfunctions import HelperFunctions as H
 from basicfunctions import ParallelFunctions as P
 from basicfunctions import BlastDBError
+from basicfunctions import DownloadManager
+from basicfunctions import FastaStats
+from basicfunctions import TaxidSet
+from basicfunctions import FastaIndex
+from basicfunctions import ProcessGroup
 
 # paths
 pipe_dir = os.path.dirname(os.path.abspath(__file__))
@@ -45,7 +60,9 @@ errors = []
 systemdirs = [
     "genomic_fna", "config", "ffn_files", "gff_files", "Pangenome",
     "rRNA_QC", "recA_QC", "tuf_QC",
-    "dnaK_QC", "pheS_QC"]
+    "dnaK_QC", "pheS_QC", "combined_QC",
+    "rRNA_preQC", "recA_preQC", "tuf_preQC",
+    "dnaK_preQC", "pheS_preQC", "combined_preQC", "ncbi_annotation"]
 
 Entrez.tool = "SpeciesPrimer pipeline"
 
@@ -96,6 +113,10 @@ class Config:
             assemblylevel, skip_tree, nolist, offline, ignore_qc, mfethreshold,
             customdb, blastseqs, probe, blastdbv5)
 
+    def get_option(self, target, option, default=None):
+        # options added later are missing in older config files
+        return self.config_dict[target].get(option, default)
+
 
 class CLIconf:
     def __init__(
@@ -103,7 +124,10 @@ class CLIconf:
             intermediate, qc_gene, mfold,
             skip_download, assemblylevel,
             nontargetlist, skip_tree, nolist, offline, ignore_qc, mfethreshold,
-            customdb, blastseqs, probe, blastdbv5):
+            customdb, blastseqs, probe, blastdbv5, preqc=False,
+            annotation="prokka", pangenome="keep", dereplicate=0.0,
+            max_genomes=0, annotation_cores=0, prokka_cores=4,
+            prank_workers=0, prank_timeout=21600, prank_retries=1):
         self.minsize = minsize
         self.maxsize = maxsize
         self.mpprimer = mpprimer
@@ -125,6 +149,16 @@ class CLIconf:
         self.blastseqs = blastseqs
         self.probe = probe
         self.blastdbv5 = blastdbv5
+        self.preqc = preqc
+        self.annotation = annotation
+        self.pangenome = pangenome
+        self.dereplicate = dereplicate
+        self.max_genomes = max_genomes
+        self.annotation_cores = annotation_cores
+        self.prokka_cores = prokka_cores
+        self.prank_workers = prank_workers
+        self.prank_timeout = prank_timeout
+        self.prank_retries = prank_retries
         self.save_config()
 
     def save_config(self):
@@ -149,6 +183,16 @@ class CLIconf:
         config_dict.update({"blastseqs": self.blastseqs})
         config_dict.update({"probe": self.probe})
         config_dict.update({"blastdbv5": self.blastdbv5})
+        config_dict.update({"preqc": self.preqc})
+        config_dict.update({"annotation": self.annotation})
+        config_dict.update({"pangenome": self.pangenome})
+        config_dict.update({"dereplicate": self.dereplicate})
+        config_dict.update({"max_genomes": self.max_genomes})
+        config_dict.update({"annotation_cores": self.annotation_cores})
+        config_dict.update({"prokka_cores": self.prokka_cores})
+        config_dict.update({"prank_workers": self.prank_workers})
+        config_dict.update({"prank_timeout": self.prank_timeout})
+        config_dict.update({"prank_retries": self.prank_retries})
 
         dir_path = os.path.join(self.path, self.target)
         config_path = os.path.join(self.path, self.target, "config")
@@ -159,6 +203,616 @@ class CLIconf:
             f.write(json.dumps(config_dict))
 
 
+class GenomeManifest:
+    """ Persistent record of the genome assemblies of a target and their
+    state, so stages can look up a genome instead of scanning directories
+    """
+    states = ["downloaded", "extracted", "annotated", "passed", "excluded"]
+
+    def __init__(self, target_dir):
+        config_dir = os.path.join(target_dir, "config")
+        G.create_directory(config_dir)
+        self.db_path = os.path.join(config_dir, "genome_manifest.db")
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(
+            self.db_path, timeout=60, check_same_thread=False)
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS genomes ("
+                "name TEXT PRIMARY KEY, accession TEXT, version INTEGER, "
+                "state TEXT, info TEXT, updated REAL)")
+        self.genomes = {}
+        for name, accession, state, info in self.conn.execute(
+                "SELECT name, accession, state, info FROM genomes"):
+            self.genomes.update({
+                name: {"accession": accession, "state": state, "info": info}})
+
+    @staticmethod
+    def genome_name(filename):
+        # GCF_902362325.1_MGYG-HGUT-00020_genomic.fna(.gz) -> GCF_902362325v1
+        if "_genomic.fna" in filename:
+            return (
+                filename.split(".")[0] + "v"
+                + filename.split(".")[1].split("_")[0])
+        name = filename.split(".fna")[0]
+        if "_" in name:
+            return "_".join("-".join(name.split(".")).split("_")[0:-1])
+        return "-".join(name.split("."))
+
+    @staticmethod
+    def get_accession(name):
+        # GCF_902362325v1 -> GCF_902362325.1, 1
+        if name.startswith(("GCF_", "GCA_")) and "v" in name:
+            accession, version = name.rsplit("v", 1)
+            if version.isdigit():
+                return accession + "." + version, int(version)
+        return name, None
+
+    def get_state(self, name):
+        if name in self.genomes:
+            return self.genomes[name]["state"]
+        return None
+
+    def get_info(self, name):
+        if name in self.genomes:
+            return self.genomes[name]["info"]
+        return None
+
+    def get_names(self, state):
+        return [
+            name for name in self.genomes
+            if self.genomes[name]["state"] == state]
+
+    def update(self, names, state, info=""):
+        if isinstance(names, str):
+            names = [names]
+        rows = []
+        for name in names:
+            accession, version = self.get_accession(name)
+            rows.append([name, accession, version, state, info, time.time()])
+            self.genomes.update({
+                name: {"accession": accession, "state": state, "info": info}})
+        with self.lock:
+            with self.conn:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO genomes VALUES (?, ?, ?, ?, ?, ?)",
+                    rows)
+
+    def remove(self, names):
+        for name in names:
+            self.genomes.pop(name, None)
+        with self.lock:
+            with self.conn:
+                self.conn.executemany(
+                    "DELETE FROM genomes WHERE name = ?",
+                    [[name] for name in names])
+
+
+class AccessionIndex:
+    """ Genome names indexed by their parsed assembly accession
+    (GCF_004088235v2 -> prefix GCF, number 004088235, version 2) to find
+    older versions of an assembly and the files that belong to a genome
+    """
+    pattern = re.compile(r"^(GC[AF])_(\d+)v(\d+)$")
+
+    def __init__(self, names=()):
+        self.names = {}
+        self.newest = {}
+        for name in names:
+            self.add(name)
+
+    @classmethod
+    def parse(cls, name):
+        """ (prefix, number, version) or None for other genome names """
+        match = cls.pattern.match(name)
+        if match:
+            prefix, number, version = match.groups()
+            return prefix, number, int(version)
+        return None
+
+    def add(self, name):
+        accession = self.parse(name)
+        self.names.update({name: accession})
+        if accession:
+            key = accession[0:2]
+            newest = self.newest.get(key)
+            if newest is None or accession[2] > self.names[newest][2]:
+                self.newest.update({key: name})
+
+    def older_versions(self):
+        """ names of the genomes with a newer version of the assembly """
+        return set(
+            name for name, accession in self.names.items()
+            if accession and self.newest[accession[0:2]] != name)
+
+    def lookup(self, filename):
+        """ indexed genome name of a file or directory
+        (<name>_<suffix> or <accession>_<assembly>_genomic.fna) or None """
+        name = "_".join(filename.split("_")[0:-1])
+        if name in self.names:
+            return name
+        if "_genomic.fna" in filename:
+            name = GenomeManifest.genome_name(filename)
+            if name in self.names:
+                return name
+        return None
+
+
+class AssemblyMetadata:
+    """ Local copy of the NCBI assembly docsums of a target, reused until it
+    is older than ttl (seconds) and then updated incrementally
+    """
+    fields = [
+        "AssemblyAccession", "AssemblyName", "AssemblyStatus",
+        "FtpPath_RefSeq", "LastUpdateDate", "Biosource", "Meta",
+        "ExclFromRefSeq", "AnomalousList", "PropertyList"]
+
+    def __init__(self, config_dir):
+        self.filepath = os.path.join(config_dir, "assembly_metadata.json")
+        self.taxid = None
+        self.updated = 0
+        self.date = None
+        self.records = {}
+        if os.path.isfile(self.filepath):
+            with open(self.filepath) as f:
+                data = json.load(f)
+            self.taxid = data["taxid"]
+            self.updated = data["updated"]
+            self.date = data["date"]
+            self.records = data["records"]
+
+    def is_valid(self, taxid, ttl):
+        if self.taxid != str(taxid) or self.date is None:
+            return False
+        return time.time() - self.updated < ttl
+
+    def add(self, docsums):
+        for docsum in docsums:
+            uid = str(docsum.attributes["uid"])
+            record = {}
+            for key in self.fields:
+                if key in docsum.keys():
+                    record.update({key: docsum[key]})
+            # convert the Entrez parser elements to plain python objects
+            self.records.update({uid: json.loads(json.dumps(record))})
+
+    def save(self, taxid, date):
+        self.taxid = str(taxid)
+        self.updated = time.time()
+        self.date = date
+        tmp_file = self.filepath + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump({
+                "taxid": self.taxid, "updated": self.updated,
+                "date": self.date, "records": self.records}, f)
+        os.replace(tmp_file, self.filepath)
+
+
+class AnnotationCache:
+    """ Prokka results shared between targets and runs, addressed by a hash
+    of the genome sequence and the annotation settings, with LRU eviction
+    once the cache grows larger than max_size (bytes)
+    """
+    extensions = ["gff", "ffn", "fna"]
+
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        G.create_directory(cache_dir)
+        self.conn = sqlite3.connect(
+            os.path.join(cache_dir, "index.db"), timeout=60)
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS annotations ("
+                "key TEXT PRIMARY KEY, size INTEGER, last_used REAL)")
+
+    @staticmethod
+    def get_key(filepath, settings):
+        sha = hashlib.sha256()
+        with open(filepath, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                sha.update(chunk)
+        for setting in settings:
+            sha.update(b"\0" + str(setting).encode())
+        return sha.hexdigest()
+
+    def get_path(self, key, ext):
+        return os.path.join(self.cache_dir, key[0:2], key, key + "." + ext)
+
+    @staticmethod
+    def link_file(from_file, to_file):
+        try:
+            os.link(from_file, to_file)
+        except OSError:
+            shutil.copy(from_file, to_file)
+
+    def fetch(self, key, target_files):
+        """ target_files: {extension: filepath} """
+        row = self.conn.execute(
+            "SELECT key FROM annotations WHERE key = ?", [key]).fetchone()
+        if row is None:
+            return False
+        for ext in self.extensions:
+            if not os.path.isfile(self.get_path(key, ext)):
+                self.remove(key)
+                return False
+        for ext in self.extensions:
+            if os.path.isfile(target_files[ext]):
+                os.remove(target_files[ext])
+            self.link_file(self.get_path(key, ext), target_files[ext])
+        with self.conn:
+            self.conn.execute(
+                "UPDATE annotations SET last_used = ? WHERE key = ?",
+                [time.time(), key])
+        return True
+
+    def store(self, key, source_files):
+        """ source_files: {extension: filepath} """
+        for ext in self.extensions:
+            if not os.path.isfile(source_files[ext]):
+                return False
+        key_dir = os.path.dirname(self.get_path(key, "gff"))
+        tmp_dir = key_dir + ".tmp" + str(os.getpid())
+        if os.path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        G.create_directory(tmp_dir)
+        size = 0
+        for ext in self.extensions:
+            to_file = os.path.join(tmp_dir, key + "." + ext)
+            shutil.copy(source_files[ext], to_file)
+            size += os.path.getsize(to_file)
+        if os.path.isdir(key_dir):
+            shutil.rmtree(key_dir)
+        os.rename(tmp_dir, key_dir)
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO annotations VALUES (?, ?, ?)",
+                [key, size, time.time()])
+        self.evict()
+        return True
+
+    def remove(self, key):
+        key_dir = os.path.dirname(self.get_path(key, "gff"))
+        if os.path.isdir(key_dir):
+            shutil.rmtree(key_dir)
+        with self.conn:
+            self.conn.execute("DELETE FROM annotations WHERE key = ?", [key])
+
+    def evict(self):
+        total = self.conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM annotations").fetchone()[0]
+        if total <= self.max_size:
+            return []
+        evicted = []
+        for key, size in self.conn.execute(
+                "SELECT key, size FROM annotations "
+                "ORDER BY last_used ASC").fetchall():
+            if total <= self.max_size:
+                break
+            self.remove(key)
+            total -= size
+            evicted.append(key)
+        G.logger(
+            "Annotation cache: evicted " + str(len(evicted)) + " entries")
+        return evicted
+
+    def close(self):
+        self.conn.close()
+
+
+class NCBIAnnotation:
+    """ RefSeq annotation of a genome (<assembly>_genomic.gff.gz and
+    <assembly>_cds_from_genomic.fna.gz) converted to the Prokka output
+    files (gff with ##FASTA section, ffn, fna) with Prokka style locus tags
+    (<name>_00001) and the Prokka product names of the QC genes """
+    suffixes = ["_genomic.gff.gz", "_cds_from_genomic.fna.gz"]
+    feature_types = ["CDS", "rRNA", "tRNA", "tmRNA"]
+    # NCBI (PGAP) product names of the QC genes: product names in
+    # QualityControl.searchdict
+    products = {
+        "translation initiation factor if-1":
+            "Translation initiation factor IF-1",
+        "molecular chaperone dnak": "Chaperone protein DnaK",
+        "chaperone protein dnak": "Chaperone protein DnaK",
+        "recombinase reca": "Protein RecA",
+        "protein reca": "Protein RecA",
+        "phenylalanine--trna ligase subunit alpha":
+            "Phenylalanine--tRNA ligase alpha subunit",
+        "phenylalanine--trna ligase alpha subunit":
+            "Phenylalanine--tRNA ligase alpha subunit"}
+
+    def __init__(self, genomic_file, annotation_dir):
+        assembly = os.path.basename(genomic_file).split("_genomic.fna")[0]
+        self.genomic_file = genomic_file
+        self.gff_file = os.path.join(
+            annotation_dir, assembly + self.suffixes[0])
+        self.cds_file = os.path.join(
+            annotation_dir, assembly + self.suffixes[1])
+
+    @classmethod
+    def get_links(cls, genomic_link):
+        """ links of the annotation files next to a _genomic.fna.gz link """
+        assembly = genomic_link.split("_genomic.fna.gz")[0]
+        return [assembly + suffix for suffix in cls.suffixes]
+
+    def is_available(self):
+        return os.path.isfile(self.gff_file) and os.path.isfile(self.cds_file)
+
+    @staticmethod
+    def encode(value):
+        # reserved characters in GFF3 attribute values
+        for char in "%;=&,":
+            value = value.replace(char, "%" + format(ord(char), "02X"))
+        return value
+
+    @classmethod
+    def get_product(cls, product):
+        product = urllib.parse.unquote(product)
+        return cls.products.get(product.lower(), product)
+
+    def read_features(self):
+        """ [contig, source, type, start, end, strand, phase, locus_tag,
+        gene, product] of all CDS and RNA features, features with several
+        parts are merged """
+        features = []
+        merged = {}
+        genes = {}
+        with gzip.open(self.gff_file, "rt") as f:
+            for line in f:
+                if line.startswith("#"):
+                    if line.startswith("##FASTA"):
+                        break
+                    continue
+                row = line.rstrip("\n").split("\t")
+                if len(row) != 9:
+                    continue
+                attributes = {}
+                for item in row[8].split(";"):
+                    if "=" in item:
+                        key, value = item.split("=", 1)
+                        attributes.update({key: value})
+                if row[2] in ["gene", "pseudogene"]:
+                    genes.update({
+                        attributes.get("ID"): attributes.get("locus_tag")})
+                    continue
+                if row[2] not in self.feature_types:
+                    continue
+                if attributes.get("pseudo") == "true":
+                    continue
+                feature_id = attributes.get("ID")
+                if feature_id in merged:
+                    feature = merged[feature_id]
+                    feature[3] = min(feature[3], int(row[3]))
+                    feature[4] = max(feature[4], int(row[4]))
+                    continue
+                locus_tag = attributes.get(
+                    "locus_tag", genes.get(attributes.get("Parent")))
+                feature = [
+                    row[0], row[1], row[2], int(row[3]), int(row[4]),
+                    row[6], row[7], locus_tag, attributes.get("gene"),
+                    self.get_product(attributes.get("product", ""))]
+                merged.update({feature_id: feature})
+                features.append(feature)
+        return features
+
+    def read_cds(self):
+        """ {locus_tag: sequence} of the CDS """
+        sequences = {}
+        with gzip.open(self.cds_file, "rt") as f:
+            for record in SeqIO.parse(f, "fasta"):
+                if "[pseudo=true]" in record.description:
+                    continue
+                match = re.search(
+                    r"\[locus_tag=([^\]]+)\]", record.description)
+                if match and match.group(1) not in sequences:
+                    sequences.update({match.group(1): str(record.seq)})
+        return sequences
+
+    @staticmethod
+    def write_fasta(f, name, seq, description=None):
+        if description:
+            f.write(">" + name + " " + description + "\n")
+        else:
+            f.write(">" + name + "\n")
+        for i in range(0, len(seq), 60):
+            f.write(seq[i:i + 60] + "\n")
+
+    def convert(self, name, outdir, prefix):
+        """ writes <outdir>/<prefix>.gff, .ffn and .fna, returns the number
+        of features, ValueError if the annotation can not be used """
+        contigs = {}
+        for record in SeqIO.parse(self.genomic_file, "fasta"):
+            contigs.update({record.id: str(record.seq).upper()})
+        cds = self.read_cds()
+        features = []
+        for feature in self.read_features():
+            contig, start, end, locus_tag = (
+                feature[0], feature[3], feature[4], feature[7])
+            if contig not in contigs:
+                raise ValueError(
+                    "Contig " + contig + " not found in " + self.genomic_file)
+            if feature[2] == "CDS":
+                seq = cds.get(locus_tag)
+            else:
+                seq = contigs[contig][start - 1:end]
+                if feature[5] == "-":
+                    seq = str(Seq(seq).reverse_complement())
+            if seq:
+                features.append(feature + [seq])
+        if len([item for item in features if item[2] == "CDS"]) == 0:
+            raise ValueError("No CDS found in " + self.gff_file)
+
+        G.create_directory(outdir)
+        filepath = os.path.join(outdir, prefix)
+        with open(filepath + ".gff", "w") as gff, open(
+                filepath + ".ffn", "w") as ffn:
+            gff.write("##gff-version 3\n")
+            for contig, seq in contigs.items():
+                gff.write(
+                    "##sequence-region " + contig + " 1 " + str(len(seq))
+                    + "\n")
+            for i, feature in enumerate(features):
+                (
+                    contig, source, ftype, start, end, strand, phase,
+                    locus_tag, gene, product, seq) = feature
+                tag = name + "_" + str(i + 1).zfill(5)
+                attributes = ["ID=" + tag]
+                if gene:
+                    attributes.extend(["Name=" + gene, "gene=" + gene])
+                attributes.extend([
+                    "locus_tag=" + tag, "product=" + self.encode(product)])
+                gff.write("\t".join([
+                    contig, source, ftype, str(start), str(end), ".",
+                    strand, phase, ";".join(attributes)]) + "\n")
+                self.write_fasta(ffn, tag, seq, product)
+            gff.write("##FASTA\n")
+            for contig, seq in contigs.items():
+                self.write_fasta(gff, contig, seq)
+        with open(filepath + ".fna", "w") as fna:
+            for contig, seq in contigs.items():
+                self.write_fasta(fna, contig, seq)
+        return len(features)
+
+    @staticmethod
+    def run_conversion(job):
+        """ job: [name, genomic file, annotation dir, outdir, prefix],
+        returns [name, prefix, error message] """
+        name, genomic_file, annotation_dir, outdir, prefix = job
+        try:
+            NCBIAnnotation(genomic_file, annotation_dir).convert(
+                name, outdir, prefix)
+        except (ValueError, OSError, EOFError) as exc:
+            if os.path.isdir(outdir):
+                shutil.rmtree(outdir)
+            return [name, prefix, str(exc)]
+        return [name, prefix, None]
+
+
+class QCCache:
+    """ Top BLAST hit (GI, DB ID, species) of QC sequences, addressed by a
+    hash of the QC gene, the sequence hash, the BLAST DB version, the
+    excluded GIs and the taxid filter of the BLAST search (taxid_filter).
+    Entries of older versions of a BLAST DB are removed and the least
+    recently used entries are evicted above max_entries
+    """
+    def __init__(
+            self, cache_file, max_entries, db_version, excluded_gis,
+            taxid_filter=""):
+        self.max_entries = max_entries
+        self.db_name, self.db_version = db_version
+        self.excluded_gis = sorted(set(excluded_gis))
+        self.taxid_filter = taxid_filter
+        G.create_directory(os.path.dirname(cache_file))
+        self.conn = sqlite3.connect(cache_file, timeout=60)
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS qc_hits ("
+                "key TEXT PRIMARY KEY, db_name TEXT, db_version TEXT, "
+                "gi TEXT, db_id TEXT, species TEXT, last_used REAL)")
+            self.conn.execute(
+                "DELETE FROM qc_hits WHERE db_name = ? AND db_version != ?",
+                [self.db_name, self.db_version])
+
+    @staticmethod
+    def get_db_dirs(config):
+        """ directories searched for the BLAST DB and the DB name """
+        if config.customdb:
+            db_dirs = [os.path.dirname(os.path.abspath(config.customdb))]
+            db_name = os.path.basename(config.customdb)
+        else:
+            db_dirs = [
+                os.getcwd(), os.environ.get("BLASTDB", ""),
+                os.path.join("/", "blastdb")]
+            db_name = "nt"
+        return db_dirs, db_name
+
+    @staticmethod
+    def get_db_version(config):
+        """ (name, version) of the BLAST DB, the version is a hash of the
+        md5 files of getblastdb or else of the size and mtime of the DB
+        files, None if the DB was not found """
+        db_dirs, db_name = QCCache.get_db_dirs(config)
+        for db_dir in db_dirs:
+            if not os.path.isdir(db_dir):
+                continue
+            sha = hashlib.sha256()
+            md5_dir = os.path.join(db_dir, "md5_files")
+            if os.path.isdir(md5_dir):
+                md5_files = sorted(
+                    files for files in os.listdir(md5_dir)
+                    if files.startswith(db_name + ".")
+                    and files.endswith(".md5"))
+                for files in md5_files:
+                    with open(os.path.join(md5_dir, files), "rb") as f:
+                        sha.update(files.encode() + b"\0" + f.read())
+                if md5_files:
+                    return db_name, sha.hexdigest()
+            db_files = sorted(
+                files for files in os.listdir(db_dir)
+                if files.startswith(db_name + ".") and files.endswith((
+                    ".nal", ".nsq", ".nin", ".nhr")))
+            for files in db_files:
+                stat = os.stat(os.path.join(db_dir, files))
+                sha.update((
+                    files + "\0" + str(stat.st_size) + "\0"
+                    + str(stat.st_mtime) + "\0").encode())
+            if db_files:
+                return db_name, sha.hexdigest()
+        return None
+
+    def get_key(self, qc_gene, seq_hash):
+        sha = hashlib.sha256()
+        for item in [qc_gene, seq_hash, self.db_name, self.db_version]:
+            sha.update(item.encode() + b"\0")
+        sha.update(",".join(self.excluded_gis).encode() + b"\0")
+        sha.update(self.taxid_filter.encode())
+        return sha.hexdigest()
+
+    def get(self, keys):
+        """ {key: [gi, db_id, species]} of all cached keys """
+        keys = list(keys)
+        hits = {}
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            for key, gi, db_id, species in self.conn.execute(
+                    "SELECT key, gi, db_id, species FROM qc_hits WHERE key IN "
+                    "(" + ",".join("?" * len(chunk)) + ")", chunk):
+                hits.update({key: [gi, db_id, species]})
+        if len(hits) > 0:
+            with self.conn:
+                self.conn.executemany(
+                    "UPDATE qc_hits SET last_used = ? WHERE key = ?",
+                    [[time.time(), key] for key in hits])
+        return hits
+
+    def store(self, rows):
+        """ rows: [key, gi, db_id, species] """
+        if len(rows) == 0:
+            return
+        now = time.time()
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO qc_hits VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [[key, self.db_name, self.db_version, str(gi), db_id,
+                    species, now] for key, gi, db_id, species in rows])
+        self.evict()
+
+    def evict(self):
+        count = self.conn.execute("SELECT COUNT(*) FROM qc_hits").fetchone()[0]
+        if count <= self.max_entries:
+            return 0
+        with self.conn:
+            self.conn.execute(
+                "DELETE FROM qc_hits WHERE key IN (SELECT key FROM qc_hits "
+                "ORDER BY last_used ASC LIMIT ?)", [count - self.max_entries])
+        G.logger(
+            "QC cache: evicted " + str(count - self.max_entries) + " entries")
+        return count - self.max_entries
+
+    def close(self):
+        self.conn.close()
+
+
 class DataCollection():
     def __init__(self, configuration):
         self.config = configuration
@@ -171,9 +825,30 @@ class DataCollection():
         self.gff_dir = os.path.join(self.target_dir, "gff_files")
         self.ffn_dir = os.path.join(self.target_dir, "ffn_files")
         self.fna_dir = os.path.join(self.target_dir, "fna_files")
+        self.ncbi_annotation_dir = os.path.join(
+            self.target_dir, "ncbi_annotation")
         self.contiglimit = 500
+        self.download_workers = 4
+        # Prokka scales poorly beyond a few threads, the core budget is
+        # split between several concurrent annotation jobs instead
+        self.annotation_cores = self.config.annotation_cores
+        if self.annotation_cores <= 0:
+            self.annotation_cores = G.cpu_count()
+        self.prokka_cores = max(1, self.config.prokka_cores)
+        # Prokka results are reused across targets and runs
+        self.annotation_cache_dir = os.path.join(
+            self.config.path, "annotationcache")
+        self.annotation_cache_size = 20 * 1024 ** 3
         self.ex_dir = os.path.join(
             self.config.path, "excludedassemblies", self.target)
+        self.manifest = GenomeManifest(self.target_dir)
+        # Entrez: docsums per request, assembly metadata reuse (seconds)
+        # and at most three requests per second without an API key
+        self.entrez_pagesize = 500
+        self.metadata_ttl = 24 * 60 * 60
+        self.entrez_delay = 0.34
+        self.last_request = 0
+        self.link_records = {}
 
     def get_taxid(self, target):
         Entrez.email = H.get_email_for_Entrez()
@@ -208,35 +883,108 @@ class DataCollection():
                 for gi in removed_gis:
                     f.write(gi + "\n")
 
-    def get_ncbi_links(self, taxid, maxrecords=2000):
+    def entrez_request(self, function, **kwargs):
+        wait = self.last_request + self.entrez_delay - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        try:
+            handle = function(**kwargs)
+            record = Entrez.read(handle)
+            handle.close()
+        finally:
+            self.last_request = time.time()
+        return record
+
+    def search_assemblies(self, term, maxrecords=None, **kwargs):
+        uids = []
+        found = set()
+        webenv = None
+        query_key = None
+        retstart = 0
+        count = 1
+        while retstart < count:
+            result = self.entrez_request(
+                Entrez.esearch, db="assembly", term=term, usehistory="y",
+                retstart=retstart, retmax=10000, **kwargs)
+            count = int(result["Count"])
+            if maxrecords:
+                count = min(count, maxrecords)
+            if "WebEnv" in result.keys():
+                webenv = result["WebEnv"]
+                query_key = result["QueryKey"]
+            if len(result["IdList"]) == 0:
+                break
+            for uid in result["IdList"]:
+                if uid not in found:
+                    found.add(uid)
+                    uids.append(str(uid))
+            retstart += len(result["IdList"])
+        return uids[0:count], webenv, query_key
+
+    def fetch_docsums(self, uids, webenv=None, query_key=None):
+        docsums = []
+        for retstart in range(0, len(uids), self.entrez_pagesize):
+            if webenv:
+                # page through the search results on the history server
+                kwargs = {
+                    "webenv": webenv, "query_key": query_key,
+                    "retstart": retstart, "retmax": self.entrez_pagesize}
+            else:
+                kwargs = {
+                    "id": uids[retstart:retstart + self.entrez_pagesize]}
+            records = self.entrez_request(
+                Entrez.efetch, db="assembly", rettype="docsum",
+                retmode="xml", **kwargs)
+            docsums.extend(records["DocumentSummarySet"]["DocumentSummary"])
+            info = (
+                "Assembly metadata: " + str(len(docsums)) + " of "
+                + str(len(uids)))
+            G.logger(info)
+        return docsums
 
-        def collect_genomedata(taxid, email):
-            genomedata = []
-            # 02/12/18 overwrite file because assembly level can change
-            Entrez.email = email
-            assembly_search = Entrez.esearch(
-                db="assembly",
-                term="txid" + str(taxid) + "[Orgn]",
-                retmax=maxrecords)
-
-            assembly_record = Entrez.read(assembly_search)
-            uidlist = assembly_record["IdList"]
-            assembly_efetch = Entrez.efetch(
-                db="assembly",
-                id=uidlist,
-                rettype="docsum",
-                retmode="xml")
-
-            assembly_records = Entrez.read(assembly_efetch)
-
-            with open("genomicdata.json", "w") as f:
-                f.write(json.dumps(assembly_records))
-
-            with open("genomicdata.json", "r") as f:
-                for line in f:
-                    gen_dict = json.loads(line)
+    def update_assembly_metadata(self, taxid, maxrecords=None):
+        metadata = AssemblyMetadata(self.config_dir)
+        if metadata.is_valid(taxid, self.metadata_ttl):
+            info = "Use cached assembly metadata"
+            G.logger("> " + info)
+            print(info)
+            return metadata
+
+        term = "txid" + str(taxid) + "[Orgn]"
+        date = time.strftime("%Y/%m/%d")
+        uids, webenv, query_key = self.search_assemblies(term, maxrecords)
+        if metadata.taxid == str(taxid) and metadata.date:
+            # only new assemblies and assemblies modified since the last
+            # update are fetched again
+            changed = set(self.search_assemblies(
+                term, datetype="mdat", mindate=metadata.date,
+                maxdate=date)[0])
+            fetch = [
+                uid for uid in uids
+                if uid not in metadata.records or uid in changed]
+            webenv = None
+        else:
+            metadata.records = {}
+            fetch = uids
+        for uid in list(metadata.records.keys()):
+            if uid not in uids:
+                metadata.records.pop(uid)
+        if len(fetch) > 0:
+            metadata.add(self.fetch_docsums(fetch, webenv, query_key))
+        metadata.save(taxid, date)
+        info = (
+            "Assembly metadata: " + str(len(fetch)) + " fetched, "
+            + str(len(uids) - len(fetch)) + " from cache")
+        G.logger("> " + info)
+        print(info)
+        return metadata
+
+    def get_ncbi_links(self, taxid, maxrecords=None):
 
-            for assembly in gen_dict['DocumentSummarySet']['DocumentSummary']:
+        def collect_genomedata(taxid):
+            genomedata = []
+            metadata = self.update_assembly_metadata(taxid, maxrecords)
+            for assembly in metadata.records.values():
                 accession = assembly["AssemblyAccession"]
                 name = assembly["AssemblyName"]
                 status = assembly["AssemblyStatus"]
@@ -248,6 +996,7 @@ class DataCollection():
                         ftp_path + "/" + ftp_path.split("/")[-1]
                         + "_genomic.fna.gz"
                     )
+                    self.link_records.update({ftp_link: assembly})
                 data = [accession, name, status, ftp_link]
                 genomedata.append(data)
 
@@ -279,10 +1028,9 @@ class DataCollection():
 
         G.logger("Run: ncbi_genome_links(" + self.target + ")")
         os.chdir(self.config_dir)
-        email = H.get_email_for_Entrez()
-        genomedata = collect_genomedata(taxid, email)
-        time.sleep(1)
-        link_list = get_links(genomedata)
+        Entrez.email = H.get_email_for_Entrez()
+        genomedata = collect_genomedata(taxid)
+        link_list = self.filter_assemblies(get_links(genomedata))
         msg = " genome assemblies are available for download"
         statmsg = "genome assemblies from NCBI: " + str(len(link_list))
         if self.config.assemblylevel == ["offline"]:
@@ -299,36 +1047,134 @@ class DataCollection():
         os.chdir(self.target_dir)
 
 
+    @staticmethod
+    def get_assembly_stats(assembly):
+        stats = {}
+        meta = assembly.get("Meta", "")
+        for category, value in re.findall(
+                r'<Stat category="(\w+)" sequence_tag="all">(\d+)</Stat>',
+                meta):
+            stats.update({category: int(value)})
+        return stats
+
+    def check_assembly(self, assembly):
+        stats = self.get_assembly_stats(assembly)
+        if "contig_count" in stats:
+            if stats["contig_count"] >= self.contiglimit:
+                return (
+                    "has more than " + str(self.contiglimit) + " contigs ("
+                    + str(stats["contig_count"]) + ")")
+        # ExclFromRefSeq is not checked, it lists also valid assemblies
+        # (e.g. "from large multi-isolate project")
+        if len(assembly.get("AnomalousList", [])) > 0:
+            return "is flagged as anomalous by NCBI"
+        return None
+
+    def filter_assemblies(self, link_list):
+        # drop assemblies before the download if the docsum already shows
+        # that they will not pass the quality control
+        if self.config.ignore_qc:
+            return link_list
+        passed = []
+        excluded = []
+        for link in link_list:
+            if link not in self.link_records:
+                passed.append(link)
+                continue
+            assembly = self.link_records[link]
+            reason = self.check_assembly(assembly)
+            if reason is None:
+                passed.append(link)
+            else:
+                name = "v".join(assembly["AssemblyAccession"].split("."))
+                msg = (
+                    assembly["AssemblyAccession"] + " " + reason
+                    + " and will not be downloaded, to include it in the "
+                    "run use the ignore_qc option")
+                print(msg)
+                G.logger(msg)
+                excluded.append(name)
+
+        if len(excluded) > 0:
+            known = self.get_excluded_assemblies()
+            self.write_excluded_assemblies(
+                [name for name in excluded if name not in known])
+            self.manifest.update(excluded, "excluded", "Assembly metadata")
+            info = (
+                "Assembly metadata filter: " + str(len(excluded))
+                + " genome assemblies excluded before download")
+            G.logger("> " + info)
+            print(info)
+            PipelineStatsCollector(self.target_dir).write_stat(info)
+        return passed
+
+    def write_excluded_assemblies(self, names):
+        if len(names) == 0:
+            return
+        G.create_directory(self.ex_dir)
+        with open(os.path.join(self.ex_dir, "excluded_list.txt"), "a") as f:
+            for item in names:
+                f.write(item + "\n")
+
     def check_download_files(self, input_line):
-        line = input_line.strip()
-        zip_file = line.split("/")[-1]
-        name_start = (
-            zip_file.split(".")[0]
-            + "v" + zip_file.split(".")[1].split("_")[0])
-        directories = [self.gff_dir, self.ffn_dir]
-        gff = False
-        ffn = False
-        genomic = False
-        for directory in directories:
-            for files in [f for f in os.listdir(directory)]:
-                if files.startswith(name_start):
-                    if directory == self.gff_dir:
-                        if files.endswith(".gff"):
-                            gff = True
-                    elif directory == self.ffn_dir:
-                        if files.endswith(".ffn"):
-                            ffn = True
-        for files in [f for f in os.listdir(self.genomic_dir)]:
-            if files == zip_file.split(".gz")[0]:
-                genomic = True
-        if (gff and ffn) is True:
+        zip_file = input_line.strip().split("/")[-1]
+        state = self.manifest.get_state(GenomeManifest.genome_name(zip_file))
+        if state in ["annotated", "passed"]:
             status = True
-        elif genomic is True:
+        elif state == "extracted":
             status = "Extracted"
         else:
             status = False
         return status
 
+    def get_names(self, directory, extension):
+        names = set()
+        if os.path.isdir(directory):
+            for files in os.listdir(directory):
+                if files.endswith(extension):
+                    names.add("_".join(files.split("_")[:-1]))
+        return names
+
+    def sync_manifest(self):
+        # one pass over the directories to register genomes of earlier
+        # runs or added by the user and to forget removed files
+        found = {}
+        genomic_files = []
+        if os.path.isdir(self.genomic_dir):
+            genomic_files = os.listdir(self.genomic_dir)
+        for files in genomic_files:
+            if files.endswith(".part"):
+                continue
+            name = GenomeManifest.genome_name(files.split(".gz")[0])
+            if files.endswith(".gz"):
+                if name not in found:
+                    found.update({name: "downloaded"})
+            elif files.endswith(".fna"):
+                found.update({name: "extracted"})
+        annotated = (
+            self.get_names(self.gff_dir, ".gff")
+            & self.get_names(self.ffn_dir, ".ffn"))
+        for name in annotated:
+            found.update({name: "annotated"})
+        for name in self.get_excluded_assemblies():
+            found.update({name: "excluded"})
+
+        removed = []
+        for name in list(self.manifest.genomes.keys()):
+            if name not in found:
+                removed.append(name)
+        if len(removed) > 0:
+            self.manifest.remove(removed)
+        for state in GenomeManifest.states:
+            names = [
+                name for name in found if found[name] == state
+                and self.manifest.get_state(name) != state
+                and not (
+                    state == "annotated"
+                    and self.manifest.get_state(name) == "passed")]
+            if len(names) > 0:
+                self.manifest.update(names, state)
+
     def get_excluded_assemblies(self):
         excluded = []
         # a list of excluded Genomes to keep information
@@ -348,7 +1194,8 @@ class DataCollection():
         G.create_directory(self.gff_dir)
         G.create_directory(self.ffn_dir)
         G.create_directory(self.fna_dir)
-        excluded = self.get_excluded_assemblies()
+        self.sync_manifest()
+        jobs = []
         os.chdir(self.genomic_dir)
         with open(os.path.join(self.config_dir, "genomic_links.txt")) as r:
             for line in r:
@@ -367,85 +1214,370 @@ class DataCollection():
                         info = "File already downloaded " + zip_file
                         G.logger(info)
                     else:
-                        if [
-                                ex for ex in excluded
-                                if zip_file.startswith(".".join(ex.split("v")))
-                        ]:
+                        name = GenomeManifest.genome_name(zip_file)
+                        if self.manifest.get_state(name) == "excluded":
                             msg = " already in excludedassemblies"
                             print(zip_file + msg)
                             G.logger(zip_file + msg)
                         else:
-                            print_msg = "\n\nDownload..." + zip_file + "\n"
-                            info = "Downloaded " + zip_file
-                            try:
-                                print(print_msg)
-                                wget.download(ftp_path)
-                                print("\n")
-                                G.logger(info)
-                            except urllib.error.HTTPError:
-                                try:
-                                    print("\ntry again\n")
-                                    print(print_msg)
-                                    wget.download(ftp_path)
-                                    print("\n")
-                                    G.logger(info)
-                                except urllib.error.HTTPError:
-                                    try:
-                                        print("\ntry a last time\n")
-                                        print(print_msg)
-                                        wget.download(ftp_path)
-                                        print("\n")
-                                        G.logger(info)
-                                    except urllib.error.HTTPError:
-                                        error_msg = (
-                                            "SpeciesPrimer in unable to "
-                                            "connect to the NCBI FTP server. "
-                                            "Please check internet connection "
-                                            "and NCBI FTP server status")
-                                        print(error_msg)
-                                        G.logger("> " + error_msg)
-                                        errors.append([self.target, error_msg])
-                                        raise
+                            jobs.append([ftp_path, target_path])
+
+        if len(jobs) > 0:
+            self.download_genomes(jobs)
+        if self.config.annotation == "ncbi":
+            self.download_ncbi_annotation()
+
+        self.decompress_genomes()
+        os.chdir(self.target_dir)
+
+    def download_genomes(self, jobs):
+        info = "Download " + str(len(jobs)) + " genome assemblies"
+        print("\n" + info)
+        G.logger("> " + info)
+        downloader = DownloadManager(
+            max_workers=self.download_workers, decompress=True)
+        # one stats table for the whole download, saved every 50 genomes
+        fasta_stats = FastaStats(
+            os.path.join(self.config_dir, "fasta_stats.json"))
+        ready = []
+
+        def genome_ready(filepath):
+            # genomes are extracted during the download and checked
+            # while the remaining files are still downloading
+            filename = os.path.basename(filepath)
+            self.manifest.update(
+                GenomeManifest.genome_name(filename), "extracted")
+            self.remove_max_contigs([filename], fasta_stats)
+            ready.append(filename)
+            if len(ready) % 50 == 0:
+                fasta_stats.save()
+
+        try:
+            downloader.download_all(jobs, callback=genome_ready)
+        except (OSError, http.client.HTTPException):
+            error_msg = (
+                "SpeciesPrimer in unable to "
+                "connect to the NCBI FTP server. "
+                "Please check internet connection "
+                "and NCBI FTP server status")
+            print(error_msg)
+            G.logger("> " + error_msg)
+            errors.append([self.target, error_msg])
+            raise
+        finally:
+            fasta_stats.save()
+            downloader.close()
+            info = downloader.summary()
+            print(info)
+            G.logger("> " + info)
+            PipelineStatsCollector(self.target_dir).write_stat(info)
+
+    def download_ncbi_annotation(self):
+        """ RefSeq annotation files of the genomes that are not annotated,
+        genomes without annotation files are annotated by Prokka """
+        jobs = []
+        G.create_directory(self.ncbi_annotation_dir)
+        with open(os.path.join(self.config_dir, "genomic_links.txt")) as r:
+            for line in r:
+                link = line.strip()
+                zip_file = link.split("/")[-1]
+                if not zip_file.startswith("GCF_"):
+                    continue
+                if self.check_download_files(line) is True:
+                    continue
+                name = GenomeManifest.genome_name(zip_file)
+                if self.manifest.get_state(name) == "excluded":
+                    continue
+                for annotation_link in NCBIAnnotation.get_links(link):
+                    filepath = os.path.join(
+                        self.ncbi_annotation_dir,
+                        annotation_link.split("/")[-1])
+                    if not os.path.isfile(filepath):
+                        jobs.append([annotation_link, filepath])
+        if len(jobs) == 0:
+            return []
+
+        info = "Download " + str(len(jobs)) + " NCBI annotation files"
+        print("\n" + info)
+        G.logger("> " + info)
+        downloader = DownloadManager(max_workers=self.download_workers)
+        try:
+            downloaded = downloader.download_all(jobs, skip_failed=True)
+        finally:
+            downloader.close()
+            info = downloader.summary()
+            G.logger("> " + info)
+        return downloaded
 
+    def use_ncbi_annotation(self, prokka_jobs):
+        """ converts the NCBI annotation of the genomes in prokka_jobs,
+        returns the annotation directories and the remaining Prokka jobs """
+        annotation_dirs = []
+        remaining = []
+        jobs = []
+        date = time.strftime("%Y%m%d")
+        for file_name, fna in prokka_jobs:
+            genomic_file = os.path.join(self.genomic_dir, fna)
+            if NCBIAnnotation(
+                    genomic_file, self.ncbi_annotation_dir).is_available():
+                prefix = file_name + "_" + date
+                jobs.append([
+                    file_name, genomic_file, self.ncbi_annotation_dir,
+                    os.path.join(self.target_dir, prefix), prefix])
+            else:
+                remaining.append([file_name, fna])
+        if len(jobs) == 0:
+            return annotation_dirs, prokka_jobs
+
+        converted = []
+        for file_name, prefix, error in G.run_parallel(
+                NCBIAnnotation.run_conversion, jobs, verbosity=""):
+            if error is None:
+                converted.append(file_name)
+                annotation_dirs.append(prefix)
+            else:
+                G.logger(
+                    "NCBI annotation of " + file_name + " not used: "
+                    + error)
+        remaining.extend([
+            [job[0], os.path.basename(job[1])] for job in jobs
+            if job[0] not in converted])
+        if len(converted) > 0:
+            self.manifest.update(converted, "annotated")
+            if self.config.intermediate is False:
+                for job in jobs:
+                    if job[0] in converted:
+                        annotation = NCBIAnnotation(job[1], job[2])
+                        os.remove(annotation.gff_file)
+                        os.remove(annotation.cds_file)
+        info = (
+            "NCBI annotation: used for " + str(len(converted))
+            + " genome(s), " + str(len(remaining))
+            + " genome(s) require Prokka")
+        G.logger("> " + info)
+        print("\n" + info)
+        PipelineStatsCollector(self.target_dir).write_stat(info)
+        return annotation_dirs, remaining
+
+    def decompress_genomes(self):
+        gz_files = []
         for files in os.listdir(self.genomic_dir):
             if files.endswith(".gz"):
-                G.run_subprocess(["gunzip", files], False, True, False)
-        os.chdir(self.target_dir)
+                gz_files.append(os.path.join(self.genomic_dir, files))
+        if len(gz_files) > 0:
+            info = "Extract " + str(len(gz_files)) + " genome assemblies"
+            print(info)
+            G.logger(info)
+            G.run_parallel(G.gunzip_file, gz_files, verbosity="")
 
     def copy_genome_files(self):
         G.logger("Run: copy_genome_files(" + self.target + ")")
+        # one listing per directory instead of one for every file found
+        present = {}
+        for directory in [self.ffn_dir, self.gff_dir, self.fna_dir]:
+            G.create_directory(directory)
+            present.update({directory: set(os.listdir(directory))})
         for root, dirs, files in os.walk(self.target_dir):
             for file_name in files:
                 if file_name.endswith(".ffn"):
-                    ffn_file = os.path.join(self.ffn_dir, file_name)
-                    if file_name not in os.listdir(self.ffn_dir):
-                        shutil.copy(os.path.join(root, file_name), ffn_file)
-                if file_name.endswith(".gff"):
-                    gff_file = os.path.join(self.gff_dir, file_name)
-                    if file_name not in os.listdir(self.gff_dir):
-                        shutil.copy(os.path.join(root, file_name), gff_file)
-                if file_name.endswith(".fna"):
-                    if not file_name.endswith("genomic.fna"):
-                        if "genomic_fna" not in root.split("/"):
-                            fna_file = os.path.join(self.fna_dir, file_name)
-                            if file_name not in os.listdir(self.fna_dir):
-                                shutil.copy(
-                                    os.path.join(root, file_name), fna_file)
+                    directory = self.ffn_dir
+                elif file_name.endswith(".gff"):
+                    directory = self.gff_dir
+                elif (
+                        file_name.endswith(".fna")
+                        and not file_name.endswith("genomic.fna")
+                        and "genomic_fna" not in root.split("/")):
+                    directory = self.fna_dir
+                else:
+                    continue
+                if file_name in present[directory]:
+                    continue
+                name = "_".join(file_name.split("_")[:-1])
+                if self.manifest.get_state(name) == "excluded":
+                    continue
+                shutil.copy(
+                    os.path.join(root, file_name),
+                    os.path.join(directory, file_name))
+                present[directory].add(file_name)
+
+    def start_prokka(self, filename, fna, cpus, date):
+        start = time.time()
+        genus = self.target.split("_")[0]
+        outdir = os.path.join(self.target_dir, filename + "_" + date)
+        prokka_cmd = [
+            "prokka",
+            "--kingdom", "Bacteria",
+            "--outdir", outdir,
+            "--genus", genus,
+            "--locustag", filename,
+            "--prefix", filename + "_" + date,
+            "--cpus", str(cpus),
+            os.path.join(self.genomic_dir, fna)
+        ]
+        G.logger(filename + " annotation required")
+        G.logger("Run " + " ".join(prokka_cmd))
+        print("Run " + " ".join(prokka_cmd))
+        returncode = self.prokka_processes.run(
+            prokka_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        annotated = returncode == 0
+        for ext in ["gff", "ffn"]:
+            if not os.path.isfile(os.path.join(
+                    outdir, filename + "_" + date + "." + ext)):
+                annotated = False
+        return filename + "_" + date, annotated, time.time() - start
+
+    def get_prokka_version(self):
+        try:
+            process = subprocess.run(
+                ["prokka", "--version"], stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT, universal_newlines=True)
+        except OSError:
+            return None
+        for line in process.stdout.splitlines():
+            if line.startswith("prokka"):
+                return line.split()[-1]
+        return None
+
+    def get_annotation_cache(self):
+        version = self.get_prokka_version()
+        if version is None:
+            info = "Prokka version not found, annotation cache disabled"
+            print(info)
+            G.logger("> " + info)
+            return None
+        self.annotation_settings = [version, self.target.split("_")[0]]
+        self.annotation_keys = {}
+        return AnnotationCache(
+            self.annotation_cache_dir, self.annotation_cache_size)
+
+    def get_cache_key(self, file_name, fna):
+        if fna not in self.annotation_keys:
+            self.annotation_keys.update({
+                fna: AnnotationCache.get_key(
+                    os.path.join(self.genomic_dir, fna),
+                    self.annotation_settings + [file_name])})
+        return self.annotation_keys[fna]
+
+    def fetch_annotations(self, cache, prokka_jobs):
+        remaining = []
+        cached = []
+        date = time.strftime("%Y%m%d")
+        for file_name, fna in prokka_jobs:
+            target_files = {
+                "gff": os.path.join(
+                    self.gff_dir, file_name + "_" + date + ".gff"),
+                "ffn": os.path.join(
+                    self.ffn_dir, file_name + "_" + date + ".ffn"),
+                "fna": os.path.join(
+                    self.fna_dir, file_name + "_" + date + ".fna")}
+            if cache.fetch(self.get_cache_key(file_name, fna), target_files):
+                cached.append(file_name)
+            else:
+                remaining.append([file_name, fna])
+        if len(cached) > 0:
+            self.manifest.update(cached, "annotated")
+            info = (
+                "Annotation cache: reused " + str(len(cached))
+                + " annotation(s)")
+            G.logger("> " + info)
+            G.logger(cached)
+            print("\n" + info)
+            PipelineStatsCollector(self.target_dir).write_stat(info)
+        return remaining
 
-    def run_prokka(self):
+    def store_annotation(self, cache, file_name, fna, outdir):
+        outpath = os.path.join(self.target_dir, outdir)
+        source_files = {}
+        for ext in AnnotationCache.extensions:
+            source_files.update({
+                ext: os.path.join(outpath, outdir + "." + ext)})
+        cache.store(self.get_cache_key(file_name, fna), source_files)
+
+    def schedule_prokka(self, prokka_jobs, cache=None):
         annotation_dirs = []
+        start = time.time()
+        date = time.strftime("%Y%m%d")
+        # longest genomes first, so the slowest job does not start last
+        prokka_jobs = sorted(
+            prokka_jobs, key=lambda job: os.path.getsize(
+                os.path.join(self.genomic_dir, job[1])), reverse=True)
+        workers = max(1, self.annotation_cores // self.prokka_cores)
+        workers = min(workers, len(prokka_jobs))
+        cpus = max(1, self.annotation_cores // workers)
+        info = (
+            str(len(prokka_jobs)) + " annotation(s) required, run "
+            + str(workers) + " Prokka job(s) with " + str(cpus) + " cpus")
+        G.logger("> " + info)
+        print("\n" + info)
 
-        def excluded_assemblies():
-            qc_fail_dirs = []
-            # list of failed assemblies
-            if os.path.isfile(os.path.join(self.ex_dir, "excluded_list.txt")):
-                with open(
-                    os.path.join(self.ex_dir, "excluded_list.txt"), "r"
-                ) as f:
-                    for line in f:
-                        line = line.strip()
-                        qc_fail_dirs.append(line)
-            return qc_fail_dirs
+        running = {}
+        failed = []
+        self.prokka_processes = ProcessGroup()
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        try:
+            for file_name, fna in prokka_jobs:
+                future = executor.submit(
+                    self.start_prokka, file_name, fna, cpus, date)
+                running.update({future: [file_name, fna]})
+            for future in concurrent.futures.as_completed(running):
+                outdir, annotated, duration = future.result()
+                file_name, fna = running.pop(future)
+                if annotated:
+                    annotation_dirs.append(outdir)
+                    self.manifest.update(file_name, "annotated")
+                    # only complete annotations are shared with other runs
+                    if cache:
+                        self.store_annotation(cache, file_name, fna, outdir)
+                    info = "Annotated " + file_name
+                else:
+                    # incomplete output, the genome is annotated again
+                    # in the next run
+                    failed.append(file_name)
+                    outpath = os.path.join(self.target_dir, outdir)
+                    if os.path.isdir(outpath):
+                        shutil.rmtree(outpath)
+                    info = "Prokka failed for " + file_name
+                info = (
+                    info + " (" + str(len(annotation_dirs) + len(failed))
+                    + " of " + str(len(prokka_jobs)) + "): "
+                    + str(timedelta(seconds=duration)).split(".")[0])
+                G.logger(info)
+                print(info)
+        except BaseException as exc:
+            # no queued job may start once the annotation is stopped
+            for future in running:
+                future.cancel()
+            # stop the running Prokka jobs before their output is removed
+            self.prokka_processes.terminate()
+            executor.shutdown(wait=True)
+            # remove the output of every job that did not finish
+            for file_name, fna in running.values():
+                dirpath = os.path.join(self.target_dir, file_name + "_" + date)
+                if isinstance(exc, (KeyboardInterrupt, SystemExit)):
+                    G.keyexit_rollback("annotation", dp=dirpath)
+                elif os.path.isdir(dirpath):
+                    shutil.rmtree(dirpath)
+            raise
+        finally:
+            executor.shutdown(wait=False)
+
+        duration = time.time() - start
+        info = (
+            "Annotation of " + str(len(annotation_dirs)) + " genome(s): "
+            + str(timedelta(seconds=duration)).split(".")[0])
+        G.logger("> " + info)
+        PipelineStatsCollector(self.target_dir).write_stat(info)
+        if failed:
+            msg = (
+                "Prokka annotation failed for " + str(len(failed))
+                + " genome(s): " + ", ".join(sorted(failed)))
+            print(msg)
+            G.logger("> " + msg)
+            errors.append([self.target, msg])
+        return annotation_dirs
+
+    def run_prokka(self):
+        annotation_dirs = []
 
         def get_annotation_dirs():
             dirs = []
@@ -463,7 +1595,9 @@ class DataCollection():
             # list of genomic files
             if os.path.isdir(self.genomic_dir):
                 for file_name in os.listdir(self.genomic_dir):
-                    genomic_files.append(file_name)
+                    # incomplete downloads are resumed in the next run
+                    if not file_name.endswith(".part"):
+                        genomic_files.append(file_name)
             return genomic_files
 
         def get_filenames(directory):
@@ -486,39 +1620,12 @@ class DataCollection():
                         info = "Removed " + filepath
                         G.logger(info)
 
-        def start_prokka(filename, fna):
-            date = time.strftime("%Y%m%d")
-            genus = self.target.split("_")[0]
-            #outdir = filename + "_" + date
-            outdir = os.path.join(self.target_dir, filename + "_" + date)
-            prokka_cmd = [
-                "prokka",
-                "--kingdom", "Bacteria",
-                "--outdir", outdir,
-                "--genus", genus,
-                "--locustag", filename,
-                "--prefix", filename + "_" + date,
-                "--cpus", "0",
-                "genomic_fna/" + fna
-            ]
-            info = file_name + " annotation required"
-            G.logger(info)
-            print("\n" + info)
-            try:
-                G.run_subprocess(prokka_cmd, True, True, False)
-            except (KeyboardInterrupt, SystemExit):
-                G.keyexit_rollback(
-                    "annotation", dp=os.path.join(self.target_dir, outdir))
-                raise
-
-            annotation_dirs.append(filename + "_" + date)
-
         annotated = []
         excluded = []
         G.logger("Run: run_prokka(" + self.target + ")")
 
+        self.sync_manifest()
         dirs = get_annotation_dirs()
-        qc_fail_dirs = excluded_assemblies()
         genomic_files = get_genomic_files()
         # set intersection to identify the required annotation files
         fna_names = get_filenames(self.fna_dir)
@@ -534,6 +1641,7 @@ class DataCollection():
         check_incomplete(annotatedname, ffn_names, self.ffn_dir)
 
         # write annotation command
+        prokka_jobs = []
         for fna in genomic_files:
             if fna.endswith("_genomic.fna"):
                 file_name = (
@@ -549,10 +1657,27 @@ class DataCollection():
             if file_name in dirs:
                 if file_name != '':
                     annotated.append(file_name)
-            elif file_name in qc_fail_dirs:
+            elif self.manifest.get_state(file_name) == "excluded":
                 excluded.append(file_name)
             else:
-                start_prokka(file_name, fna)
+                prokka_jobs.append([file_name, fna])
+
+        if len(prokka_jobs) > 0 and self.config.annotation == "ncbi":
+            annotation_dirs, prokka_jobs = self.use_ncbi_annotation(
+                prokka_jobs)
+
+        if len(prokka_jobs) > 0:
+            cache = self.get_annotation_cache()
+            if cache:
+                try:
+                    prokka_jobs = self.fetch_annotations(cache, prokka_jobs)
+                    if len(prokka_jobs) > 0:
+                        annotation_dirs += self.schedule_prokka(
+                            prokka_jobs, cache)
+                finally:
+                    cache.close()
+            else:
+                annotation_dirs += self.schedule_prokka(prokka_jobs)
 
         if len(annotated) > 0:
             info = "Already annotated: "
@@ -570,26 +1695,69 @@ class DataCollection():
 
         return annotation_dirs, annotated
 
+    def get_exception_taxids(self):
+        # taxids of synonyms and exceptions, names are only searched once
+        cachefile = os.path.join(self.config_dir, "exception_taxids.json")
+        cached = {}
+        if os.path.isfile(cachefile):
+            with open(cachefile) as f:
+                cached = json.load(f)
+        for name in self.config.exception:
+            if name in cached:
+                continue
+            try:
+                result = self.entrez_request(
+                    Entrez.esearch, db="taxonomy", term=name)
+            except (OSError, RuntimeError):
+                G.logger("No taxid found for exception " + name)
+                continue
+            if len(result["IdList"]) == 1:
+                cached.update({name: str(result["IdList"][0])})
+            else:
+                cached.update({name: None})
+        with open(cachefile, "w") as f:
+            json.dump(cached, f)
+        return [
+            cached[name] for name in self.config.exception
+            if cached.get(name)]
+
     def create_taxidlist(self, taxid):
-        # removes the target species taxid from the taxidlist
-        # sequences for the target will not searched by blastn
+        # removes the target species taxid, synonyms and exceptions from
+        # the taxidlist, sequences of these taxa are not searched by blastn
         txidlist = os.path.join(dict_path, "2.txids")
         taxidlist = os.path.join(self.config_dir, "taxidlist.txt")
-        with open(taxidlist, "w") as r:
-            with open(txidlist, "r") as f:
-                for line in f:
-                    if not line.strip() == taxid:
-                        r.write(line)
-
-    def remove_max_contigs(self):
+        keyfile = os.path.join(self.config_dir, "taxidlist.key")
+        exclude = sorted(set([str(taxid)] + self.get_exception_taxids()))
+        key = (
+            str(os.path.getmtime(txidlist)) + " " + " ".join(exclude))
+        if os.path.isfile(taxidlist) and os.path.isfile(keyfile):
+            with open(keyfile) as f:
+                if f.read() == key:
+                    G.logger("> Use cached taxidlist")
+                    return taxidlist
+        taxids = TaxidSet(txidlist)
+        try:
+            taxids.write_difference(exclude, taxidlist)
+        finally:
+            taxids.close()
+        with open(keyfile, "w") as f:
+            f.write(key)
+        G.logger("> taxidlist without taxid(s): " + ", ".join(exclude))
+        return taxidlist
+
+    def remove_max_contigs(self, genomic_files=None, fasta_stats=None):
+        """ fasta_stats: stats table of the caller, saved by the caller """
         maxcontigs = []
-        for files in os.listdir(self.genomic_dir):
+        if genomic_files is None:
+            genomic_files = os.listdir(self.genomic_dir)
+        save_stats = fasta_stats is None
+        if save_stats:
+            fasta_stats = FastaStats(
+                os.path.join(self.config_dir, "fasta_stats.json"))
+        for files in genomic_files:
             if files.endswith(".fna"):
-                contigcount = 0
                 filepath = os.path.join(self.genomic_dir, files)
-                for line in open(filepath).readlines():
-                    if ">" in line:
-                        contigcount += 1
+                contigcount = fasta_stats.get(filepath)["contigs"]
                 if contigcount >= self.contiglimit:
                     if self.config.ignore_qc is False:
                         if files.endswith("_genomic.fna"):
@@ -615,19 +1783,11 @@ class DataCollection():
                             G.create_directory(excl_path)
                         shutil.move(filepath, os.path.join(excl_path, files))
 
+        if save_stats:
+            fasta_stats.save()
         if len(maxcontigs) > 0:
-            if os.path.isfile(os.path.join(self.ex_dir, "excluded_list.txt")):
-                with open(
-                    os.path.join(self.ex_dir, "excluded_list.txt"), "a"
-                ) as f:
-                    for item in maxcontigs:
-                        f.write(item + "\n")
-            else:
-                with open(
-                    os.path.join(self.ex_dir, "excluded_list.txt"), "w"
-                ) as f:
-                    for item in maxcontigs:
-                        f.write(item + "\n")
+            self.manifest.update(maxcontigs, "excluded", "Max contigs")
+            self.write_excluded_assemblies(maxcontigs)
 
     def add_synonym_exceptions(self, syn):
         for item in syn:
@@ -645,8 +1805,7 @@ class DataCollection():
     def collect(self):
         G.logger("Run: collect data(" + self.target + ")")
         self.prepare_dirs()
-        pan = os.path.join(self.pangenome_dir, "gene_presence_absence.csv")
-        if os.path.isfile(pan):
+        if PangenomeAnalysis.keep_existing(self.config):
             return 0
 
         if not self.config.offline:
@@ -662,25 +1821,24 @@ class DataCollection():
                 G.create_directory(self.gff_dir)
                 G.create_directory(self.ffn_dir)
                 G.create_directory(self.fna_dir)
-                for files in os.listdir(self.genomic_dir):
-                    if files.endswith(".gz"):
-                        filepath = os.path.join(self.genomic_dir, files)
-                        G.run_subprocess(
-                            ["gunzip", filepath], False, True, False)
+                self.decompress_genomes()
                 os.chdir(self.target_dir)
         else:
             G.create_directory(self.gff_dir)
             G.create_directory(self.ffn_dir)
             G.create_directory(self.fna_dir)
-            for files in os.listdir(self.genomic_dir):
-                if files.endswith(".gz"):
-                    filepath = os.path.join(self.genomic_dir, files)
-                    G.run_subprocess(
-                        ["gunzip", filepath], False, True, False)
+            self.decompress_genomes()
             os.chdir(self.target_dir)
 
         self.remove_max_contigs()
         self.create_GI_list()
+        if self.config.preqc and not self.config.ignore_qc:
+            # genomes which fail QC are excluded before the annotation
+            qc_count = CombinedQualityControl(
+                self.config, PreAnnotationQC).quality_control(
+                    self.config.qc_gene)
+            if not sum(qc_count) == 0:
+                return self.config
         annotation_dirs, annotated = self.run_prokka()
         self.copy_genome_files()
 
@@ -702,6 +1860,8 @@ class QualityControl:
         "dnaK": "product=Chaperone protein DnaK",
         "recA": "product=Protein RecA",
         "pheS": "product=Phenylalanine--tRNA ligase alpha subunit"}
+    # <qc_gene><qc_suffix>: directory of the QC reports
+    qc_suffix = "_QC"
 
     def __init__(self, configuration):
         self.config = configuration
@@ -716,6 +1876,8 @@ class QualityControl:
         self.ffn_dir = os.path.join(self.target_dir, "ffn_files")
         self.fna_dir = os.path.join(self.target_dir, "fna_files")
         self.qc_gene_search = []
+        self.qc_gene_found = set()
+        self.qc_index = {}
         self.ffn_list = []
         self.contiglimit = 500
         self.no_seq = []
@@ -723,6 +1885,18 @@ class QualityControl:
         self.contig_ex = []
         self.problems = []
         self.passed = []
+        self.qc_queries = {}
+        self.qc_hits = {}
+        self.cached_hits = {}
+        # rows of genomes in a previous QC report that are no longer input
+        self.qc_history = []
+        # {genome name: input file} of the QC results
+        self.qc_inputs = {}
+        # top hits of QC sequences are reused across targets and runs
+        self.qc_cache_file = os.path.join(
+            self.config.path, "qccache", "qc_classification.db")
+        self.qc_cache_size = 500000
+        self.manifest = GenomeManifest(self.target_dir)
 
     def get_excluded_gis(self):
         excluded_gis = []
@@ -735,30 +1909,194 @@ class QualityControl:
                         excluded_gis.append(str(gi))
         return excluded_gis
 
-    def search_qc_gene(self, file_name, qc_gene):
-        with open(os.path.join(self.gff_dir, file_name), "r") as f:
+    def input_files(self):
+        gff_files = []
+        if os.path.isdir(self.gff_dir):
+            for file_name in os.listdir(self.gff_dir):
+                name = "_".join(file_name.split(".gff")[0].split("_")[0:-1])
+                if self.manifest.get_state(name) != "excluded":
+                    gff_files.append(file_name)
+        return gff_files
+
+    def get_preqc_failures(self, qc_gene):
+        """ report rows of the genomes excluded by the QC before annotation
+        (--preqc), listed again in the QC report of the annotated genomes
+        """
+        failures = []
+        report = os.path.join(
+            self.target_dir, qc_gene + PreAnnotationQC.qc_suffix,
+            qc_gene + "_QC_report.csv")
+        if os.path.isfile(report):
+            with open(report, "r") as f:
+                reader = csv.reader(f)
+                next(reader, None)
+                for row in reader:
+                    if len(row) == 6 and "passed QC" not in row[5]:
+                        failures.append(row)
+        return failures
+
+    def get_qc_key(self, qc_gene):
+        """ hash of the settings of a QC result, the results of a previous
+        run are only reused with the same settings """
+        settings = [
+            qc_gene, self.target, sorted(self.exception),
+            sorted(self.get_excluded_gis()), self.get_db_version()]
+        return hashlib.sha256(json.dumps(settings).encode()).hexdigest()
+
+    @staticmethod
+    def file_signature(filepath):
+        stat = os.stat(filepath)
+        return [stat.st_size, stat.st_mtime]
+
+    def reuse_qc_results(self, qc_gene, inputs):
+        """ inputs: {genome name: input file}. The results of genomes in
+        the QC report of a previous run are reused while the input file and
+        the settings are unchanged (<qc_gene>_QC_state.json), returns the
+        names of the genomes that need QC """
+        qc_dir = os.path.join(self.target_dir, qc_gene + self.qc_suffix)
+        report = os.path.join(qc_dir, qc_gene + "_QC_report.csv")
+        state_file = os.path.join(qc_dir, qc_gene + "_QC_state.json")
+        self.qc_inputs.update(inputs)
+        if not os.path.isfile(report) or not os.path.isfile(state_file):
+            return list(inputs)
+        try:
+            with open(state_file) as f:
+                state = json.load(f)
+        except ValueError:
+            return list(inputs)
+        if state.get("key") != self.get_qc_key(qc_gene):
+            return list(inputs)
+        previous = state.get("genomes", {})
+        reused = set()
+        with open(report, "r") as f:
+            reader = csv.reader(f)
+            next(reader, None)
+            for row in reader:
+                if len(row) != 6:
+                    continue
+                name = "_".join(row[0].split("_")[0:-1])
+                if name not in inputs:
+                    self.qc_history.append(row)
+                elif row[5] in ["passed QC", "failed QC"] and previous.get(
+                        name) == self.file_signature(inputs[name]):
+                    reused.add(name)
+                    if row[5] == "passed QC":
+                        self.passed.append(row)
+                    else:
+                        self.problems.append(row)
+        new = [name for name in inputs if name not in reused]
+        if len(reused) > 0:
+            info = (
+                qc_gene + " QC: reused the results of " + str(len(reused))
+                + " Genome(s), " + str(len(new)) + " new Genome(s)")
+            print(info)
+            G.logger("> " + info)
+            PipelineStatsCollector(self.target_dir).write_stat(info)
+        return new
+
+    def save_qc_state(self, qc_gene):
+        """ settings and input files of the genomes with a QC result """
+        qc_dir = os.path.join(self.target_dir, qc_gene + self.qc_suffix)
+        state_file = os.path.join(qc_dir, qc_gene + "_QC_state.json")
+        genomes = {}
+        for row in self.passed + self.problems:
+            name = "_".join(row[0].split("_")[0:-1])
+            if name in self.qc_inputs and os.path.isfile(
+                    self.qc_inputs[name]):
+                genomes.update({
+                    name: self.file_signature(self.qc_inputs[name])})
+        state = {"key": self.get_qc_key(qc_gene), "genomes": genomes}
+        with open(state_file + ".tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(state_file + ".tmp", state_file)
+
+    @staticmethod
+    def clear_blastfiles(qc_dir):
+        # BLAST files of a previous run must not be parsed again
+        for files in os.listdir(qc_dir):
+            if ".part-" in files or files.endswith(".xml"):
+                os.remove(os.path.join(qc_dir, files))
+
+    @staticmethod
+    def index_gff(filepath, searchdict):
+        # one pass over a gff file for the loci of all QC genes
+        index = {qc_gene: [] for qc_gene in searchdict}
+        with open(filepath, "r") as f:
             for line in f:
-                if self.searchdict[qc_gene] in line:
-                    gene = line.split("ID=")[1].split(";")[0].split(" ")[0]
-                    if gene not in self.qc_gene_search:
-                        self.qc_gene_search.append(gene)
+                if "product=" not in line or "ID=" not in line:
+                    continue
+                for qc_gene, product in searchdict.items():
+                    if product in line:
+                        gene = line.split("ID=")[1].split(";")[0].split(" ")[0]
+                        if gene not in index[qc_gene]:
+                            index[qc_gene].append(gene)
+        return [filepath, index]
+
+    def build_qc_index(self, gff_files):
+        """ QC gene loci of each gff file, cached per genome in
+        config/qc_gene_index.json while the gff file is unchanged """
+        indexfile = os.path.join(self.config_dir, "qc_gene_index.json")
+        index = {}
+        if os.path.isfile(indexfile):
+            try:
+                with open(indexfile) as f:
+                    index = json.load(f)
+            except ValueError:
+                index = {}
+        search_key = json.dumps(self.searchdict, sort_keys=True)
+        stale = []
+        for file_name in gff_files:
+            filepath = os.path.join(self.gff_dir, file_name)
+            stat = os.stat(filepath)
+            entry = index.get(file_name)
+            if entry is None or entry["key"] != [
+                    stat.st_size, stat.st_mtime, search_key]:
+                stale.append(filepath)
+        if len(stale) > 0:
+            if len(stale) == 1:
+                results = [self.index_gff(stale[0], self.searchdict)]
+            else:
+                results = G.run_parallel(
+                    QualityControl.index_gff, stale, self.searchdict,
+                    verbosity="")
+            for filepath, genes in results:
+                stat = os.stat(filepath)
+                index.update({os.path.basename(filepath): {
+                    "key": [stat.st_size, stat.st_mtime, search_key],
+                    "genes": genes}})
+            G.create_directory(self.config_dir)
+            tmp_file = indexfile + ".tmp"
+            with open(tmp_file, "w") as f:
+                json.dump(index, f)
+            os.replace(tmp_file, indexfile)
+        for file_name in gff_files:
+            self.qc_index.update({file_name: index[file_name]["genes"]})
+        return self.qc_index
+
+    def search_qc_gene(self, file_name, qc_gene):
+        if file_name not in self.qc_index:
+            self.build_qc_index([file_name])
+        for gene in self.qc_index[file_name][qc_gene]:
+            if gene not in self.qc_gene_found:
+                self.qc_gene_found.add(gene)
+                self.qc_gene_search.append(gene)
 
     def count_contigs(self, gff_list, contiglimit):
         exclude = []
+        fasta_stats = FastaStats(
+            os.path.join(self.config_dir, "fasta_stats.json"))
         for dirs in os.listdir(self.target_dir):
             if dirs not in systemdirs:
                 path = os.path.join(self.target_dir, dirs)
                 if os.path.isdir(path):
                     for files in os.listdir(path):
                         if files.endswith(".fna"):
-                            contigcount = 0
                             filepath = os.path.join(path, files)
                             file = files.split(".fna")[0]
-                            for line in open(filepath).readlines():
-                                if ">" in line:
-                                    contigcount += 1
-                            if contigcount >= contiglimit:
+                            stats = fasta_stats.get(filepath)
+                            if stats["contigs"] >= contiglimit:
                                 exclude.append(file)
+        fasta_stats.save()
 
         if len(exclude) > 0:
             for item in exclude:
@@ -777,56 +2115,23 @@ class QualityControl:
         return gff_list
 
     def identify_duplicates(self, gff_list):
-        duplicate = []
-        duplicate_test = []
-        keep = []
-        remove_older_version = []
-
-        def find_potential_duplicates():
-            for item in gff_list:
-                name = '_'.join(item.split(".gff")[0].split("_")[0:-1])
-                if (("GCA" or "GCF") and "v") in name:
-                    version = name.split("_")[-1].split("v")[1]
-                    common = name.split("v")[0]
-                    if int(version) > 1:
-                        if common not in duplicate:
-                            duplicate.append(common)
-
-        def test_if_duplicate(duplicate):
-            for y in duplicate:
-                del duplicate_test[:]
-                for x in gff_list:
-                    x = "_".join(x.split(".")[0].split("_")[0:-1])
-                    if str(y) in str(x):
-                        if x not in duplicate_test:
-                            duplicate_test.append(x)
-
-                if len(duplicate_test) > 0:
-                    maxi = max(
-                        duplicate_test,
-                        key=lambda item: int(item.split("v")[1])
-                    )
-                    if maxi not in keep:
-                        keep.append(maxi)
-                    duplicate_test.remove(maxi)
-                    for item in duplicate_test:
-                        if item not in remove_older_version:
-                            remove_older_version.append(item)
-
-        find_potential_duplicates()
-        test_if_duplicate(duplicate)
+        names = [
+            "_".join(item.split(".gff")[0].split("_")[0:-1])
+            for item in gff_list]
+        remove_older_version = AccessionIndex(names).older_versions()
 
         if len(remove_older_version) > 0:
-            for item in remove_older_version:
-                for gff_file in gff_list:
-                    if item in gff_file:
-                        if gff_file in gff_list:
-                            gff_list.remove(gff_file)
-                        data = [
-                            gff_file.split(".gff")[0],
-                            "", "", "", "", "Duplicate"]
-                        if data not in self.double:
-                            self.double.append(data)
+            keep = []
+            for gff_file, name in zip(gff_list, names):
+                if name in remove_older_version:
+                    data = [
+                        gff_file.split(".gff")[0],
+                        "", "", "", "", "Duplicate"]
+                    if data not in self.double:
+                        self.double.append(data)
+                else:
+                    keep.append(gff_file)
+            gff_list = keep
 
             info = (
                 "skip " + str(len(self.double)) + " duplicate Genome(s) ")
@@ -838,24 +2143,18 @@ class QualityControl:
     # 12.02.2018 change to generate one QC file
     def check_no_sequence(self, qc_gene, gff):
         ffn_list = []
-        sub_gff = []
-        sub_gene_search = []
-        for file_name in gff:
-            name = "_".join(file_name.split("_")[:-1])
-            sub_gff.append(name)
-        for seq_id in self.qc_gene_search:
-            seq_name = "_".join(seq_id.split("_")[:-1])
-            sub_gene_search.append(seq_name)
-        no_seq_found = set(sub_gff) - set(sub_gene_search)
+        found = set(
+            "_".join(seq_id.split("_")[:-1]) for seq_id in self.qc_gene_search)
+        no_seq_found = [
+            file_name for file_name in gff
+            if "_".join(file_name.split("_")[:-1]) not in found]
 
         if len(no_seq_found) > 0:
-            for item in no_seq_found:
-                for file_name in gff:
-                    if item in file_name:
-                        gff.remove(file_name)
-                        self.no_seq.append([
-                            file_name.split(".gff")[0],
-                            "", "", "", "", "QC gene missing"])
+            for file_name in no_seq_found:
+                gff.remove(file_name)
+                self.no_seq.append([
+                    file_name.split(".gff")[0],
+                    "", "", "", "", "QC gene missing"])
 
             info = (
                 "skip " + str(len(self.no_seq)) + " Genome(s) without "
@@ -874,10 +2173,10 @@ class QualityControl:
         G.logger("> Starting QC with " + qc_gene)
         print("Starting QC with " + qc_gene)
         gff = []
-        qc_dir = os.path.join(self.target_dir, qc_gene + "_QC")
+        qc_dir = os.path.join(self.target_dir, qc_gene + self.qc_suffix)
         G.create_directory(qc_dir)
         # find annotation of gene in gff files and store file name
-        for files in os.listdir(self.gff_dir):
+        for files in self.input_files():
             if files not in gff:
                 gff.append(files)
         info = "found " + str(len(gff)) + " gff files"
@@ -892,6 +2191,16 @@ class QualityControl:
             else:
                 gff_list = self.identify_duplicates(gff)
 
+            names = [
+                "_".join(item.split(".gff")[0].split("_")[0:-1])
+                for item in gff_list]
+            new = set(self.reuse_qc_results(qc_gene, {
+                name: os.path.join(self.gff_dir, item)
+                for name, item in zip(names, gff_list)}))
+            gff_list = [
+                item for name, item in zip(names, gff_list) if name in new]
+
+            self.build_qc_index(gff_list)
             for item in gff_list:
                 self.search_qc_gene(item, qc_gene)
 
@@ -928,35 +2237,95 @@ class QualityControl:
         if a sequence was found more than once """
         G.logger("Run: choose_sequence(" + qc_gene + ")")
         qc_seqs = []
-        qc_dir = os.path.join(self.target_dir, qc_gene + "_QC")
+        qc_dir = os.path.join(self.target_dir, qc_gene + self.qc_suffix)
         with open(os.path.join(qc_dir, qc_gene + "_seq"), "w") as o:
             for file_name in self.ffn_list:
-                recid = []
-                recseq = []
-                for seq_id in self.qc_gene_search:
-                    match = "_".join(seq_id.split("_")[:-1])
-                    if file_name.startswith(match):
-                        file_path = os.path.join(self.ffn_dir, file_name)
-                        for record in SeqIO.parse(file_path, "fasta"):
-                            if seq_id in record.id:
-                                if len(str(record.seq)) != 0:
-                                    if record.id not in recid:
-                                        recid.append(record.id)
-                                    if str(record.seq) not in recseq:
-                                        recseq.append(str(record.seq))
+                seq_ids = [
+                    seq_id for seq_id in self.qc_gene_search
+                    if file_name.startswith(
+                        "_".join(seq_id.split("_")[:-1]))]
+                if len(seq_ids) == 0:
+                    continue
+                index = FastaIndex(os.path.join(self.ffn_dir, file_name))
+                sequences = index.fetch(seq_ids)
+                recseq = {}
+                for seq_id in seq_ids:
+                    seq = sequences.get(seq_id, "")
+                    if len(seq) != 0:
+                        recseq.setdefault(seq, seq_id)
 
                 # get longest sequence and write to file
                 if len(recseq) != 0:
                     q = max(recseq, key=len)
-                    z = dict(zip(tuple(recid), tuple(recseq)))
-                    a = {v: k for k, v in z.items()}
-                    o.write(">" + str(a[q]) + "\n" + str(q) + "\n")
-                    qc_seqs.append([str(a[q]), str(q)])
+                    o.write(">" + recseq[q] + "\n" + q + "\n")
+                    qc_seqs.append([recseq[q], q])
 
         return qc_seqs
 
-    def qc_blast_parser(self, qc_gene):
-        qc_dir = os.path.join(self.target_dir, qc_gene + "_QC")
+    @staticmethod
+    def sequence_hash(seq):
+        return hashlib.sha256(seq.encode()).hexdigest()
+
+    def dedup_qc_seqs(self, qc_seqs):
+        """ {sequence hash: [query, seq]} with one query per distinct
+        sequence, genomes with the same sequence get the BLAST result of
+        this query (self.qc_queries) """
+        unique = {}
+        for query, seq in qc_seqs:
+            seq_hash = self.sequence_hash(seq)
+            if seq_hash in unique:
+                self.qc_queries[unique[seq_hash][0]].append(query)
+            else:
+                unique.update({seq_hash: [query, seq]})
+                self.qc_queries.update({query: [query]})
+        return unique
+
+    def get_db_version(self):
+        qc_db = Blast.find_qc_db(self.config, self.config.qc_gene)
+        if qc_db:
+            return ("qcdb", qc_db[1])
+        return QCCache.get_db_version(self.config)
+
+    def get_qc_cache(self):
+        db_version = self.get_db_version()
+        if db_version is None:
+            return None
+        return QCCache(
+            self.qc_cache_file, self.qc_cache_size, db_version,
+            self.get_excluded_gis(), self.get_taxid_filter())
+
+    def get_taxid_filter(self):
+        """ taxids and exceptions the QC BLAST search runs with, the hits
+        of the target specific taxidlist are only valid for this target """
+        sha = hashlib.sha256()
+        sha.update(",".join(sorted(self.exception)).encode() + b"\0")
+        if self.config.blastdbv5:
+            keyfile = os.path.join(self.config_dir, "taxidlist.key")
+            taxidlist = os.path.join(self.config_dir, "taxidlist.txt")
+            if os.path.isfile(taxidlist) and os.path.isfile(keyfile):
+                with open(keyfile, "rb") as f:
+                    sha.update(b"taxidlist\0" + f.read())
+            else:
+                txidlist = os.path.join(dict_path, "2.txids")
+                if os.path.isfile(txidlist):
+                    sha.update((
+                        "2.txids\0" + str(os.path.getmtime(txidlist))
+                        ).encode())
+        return sha.hexdigest()
+
+    @staticmethod
+    def write_dedup_stat(target_dir, name, total, unique):
+        ratio = round(total / unique, 2) if unique else 0
+        info = (
+            name + " QC BLAST queries: " + str(unique) + " unique of "
+            + str(total) + " sequences (dedup ratio " + str(ratio) + ")")
+        G.logger("> " + info)
+        PipelineStatsCollector(target_dir).write_stat(info)
+
+    def qc_blast_parser(self, qc_gene, blast_records=None):
+        """ blast_records: BLAST records of this QC gene from a combined
+        BLAST search, evaluated before the results files in the QC dir """
+        qc_dir = os.path.join(self.target_dir, qc_gene + self.qc_suffix)
         G.logger("Run: qc_blast_parser(" + qc_gene + ")")
 
         def delete_blastreport(xmlblastresults):
@@ -968,7 +2337,7 @@ class QualityControl:
             os.remove(qc_gene + "_seq")
 
         def parse_blastresults():
-            wrote = []
+            wrote = set()
             exceptions = []
             if not self.exception == []:
                 for item in self.exception:
@@ -977,12 +2346,36 @@ class QualityControl:
             gi_list = []
             excluded_gis = self.get_excluded_gis()
             expected = " ".join(self.target.split("_"))
+
+            def classify(query, gi, db_id, spec):
+                # results of a deduplicated sequence for all genomes
+                for query in self.qc_queries.get(query, [query]):
+                    if query in wrote:
+                        continue
+                    wrote.add(query)
+                    if expected in spec or spec in exceptions:
+                        success = [
+                            query, gi, db_id, spec,
+                            expected, "passed QC"]
+                        self.passed.append(success)
+                    else:
+                        fail = [
+                            query, gi, db_id, spec, expected, "failed QC"]
+                        self.problems.append(fail)
+
+            # top hits of sequences in the QC cache
+            for query, (gi, db_id, spec) in self.cached_hits.items():
+                classify(query, gi, db_id, spec)
             # collect the blast results
             os.chdir(qc_dir)
             blapa = BlastParser(self.config)
             xmlblastresults = blapa.blastresult_files(qc_dir)
-            for filename in xmlblastresults:
-                blast_record_list = blapa.parse_BLASTfile(filename)
+            record_lists = (
+                blapa.parse_BLASTfile(filename)
+                for filename in xmlblastresults)
+            if blast_records:
+                record_lists = itertools.chain([blast_records], record_lists)
+            for blast_record_list in record_lists:
                 for index, blast_record in enumerate(blast_record_list):
                     i = 0
                     alignment = blast_record.alignments[i]
@@ -1005,27 +2398,8 @@ class QualityControl:
                                 if gi not in gi_list:
                                     gi_list.append(gi)
 
-                    if expected in spec:
-                        if query not in wrote:
-                            wrote.append(query)
-                            success = [
-                                query, gi, db_id, spec,
-                                expected, "passed QC"]
-                            self.passed.append(success)
-
-                    elif spec in exceptions:
-                        if query not in wrote:
-                            wrote.append(query)
-                            success = [
-                                query, gi, db_id, spec,
-                                expected, "passed QC"]
-                            self.passed.append(success)
-                    else:
-                        if query not in wrote:
-                            wrote.append(query)
-                            fail = [
-                                query, gi, db_id, spec, expected, "failed QC"]
-                            self.problems.append(fail)
+                    self.qc_hits.update({query: [gi, db_id, spec]})
+                    classify(query, gi, db_id, spec)
 
             if self.config.intermediate is False:
                 delete_blastreport(xmlblastresults)
@@ -1054,6 +2428,18 @@ class QualityControl:
             if len(self.double) > 0:
                 for item in self.double:
                     results.append(item)
+            for item in self.get_preqc_failures(qc_gene):
+                results.append(item)
+            for item in self.qc_history:
+                results.append(item)
+            # rows of the previous report can repeat the preQC failures
+            unique = set()
+            rows = []
+            for item in results:
+                if tuple(item) not in unique:
+                    unique.add(tuple(item))
+                    rows.append(item)
+            results = rows
             # write files
             report = os.path.join(qc_dir, qc_gene + "_QC_report.csv")
             if len(results) > 0:
@@ -1061,6 +2447,7 @@ class QualityControl:
                     "Query", "GI", "DB ID", "Species",
                     "Target species", "QC status"]
                 G.csv_writer(report, results, header)
+                self.save_qc_state(qc_gene)
             else:
                 error_msg = "No Quality Control results found."
                 print(error_msg)
@@ -1075,18 +2462,32 @@ class QualityControl:
     def remove_qc_failures(self, qc_gene):
         G.logger("Run: remove_qc_failures(" + qc_gene + ")")
         print("Run: remove_qc_failures(" + qc_gene + ")")
-        qc_dir = os.path.join(self.target_dir, qc_gene + "_QC")
+        qc_dir = os.path.join(self.target_dir, qc_gene + self.qc_suffix)
         delete = []
+        passed = set()
         with open(os.path.join(qc_dir, qc_gene + "_QC_report.csv"), "r") as f:
             reader = csv.reader(f)
             next(reader, None)
             for row in reader:
+                name = '_'.join(row[0].split("_")[0:-1])
                 if "passed QC" not in row[5]:
-                    name = '_'.join(row[0].split("_")[0:-1])
                     if name not in delete:
                         delete.append(name)
+                else:
+                    passed.add(name)
+
+        passed = [
+            name for name in passed if name not in delete
+            and self.manifest.get_state(name) != "excluded"]
+        if len(passed) > 0:
+            self.manifest.update(passed, "passed")
+        # genomes of earlier runs in the report are already excluded
+        delete = [
+            name for name in delete
+            if self.manifest.get_state(name) != "excluded"]
 
         if len(delete) > 0:
+            self.manifest.update(delete, "excluded", qc_gene)
             G.create_directory(self.ex_dir)
             self.delete_failed_assemblies(delete)
             info = "Quality control removed " + str(len(delete)) + " Genome(s)"
@@ -1123,82 +2524,70 @@ class QualityControl:
                 if file_name in self.ffn_list:
                     self.ffn_list.remove(file_name)
 
-        def delete_files(item, directory):
-            search_str = str(item + "_*")
+        def delete_files(directory):
             for files in os.listdir(directory):
-                if re.search(search_str, files):
-                    x = '_'.join(files.split("_")[0:-1])
-                    if x == item:
-                        filepath = os.path.join(directory, files)
-                        file_format = files.split(".")[1]
-                        from_file = filepath
-                        ff_dir = os.path.join(
-                                self.ex_dir, file_format + "_files")
-                        G.create_directory(ff_dir)
-                        to_file = os.path.join(ff_dir, files)
-                        move_file(from_file, to_file)
-                        info = "remove: " + files
-                        G.logger(info)
-                        remove_from_list(file_format, files)
-                        try:
-                            os.remove(filepath)
-                        except FileNotFoundError:
-                            pass
+                if index.lookup(files):
+                    filepath = os.path.join(directory, files)
+                    file_format = files.split(".")[1]
+                    ff_dir = os.path.join(
+                            self.ex_dir, file_format + "_files")
+                    G.create_directory(ff_dir)
+                    to_file = os.path.join(ff_dir, files)
+                    move_file(filepath, to_file)
+                    info = "remove: " + files
+                    G.logger(info)
+                    remove_from_list(file_format, files)
+                    try:
+                        os.remove(filepath)
+                    except FileNotFoundError:
+                        pass
 
         def remove_directories():
-            for item in delete:
-                search_str = str(item + "_*")
-                for root, dirs, files in os.walk(self.target_dir):
-                    for directory in dirs:
-                        if directory not in systemdirs:
-                            if re.search(search_str, directory):
-                                dir_path = os.path.join(root, directory)
-                                file_names = os.listdir(dir_path)
-                                if len(file_names) == 0:
-                                    info = "Remove empty directory " + dir_path
-                                    G.logger(info)
-                                    os.rmdir(dir_path)
-                                else:
-                                    x = '_'.join(
-                                        file_names[0].split("_")[0:-1])
-                                    if x == item:
-                                        from_dir = os.path.join(
-                                            root, directory)
-                                        to_dir = os.path.join(
-                                            self.ex_dir, directory)
-                                        move_dirs(from_dir, to_dir)
+            for root, dirs, files in os.walk(self.target_dir):
+                for directory in list(dirs):
+                    if directory in systemdirs:
+                        continue
+                    name = index.lookup(directory)
+                    if name is None:
+                        continue
+                    dir_path = os.path.join(root, directory)
+                    file_names = os.listdir(dir_path)
+                    if len(file_names) == 0:
+                        info = "Remove empty directory " + dir_path
+                        G.logger(info)
+                        os.rmdir(dir_path)
+                        dirs.remove(directory)
+                    elif index.lookup(file_names[0]) == name:
+                        to_dir = os.path.join(self.ex_dir, directory)
+                        move_dirs(dir_path, to_dir)
+                        dirs.remove(directory)
 
         def remove_files():
-            for item in delete:
-                search_str = str(item + "_*")
-                if (("GCF" or "GCA") and "v") in item:
-                    accession = ".".join(item.split("v"))
-                    search_str = str(accession + "_*")
-                # genomic_fna
-                genome_dir = os.path.join(self.target_dir, "genomic_fna")
-                if os.path.isdir(genome_dir):
-                    for files in os.listdir(genome_dir):
-                        if re.search(search_str, files):
-                            G.create_directory(
-                                os.path.join(self.ex_dir, "genomic_fna"))
-                            from_file = os.path.join(genome_dir, files)
-                            to_file = os.path.join(
-                                self.ex_dir, "genomic_fna", files)
-                            move_file(from_file, to_file)
-
-                    delete_files(item, self.ffn_dir)
-                    delete_files(item, self.gff_dir)
-                    delete_files(item, self.fna_dir)
-
-                # clean the remaining directories
-                for root, dirs, files in os.walk(self.target_dir):
-                    for file_name in files:
-                        if re.search(search_str, file_name):
-                            x = '_'.join(file_name.split("_")[0:-1])
-                            if x == item:
-                                info = "remove" + str(file_name)
-                                G.logger(info)
-                                os.remove(os.path.join(root, file_name))
+            # genomic_fna
+            genome_dir = os.path.join(self.target_dir, "genomic_fna")
+            if os.path.isdir(genome_dir):
+                for files in os.listdir(genome_dir):
+                    if index.lookup(files):
+                        G.create_directory(
+                            os.path.join(self.ex_dir, "genomic_fna"))
+                        from_file = os.path.join(genome_dir, files)
+                        to_file = os.path.join(
+                            self.ex_dir, "genomic_fna", files)
+                        move_file(from_file, to_file)
+
+            for directory in [self.ffn_dir, self.gff_dir, self.fna_dir]:
+                if os.path.isdir(directory):
+                    delete_files(directory)
+
+            # clean the remaining directories
+            for root, dirs, files in os.walk(self.target_dir):
+                for file_name in files:
+                    if index.lookup(file_name):
+                        info = "remove" + str(file_name)
+                        G.logger(info)
+                        os.remove(os.path.join(root, file_name))
+
+        index = AccessionIndex(delete)
         remove_directories()
         remove_files()
 
@@ -1231,10 +2620,11 @@ class QualityControl:
         return 0
 
 
-    def quality_control(self, qc_gene):
-        pan = os.path.join(self.pangenome_dir, "gene_presence_absence.csv")
-        qc_dir = os.path.join(self.target_dir, qc_gene + "_QC")
-        if os.path.isfile(pan):
+    def quality_control(self, qc_gene, blast_records=None):
+        """ blast_records: {sequence hash: BLAST record} of a combined BLAST
+        search, only sequences without a record are searched again """
+        qc_dir = os.path.join(self.target_dir, qc_gene + self.qc_suffix)
+        if PangenomeAnalysis.keep_existing(self.config):
             info = "Found Pangenome directory, skip QC " + qc_gene
             G.logger("> " + info)
             print(info)
@@ -1244,7 +2634,41 @@ class QualityControl:
         G.logger("Run: quality_control(" + qc_gene + ")")
 
         if self.get_qc_seqs(qc_gene) == 0:
+            self.clear_blastfiles(qc_dir)
             qc_seqs = self.choose_sequence(qc_gene)
+            unique = self.dedup_qc_seqs(qc_seqs)
+            if len(qc_seqs) > 0:
+                self.write_dedup_stat(
+                    self.target_dir, qc_gene, len(qc_seqs), len(unique))
+            cache = self.get_qc_cache()
+            hashes = {}
+            if cache:
+                keys = {
+                    seq_hash: cache.get_key(qc_gene, seq_hash)
+                    for seq_hash in unique}
+                cached = cache.get(keys.values())
+                for seq_hash, (query, seq) in list(unique.items()):
+                    if keys[seq_hash] in cached:
+                        self.cached_hits.update({
+                            query: cached[keys[seq_hash]]})
+                        unique.pop(seq_hash)
+                if len(self.cached_hits) > 0:
+                    G.logger(
+                        "> " + qc_gene + " QC: " + str(len(self.cached_hits))
+                        + " sequences found in the QC cache")
+            records = []
+            if blast_records is not None:
+                for seq_hash, (query, seq) in list(unique.items()):
+                    if seq_hash in blast_records:
+                        record = blast_records[seq_hash]
+                        records.append(record)
+                        self.qc_queries.update(
+                            {record.query: self.qc_queries.pop(query)})
+                        hashes.update({record.query: seq_hash})
+                        unique.pop(seq_hash)
+            for seq_hash, (query, seq) in unique.items():
+                hashes.update({query: seq_hash})
+            qc_seqs = list(unique.values())
             if len(qc_seqs) > 0:
                 use_cores, inputseqs = BlastPrep(
                         qc_dir, qc_seqs, qc_gene,
@@ -1253,28 +2677,570 @@ class QualityControl:
                     self.config, qc_dir, "quality_control"
                 ).run_blast(qc_gene, use_cores)
 
-            passed_list = self.qc_blast_parser(qc_gene)
+            passed_list = self.qc_blast_parser(qc_gene, records)
+            if cache:
+                cache.store([
+                    [keys[hashes[query]]] + hit
+                    for query, hit in self.qc_hits.items()
+                    if query in hashes])
+                cache.close()
             exitcode = self.check_passed_list(passed_list, qc_gene)
         else:
             exitcode = 1
         return exitcode
 
 
+class PreAnnotationQC(QualityControl):
+    """ QC of the raw assemblies before the annotation. The QC genes are
+    located in the genomic fna files with the reference sequences in
+    dictionaries/qc_references.fas (><qc_gene>_<n> ...), genomes that fail
+    QC are excluded before Prokka runs """
+    qc_suffix = "_preQC"
+    blast_fields = "qseqid sseqid qstart qend sstart send qlen bitscore"
+
+    def __init__(self, configuration):
+        QualityControl.__init__(self, configuration)
+        self.genomic_dir = os.path.join(self.target_dir, "genomic_fna")
+        self.hits_dir = os.path.join(self.config_dir, "preqc_hits")
+        self.references = os.path.join(dict_path, "qc_references.fas")
+        self.genomes = {}
+        self.qc_loci = {}
+
+    def input_files(self):
+        genomic_files = []
+        if os.path.isdir(self.genomic_dir):
+            for file_name in os.listdir(self.genomic_dir):
+                # incomplete downloads end with .part
+                if not file_name.endswith(".fna"):
+                    continue
+                name = GenomeManifest.genome_name(file_name)
+                if self.manifest.get_state(name) != "excluded":
+                    genomic_files.append(file_name)
+        return sorted(genomic_files)
+
+    def get_preqc_failures(self, qc_gene):
+        return []
+
+    @staticmethod
+    def locate_qc_genes(files, references):
+        """ tabular dc-megablast results of the QC gene references against
+        one genome """
+        filepath, outfile = files
+        blast_cmd = [
+            "blastn", "-task", "dc-megablast", "-query", references,
+            "-subject", filepath, "-evalue", "1e-10",
+            "-outfmt", "6 " + PreAnnotationQC.blast_fields,
+            "-out", outfile + ".tmp"]
+        G.run_subprocess(blast_cmd, False, False, False)
+        if os.path.isfile(outfile + ".tmp"):
+            os.replace(outfile + ".tmp", outfile)
+        return outfile
+
+    @staticmethod
+    def best_hits(outfile):
+        """ {qc_gene: [contig, qstart, qend, sstart, send, qlen]} of the hit
+        with the highest bitscore of each QC gene """
+        best = {}
+        with open(outfile, "r") as f:
+            for line in f:
+                row = line.strip().split("\t")
+                if len(row) < 8:
+                    continue
+                qc_gene = "_".join(row[0].split("_")[0:-1])
+                bitscore = float(row[7])
+                if qc_gene not in best or bitscore > best[qc_gene][0]:
+                    best.update({qc_gene: [
+                        bitscore, row[1].split(" ")[0]]
+                        + [int(x) for x in row[2:7]]})
+        return {qc_gene: hit[1:] for qc_gene, hit in best.items()}
+
+    @staticmethod
+    def extract_region(contig, hit):
+        """ QC gene sequence of a hit, the alignment is extended to the
+        length of the reference and clipped at the contig ends """
+        qstart, qend, sstart, send, qlen = hit
+        if sstart <= send:
+            start = sstart - (qstart - 1)
+            end = send + (qlen - qend)
+        else:
+            start = send - (qlen - qend)
+            end = sstart + (qstart - 1)
+        seq = contig[max(start, 1) - 1:min(end, len(contig))]
+        if sstart > send:
+            seq = str(Seq(seq).reverse_complement())
+        return seq
+
+    def search_genomes(self, genomic_files):
+        """ (cached) search of all QC genes in the genomes, the results of a
+        genome are reused while the genome and the references are unchanged
+        """
+        G.create_directory(self.hits_dir)
+        jobs = []
+        results = {}
+        for file_name in genomic_files:
+            filepath = os.path.join(self.genomic_dir, file_name)
+            outfile = os.path.join(self.hits_dir, file_name + ".tsv")
+            results.update({file_name: outfile})
+            if not os.path.isfile(outfile) or os.path.getmtime(
+                    outfile) < max(
+                        os.path.getmtime(filepath),
+                        os.path.getmtime(self.references)):
+                jobs.append([filepath, outfile])
+        if len(jobs) > 0:
+            info = "search QC genes in " + str(len(jobs)) + " genome(s)"
+            G.logger("> " + info)
+            print(info)
+            G.run_parallel(
+                PreAnnotationQC.locate_qc_genes, jobs, self.references,
+                verbosity="")
+        return results
+
+    def get_qc_seqs(self, qc_gene):
+        G.logger("Run: get_qc_seqs(" + qc_gene + ")")
+        G.logger("> Starting QC before annotation with " + qc_gene)
+        print("Starting QC before annotation with " + qc_gene)
+        qc_dir = os.path.join(self.target_dir, qc_gene + self.qc_suffix)
+        G.create_directory(qc_dir)
+        genomic_files = self.input_files()
+        info = "found " + str(len(genomic_files)) + " genomic fna files"
+        G.logger(info)
+        print(info)
+        if len(genomic_files) == 0:
+            error_msg = (
+                "Error: No .fna files found for QualityControl " + qc_gene)
+            print(error_msg)
+            G.logger("> " + error_msg)
+            errors.append([self.target, error_msg])
+            return 1
+
+        names = [
+            GenomeManifest.genome_name(file_name)
+            for file_name in genomic_files]
+        older_versions = AccessionIndex(names).older_versions()
+        candidates = {}
+        for file_name, name in zip(genomic_files, names):
+            if name in older_versions:
+                self.double.append(
+                    [name + "_" + qc_gene, "", "", "", "", "Duplicate"])
+            else:
+                candidates.update({name: file_name})
+        new = self.reuse_qc_results(qc_gene, {
+            name: os.path.join(self.genomic_dir, file_name)
+            for name, file_name in candidates.items()})
+        hit_files = self.search_genomes([candidates[name] for name in new])
+        for name in new:
+            file_name = candidates[name]
+            hit = None
+            if os.path.isfile(hit_files[file_name]):
+                hit = self.best_hits(hit_files[file_name]).get(qc_gene)
+            if hit:
+                self.genomes.update({name: file_name})
+                self.qc_loci.update({name: hit})
+            else:
+                self.no_seq.append(
+                    [name + "_" + qc_gene, "", "", "", "", "QC gene missing"])
+
+        for data, reason in [
+                [self.double, "duplicate Genome(s)"],
+                [self.no_seq, "Genome(s) without " + qc_gene + " sequence"]]:
+            if len(data) > 0:
+                info = "skip " + str(len(data)) + " " + reason
+                print(info)
+                G.logger("> " + info)
+        info = (
+            "found " + str(len(self.qc_loci)) + " " + qc_gene
+            + " sequences in genomic fna files")
+        G.logger(info)
+        print(info)
+        return 0
+
+    def choose_sequence(self, qc_gene):
+        """ QC gene sequences cut out of the contigs of the genomes """
+        G.logger("Run: choose_sequence(" + qc_gene + ")")
+        qc_seqs = []
+        qc_dir = os.path.join(self.target_dir, qc_gene + self.qc_suffix)
+        with open(os.path.join(qc_dir, qc_gene + "_seq"), "w") as o:
+            for name in sorted(self.qc_loci):
+                file_name = self.genomes[name]
+                contig_id, qstart, qend, sstart, send, qlen = self.qc_loci[
+                    name]
+                filepath = os.path.join(self.genomic_dir, file_name)
+                try:
+                    # the .fai must not be written to the genomic_fna dir
+                    index = FastaIndex(
+                        filepath,
+                        fai=os.path.join(self.hits_dir, file_name + ".fai"))
+                    contig = index.fetch([contig_id]).get(contig_id, "")
+                except ValueError:
+                    contig = ""
+                    for record in SeqIO.parse(filepath, "fasta"):
+                        if record.id == contig_id:
+                            contig = str(record.seq)
+                            break
+                seq = self.extract_region(
+                    contig, [qstart, qend, sstart, send, qlen])
+                if len(seq) != 0:
+                    query = name + "_" + qc_gene
+                    o.write(">" + query + "\n" + seq + "\n")
+                    qc_seqs.append([query, seq])
+
+        return qc_seqs
+
+
+class CombinedQualityControl:
+    """ QC with several QC genes and a single BLAST search for the selected
+    sequences of all genes. The genes are still evaluated one after another,
+    the BLAST records are split into the usual per gene QC reports """
+    def __init__(self, configuration, qc_class=QualityControl):
+        """ qc_class: QualityControl or PreAnnotationQC """
+        self.config = configuration
+        self.qc_class = qc_class
+        self.target = configuration.target
+        self.target_dir = os.path.join(self.config.path, self.target)
+        self.pangenome_dir = os.path.join(self.target_dir, "Pangenome")
+        self.qc_dir = os.path.join(
+            self.target_dir, "combined" + qc_class.qc_suffix)
+
+    def collect_qc_seqs(self, qc_genes):
+        """ {sequence hash: [query, seq]} of the QC sequences of all genes
+        that are not in the QC cache and the total number of sequences """
+        queries = {}
+        cache_keys = {}
+        count = 0
+        QC = self.qc_class(self.config)
+        cache = QC.get_qc_cache()
+        for qc_gene in qc_genes:
+            QC = self.qc_class(self.config)
+            if QC.get_qc_seqs(qc_gene) == 0:
+                for query, seq in QC.choose_sequence(qc_gene):
+                    count += 1
+                    seq_hash = QualityControl.sequence_hash(seq)
+                    queries.setdefault(seq_hash, [query, seq])
+                    if cache:
+                        cache_keys.update({
+                            cache.get_key(qc_gene, seq_hash): seq_hash})
+        if cache:
+            for key in cache.get(cache_keys.keys()):
+                queries.pop(cache_keys[key], None)
+            cache.close()
+        return queries, count
+
+    def get_blast_records(self, queries):
+        G.create_directory(self.qc_dir)
+        QualityControl.clear_blastfiles(self.qc_dir)
+        hashes = {query: seq_hash for seq_hash, (query, seq) in queries.items()}
+        use_cores, inputseqs = BlastPrep(
+            self.qc_dir, list(queries.values()), "combined",
+            self.config.blastseqs).run_blastprep()
+        Blast(
+            self.config, self.qc_dir, "quality_control"
+        ).run_blast("combined", use_cores)
+        blast_records = {}
+        blapa = BlastParser(self.config)
+        for filename in blapa.blastresult_files(self.qc_dir):
+            for blast_record in blapa.parse_BLASTfile(filename):
+                if blast_record.query in hashes:
+                    blast_records.setdefault(
+                        hashes[blast_record.query], blast_record)
+        if self.config.intermediate is False:
+            QualityControl.clear_blastfiles(self.qc_dir)
+        return blast_records
+
+    def quality_control(self, qc_genes):
+        if PangenomeAnalysis.keep_existing(self.config) or len(
+                qc_genes) < 2 or len(
+                self.qc_class(self.config).input_files()) == 0:
+            return [
+                self.qc_class(self.config).quality_control(qc_gene)
+                for qc_gene in qc_genes]
+
+        info = "Run: combined quality_control(" + ", ".join(qc_genes) + ")"
+        print("\n" + info)
+        G.logger(info)
+        queries, count = self.collect_qc_seqs(qc_genes)
+        blast_records = {}
+        if len(queries) > 0:
+            QualityControl.write_dedup_stat(
+                self.target_dir, "combined", count, len(queries))
+            blast_records = self.get_blast_records(queries)
+        # genomes removed by a QC gene are excluded before the next gene
+        return [
+            self.qc_class(self.config).quality_control(
+                qc_gene, blast_records)
+            for qc_gene in qc_genes]
+
+
+class GenomeDereplication:
+    """ MinHash sketches (bottom-s sketches of canonical k-mers as in Mash)
+    of the genomes that passed QC, genomes closer than config.dereplicate
+    (Mash distance) to a representative are not used for the pan-genome
+    analysis. The dropped genomes stay in the target directory for the
+    primer quality control """
+    def __init__(self, configuration):
+        self.config = configuration
+        self.target = configuration.target
+        self.target_dir = os.path.join(self.config.path, self.target)
+        self.config_dir = os.path.join(self.target_dir, "config")
+        self.gff_dir = os.path.join(self.target_dir, "gff_files")
+        self.fna_dir = os.path.join(self.target_dir, "fna_files")
+        self.kmer_size = 21
+        self.sketch_size = 1000
+        self.sketch_dir = os.path.join(
+            self.config_dir, "minhash_k" + str(self.kmer_size) + "_s"
+            + str(self.sketch_size))
+        # gff files of the pan-genome analysis
+        self.selection_file = os.path.join(
+            self.config_dir, "pangenome_genomes.txt")
+        self.report = os.path.join(self.config_dir, "dereplication.csv")
+
+    @staticmethod
+    def hash64(values):
+        # splitmix64 finalizer, uint64 arithmetic wraps around
+        values = values ^ (values >> np.uint64(30))
+        values = values * np.uint64(0xbf58476d1ce4e5b9)
+        values = values ^ (values >> np.uint64(27))
+        values = values * np.uint64(0x94d049bb133111eb)
+        return values ^ (values >> np.uint64(31))
+
+    @staticmethod
+    def kmer_hashes(seq, kmer_size):
+        """ hashes of the canonical k-mers of a sequence (bytes), k-mers
+        with other characters than ACGT are skipped """
+        lookup = np.full(256, 4, dtype=np.uint8)
+        for code, bases in enumerate([b"Aa", b"Cc", b"Gg", b"Tt"]):
+            for base in bases:
+                lookup[base] = code
+        bases = lookup[np.frombuffer(seq, dtype=np.uint8)]
+        count = len(bases) - kmer_size + 1
+        if count <= 0:
+            return np.zeros(0, dtype=np.uint64)
+        invalid = np.concatenate(([0], np.cumsum(bases == 4)))
+        valid = (invalid[kmer_size:] - invalid[:-kmer_size]) == 0
+        bases = np.where(bases == 4, 0, bases).astype(np.uint64)
+        forward = np.zeros(count, dtype=np.uint64)
+        reverse = np.zeros(count, dtype=np.uint64)
+        for i in range(kmer_size):
+            window = bases[i:i + count]
+            forward = (forward << np.uint64(2)) | window
+            reverse = reverse | (
+                (np.uint64(3) - window) << np.uint64(2 * i))
+        canonical = np.minimum(forward, reverse)[valid]
+        return GenomeDereplication.hash64(canonical)
+
+    @staticmethod
+    def sketch_genome(files, settings):
+        """ bottom-s sketch of a genome fasta file saved as .npy """
+        filepath, outfile = files
+        kmer_size, sketch_size = settings
+        sketch = np.zeros(0, dtype=np.uint64)
+        for record in SeqIO.parse(filepath, "fasta"):
+            hashes = GenomeDereplication.kmer_hashes(
+                bytes(record.seq), kmer_size)
+            sketch = np.union1d(sketch, np.unique(hashes)[:sketch_size])
+            sketch = sketch[:sketch_size]
+        np.save(outfile + ".tmp.npy", sketch)
+        os.replace(outfile + ".tmp.npy", outfile)
+        return outfile
+
+    def get_sketches(self, names):
+        """ {name: sketch} of the fna files, sketches are reused while the
+        fna file is unchanged """
+        G.create_directory(self.sketch_dir)
+        jobs = []
+        sketch_files = {}
+        for name in names:
+            filepath = os.path.join(self.fna_dir, name + ".fna")
+            outfile = os.path.join(self.sketch_dir, name + ".npy")
+            sketch_files.update({name: outfile})
+            if not os.path.isfile(outfile) or os.path.getmtime(
+                    outfile) < os.path.getmtime(filepath):
+                jobs.append([filepath, outfile])
+        if len(jobs) > 0:
+            info = "compute MinHash sketches of " + str(len(jobs)) + " genomes"
+            G.logger("> " + info)
+            print(info)
+            G.run_parallel(
+                GenomeDereplication.sketch_genome, jobs,
+                [self.kmer_size, self.sketch_size], verbosity="")
+        return {
+            name: np.load(sketch_files[name]) for name in names}
+
+    @staticmethod
+    def mash_distance(sketch_a, sketch_b, kmer_size, sketch_size):
+        union = np.union1d(sketch_a, sketch_b)[:sketch_size]
+        if len(union) == 0:
+            return 1.0
+        shared = np.intersect1d(
+            np.intersect1d(sketch_a, sketch_b, assume_unique=True), union,
+            assume_unique=True)
+        jaccard = len(shared) / len(union)
+        if jaccard == 0:
+            return 1.0
+        return -math.log(2 * jaccard / (1 + jaccard)) / kmer_size
+
+    def distance_matrix(self, names, sketches):
+        distances = np.zeros((len(names), len(names)))
+        for i in range(len(names)):
+            for j in range(i + 1, len(names)):
+                distance = self.mash_distance(
+                    sketches[names[i]], sketches[names[j]], self.kmer_size,
+                    self.sketch_size)
+                distances[i, j] = distance
+                distances[j, i] = distance
+        return distances
+
+    @staticmethod
+    def cluster(names, distances, threshold):
+        """ {name: representative}, genomes in the given order (best first)
+        become the representative of all unassigned genomes within the
+        threshold """
+        representatives = {}
+        for i, name in enumerate(names):
+            if name in representatives:
+                continue
+            representatives.update({name: name})
+            for j in np.nonzero(distances[i] <= threshold)[0]:
+                representatives.setdefault(names[j], name)
+        return representatives
+
+    def order_genomes(self, names):
+        # assemblies with fewer contigs and larger N50 first
+        fasta_stats = FastaStats(
+            os.path.join(self.config_dir, "fasta_stats.json"))
+        stats = {
+            name: fasta_stats.get(os.path.join(self.fna_dir, name + ".fna"))
+            for name in names}
+        fasta_stats.save()
+        return sorted(names, key=lambda x: (
+            stats[x]["contigs"], -stats[x]["n50"], x))
+
+    def selected_genomes(self):
+        """ gff files selected for the pan-genome analysis, None without
+        dereplication """
+        if self.config.dereplicate <= 0 or not os.path.isfile(
+                self.selection_file):
+            return None
+        with open(self.selection_file, "r") as f:
+            return [line.strip() for line in f if line.strip()]
+
+    def run_dereplication(self):
+        if PangenomeAnalysis.keep_existing(self.config):
+            return 0
+        if os.path.isfile(self.selection_file):
+            os.remove(self.selection_file)
+        if self.config.dereplicate <= 0:
+            return 0
+        G.logger("Run: run_dereplication(" + self.target + ")")
+        gff_files = sorted(
+            files for files in os.listdir(self.gff_dir)
+            if files.endswith(".gff"))
+        names = [
+            files.split(".gff")[0] for files in gff_files
+            if os.path.isfile(os.path.join(
+                self.fna_dir, files.split(".gff")[0] + ".fna"))]
+        if len(names) < 2:
+            return 0
+        names = self.order_genomes(names)
+        index = {name: i for i, name in enumerate(names)}
+        sketches = self.get_sketches(names)
+        distances = self.distance_matrix(names, sketches)
+        representatives = self.cluster(
+            names, distances, self.config.dereplicate)
+        selected = set(representatives.values())
+        # further genomes up to max_genomes, most distant genomes first
+        others = sorted(
+            [name for name in names if name not in selected],
+            key=lambda x: -distances[index[x], index[representatives[x]]])
+        extra = max(self.config.max_genomes - len(selected), 0)
+        selected.update(others[0:extra])
+        dropped = [name for name in names if name not in selected]
+
+        report = []
+        for name in names:
+            representative = representatives[name]
+            distance = distances[index[name], index[representative]]
+            if name == representative:
+                status = "representative"
+            elif name in selected:
+                status = "selected"
+            else:
+                status = "dropped"
+            report.append([name, representative, round(distance, 6), status])
+        G.csv_writer(
+            self.report, report,
+            ["Genome", "Representative", "Mash distance", "Status"])
+        with open(self.selection_file, "w") as f:
+            for files in gff_files:
+                if files.split(".gff")[0] not in dropped:
+                    f.write(files + "\n")
+
+        info = (
+            "dereplication: " + str(len(set(representatives.values())))
+            + " clusters of " + str(len(names)) + " genomes (distance "
+            + str(self.config.dereplicate) + "), " + str(len(gff_files)
+            - len(dropped)) + " genomes for the pan-genome analysis")
+        G.logger("> " + info)
+        print(info)
+        PipelineStatsCollector(self.target_dir).write_stat(info)
+        if len(dropped) > 0:
+            G.logger("Genomes not used for the pan-genome analysis:")
+            G.logger(dropped)
+        return 0
+
+
 class PangenomeAnalysis:
     def __init__(self, configuration):
         self.config = configuration
         self.target = configuration.target
         self.target_dir = os.path.join(self.config.path, self.target)
         self.gff_dir = os.path.join(self.target_dir, "gff_files")
+        self.ffn_dir = os.path.join(self.target_dir, "ffn_files")
         self.pangenome_dir = os.path.join(self.target_dir, "Pangenome")
+        self.pangenome_file = os.path.join(
+            self.pangenome_dir, "gene_presence_absence.csv")
+        self.reference_file = os.path.join(
+            self.pangenome_dir, "pan_genome_reference.fa")
+        self.update_dir = os.path.join(self.pangenome_dir, "update")
+        # genes are added to a cluster with the blastp identity of Roary
+        # (-i 95) and an alignment over min_coverage of the longer protein
+        self.min_identity = 95.0
+        self.min_coverage = 0.8
+        # files of the pipeline that are derived from the pan-genome
+        self.derived_files = [
+            "results", "allcoregenes", "multiannotated",
+            "singlecopy_genes.csv", "ffn_sequences.csv"]
+
+    @staticmethod
+    def keep_existing(configuration):
+        """ True if a pan-genome exists and is used without changes, data
+        collection and QC are skipped """
+        pan = os.path.join(
+            configuration.path, configuration.target, "Pangenome",
+            "gene_presence_absence.csv")
+        return os.path.isfile(pan) and configuration.pangenome == "keep"
+
+    def get_input_files(self):
+        """ gff files of the pan-genome, the genomes selected by
+        GenomeDereplication or all files in gff_files """
+        gff_files = sorted(
+            files for files in os.listdir(self.gff_dir)
+            if files.endswith(".gff"))
+        selected = GenomeDereplication(self.config).selected_genomes()
+        if selected is None:
+            return gff_files
+        return [files for files in gff_files if files in selected]
 
     def run_roary(self):
-        num_cpus = str(multiprocessing.cpu_count())
+        num_cpus = str(G.cpu_count())
         G.logger("Run: run_roary(" + self.target + ")")
         os.chdir(self.target_dir)
         roary_cmd = [
             "roary", "-f", "./Pangenome", "-s", "-p", num_cpus,
             "-cd", "100", "-e", "-n", "./gff_files/*.gff"]
+        if GenomeDereplication(self.config).selected_genomes() is not None:
+            roary_cmd.remove("./gff_files/*.gff")
+            roary_cmd.extend(
+                "./gff_files/" + files for files in self.get_input_files())
         if self.config.skip_tree:
             if "-e" in roary_cmd:
                 roary_cmd.remove("-e")
@@ -1315,13 +3281,23 @@ class PangenomeAnalysis:
         if os.path.isdir(self.pangenome_dir):
             filepath = os.path.join(
                 self.pangenome_dir, "gene_presence_absence.csv")
-            if os.path.isfile(filepath):
+            if os.path.isfile(filepath) and self.config.pangenome == "keep":
                 info = (
                     "Pangenome directory already exists\n"
                     "Continue with existing Pangenome data")
                 print(info)
                 G.logger("> " + info)
                 exitstat = 2
+            elif (
+                    os.path.isfile(filepath)
+                    and self.config.pangenome == "incremental"):
+                exitstat = self.update_pangenome()
+                if exitstat == 1:
+                    # no reference sequences to add genes to the clusters
+                    shutil.rmtree(self.pangenome_dir)
+                    self.run_roary()
+                    self.run_fasttree()
+                    exitstat = 0
             else:
                 shutil.rmtree(self.pangenome_dir)
                 self.run_roary()
@@ -1331,6 +3307,391 @@ class PangenomeAnalysis:
             self.run_fasttree()
         return exitstat
 
+    @staticmethod
+    def translate(seq):
+        seq = seq[0:len(seq) // 3 * 3]
+        protein = str(Seq(seq).translate(table=11)).rstrip("*")
+        return protein.replace("*", "X")
+
+    @staticmethod
+    def read_cds(gff_file):
+        """ [[locus, product]] of the CDS in a gff file, the IDs are the
+        loci in gene_presence_absence.csv """
+        cds = []
+        with open(gff_file, "r") as f:
+            for line in f:
+                if line.startswith("##FASTA"):
+                    break
+                row = line.rstrip("\n").split("\t")
+                if len(row) != 9 or row[2] != "CDS":
+                    continue
+                attributes = {}
+                for item in row[8].split(";"):
+                    if "=" in item:
+                        key, value = item.split("=", 1)
+                        attributes.update({key: urllib.parse.unquote(value)})
+                if "ID" in attributes:
+                    cds.append([
+                        attributes["ID"], attributes.get("product", "")])
+        return cds
+
+    def read_pangenome(self):
+        with open(self.pangenome_file, "r") as f:
+            reader = csv.reader(f)
+            header = next(reader)
+            rows = [row for row in reader if len(row) == len(header)]
+        return header, rows
+
+    def protein_hits(self, query, subject):
+        """ {query: [[subject, bitscore]]} of the blastp hits that meet the
+        cluster thresholds, best hits first """
+        db = os.path.join(self.update_dir, os.path.basename(subject))
+        G.run_subprocess([
+            "makeblastdb", "-in", subject, "-dbtype", "prot", "-out", db],
+            False, True, False)
+        outfile = query + ".tsv"
+        G.run_subprocess([
+            "blastp", "-query", query, "-db", db, "-evalue", "1e-10",
+            "-max_target_seqs", "10", "-num_threads", str(G.cpu_count()),
+            "-outfmt", "6 qseqid sseqid pident length qlen slen bitscore",
+            "-out", outfile], False, True, False)
+        hits = {}
+        if os.path.isfile(outfile):
+            with open(outfile, "r") as f:
+                for line in f:
+                    row = line.strip().split("\t")
+                    if len(row) != 7:
+                        continue
+                    qseqid, sseqid = row[0], row[1]
+                    pident, length = float(row[2]), int(row[3])
+                    qlen, slen = int(row[4]), int(row[5])
+                    if pident < self.min_identity or length < (
+                            self.min_coverage * max(qlen, slen)):
+                        continue
+                    hits.setdefault(qseqid, []).append(
+                        [sseqid, float(row[6])])
+        for query_id in hits:
+            hits[query_id].sort(key=lambda x: -x[1])
+        return hits
+
+    def cluster_new_genes(self, proteins):
+        """ {locus: cluster} of genes without a hit in the pan-genome, the
+        longest unassigned gene is the representative of a new cluster """
+        query = os.path.join(self.update_dir, "unmatched.faa")
+        with open(query, "w") as f:
+            for locus, protein in proteins.items():
+                f.write(">" + locus + "\n" + protein + "\n")
+        hits = self.protein_hits(query, query)
+        representatives = {}
+        for locus in sorted(proteins, key=lambda x: -len(proteins[x])):
+            if locus in representatives:
+                continue
+            representatives.update({locus: locus})
+            for subject, bitscore in hits.get(locus, []):
+                representatives.setdefault(subject, locus)
+        return representatives
+
+    def assign_genes(self, loci, clusters, proteins):
+        """ {locus: cluster name} of the genes of the new genomes and the
+        representative loci of new clusters {cluster name: locus} """
+        reference = os.path.join(self.update_dir, "reference.faa")
+        references = {}
+        with open(reference, "w") as f:
+            for record in SeqIO.parse(self.reference_file, "fasta"):
+                # >locus cluster name
+                name = loci.get(record.id)
+                if name is None and len(record.description.split()) > 1:
+                    name = record.description.split()[1]
+                if name not in clusters:
+                    continue
+                references.update({record.id: name})
+                f.write(
+                    ">" + record.id + "\n"
+                    + self.translate(str(record.seq)) + "\n")
+        query = os.path.join(self.update_dir, "new_genes.faa")
+        with open(query, "w") as f:
+            for locus, protein in proteins.items():
+                f.write(">" + locus + "\n" + protein + "\n")
+        assigned = {}
+        for locus, hits in self.protein_hits(query, reference).items():
+            assigned.update({locus: references[hits[0][0]]})
+        unmatched = {
+            locus: protein for locus, protein in proteins.items()
+            if locus not in assigned}
+        new_clusters = {}
+        if len(unmatched) > 0:
+            groups = [
+                int(name.split("_")[1]) for name in clusters
+                if re.match(r"^group_[0-9]+$", name)]
+            number = max(groups) if len(groups) > 0 else 0
+            representatives = self.cluster_new_genes(unmatched)
+            names = {}
+            for locus in sorted(
+                    unmatched, key=lambda x: -len(unmatched[x])):
+                representative = representatives[locus]
+                if representative not in names:
+                    number += 1
+                    names.update({representative: "group_" + str(number)})
+                    new_clusters.update(
+                        {"group_" + str(number): representative})
+                assigned.update({locus: names[representative]})
+        return assigned, new_clusters
+
+    @staticmethod
+    def format_average(value):
+        # 1 or 1.05 as in the Roary output
+        value = round(value, 2)
+        if value == int(value):
+            return str(int(value))
+        return str(value)
+
+    def count_row(self, row, n_genomes):
+        """ No. isolates, No. sequences and Avg sequences per isolate """
+        cells = [cell for cell in row[14:14 + n_genomes] if cell != ""]
+        sequences = sum(len(cell.split("\t")) for cell in cells)
+        row[3] = str(len(cells))
+        row[4] = str(sequences)
+        if len(cells) > 0:
+            row[5] = self.format_average(sequences / len(cells))
+        return len(cells)
+
+    def update_group_sizes(self, rows, genomes):
+        """ Min, Max and Avg group size nuc of the clusters from the
+        sequence lengths in the .fai indexes of the ffn files. Loci of
+        genomes without ffn file are not counted, clusters without any
+        known length keep their values """
+        sizes = [[] for row in rows]
+        for column, name in enumerate(genomes):
+            ffn_file = os.path.join(self.ffn_dir, name + ".ffn")
+            if not os.path.isfile(ffn_file):
+                continue
+            index = FastaIndex(ffn_file).index
+            for i, row in enumerate(rows):
+                cell = row[14 + column]
+                if cell == "":
+                    continue
+                for locus in cell.split("\t"):
+                    if locus in index:
+                        sizes[i].append(index[locus][0])
+        for row, lengths in zip(rows, sizes):
+            if len(lengths) > 0:
+                row[11] = str(min(lengths))
+                row[12] = str(max(lengths))
+                row[13] = str(int(round(sum(lengths) / len(lengths))))
+
+    def write_pangenome(self, header, rows):
+        tmp_file = self.pangenome_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            for row in rows:
+                writer.writerow(row)
+        os.replace(tmp_file, self.pangenome_file)
+
+    def remove_derived_files(self):
+        # core genes, alignments and primers of the previous pan-genome
+        for item in self.derived_files:
+            filepath = os.path.join(self.pangenome_dir, item)
+            if os.path.isdir(filepath):
+                shutil.rmtree(filepath)
+            elif os.path.isfile(filepath):
+                os.remove(filepath)
+
+    def update_pangenome(self):
+        """ adds the genes of new genomes to the clusters of the existing
+        pan-genome and removes genomes that are no longer in gff_files,
+        genes without a match form new clusters. Returns 2 without changes
+        and 1 if pan_genome_reference.fa is missing (Roary is needed) """
+        G.logger("Run: update_pangenome(" + self.target + ")")
+        start = time.time()
+        header, rows = self.read_pangenome()
+        accessions = header[14:]
+        gff_names = [
+            files.split(".gff")[0] for files in self.get_input_files()]
+        new = [name for name in gff_names if name not in accessions]
+        removed = [name for name in accessions if name not in gff_names]
+        if len(new) == 0 and len(removed) == 0:
+            info = (
+                "No new genomes for the pan-genome\n"
+                "Continue with existing Pangenome data")
+            print(info)
+            G.logger("> " + info)
+            return 2
+        if len(new) > 0 and not os.path.isfile(self.reference_file):
+            info = (
+                "Warning: " + self.reference_file + " not found, the "
+                "pan-genome can not be updated, run Roary with all genomes")
+            print(info)
+            G.logger("> " + info)
+            return 1
+
+        info = (
+            "Update pan-genome: " + str(len(new)) + " new and "
+            + str(len(removed)) + " removed genome(s)")
+        print(info)
+        G.logger("> " + info)
+        G.create_directory(self.update_dir)
+        # loci of the kept genomes and the new genomes
+        keep = [i for i, name in enumerate(accessions) if name not in removed]
+        genomes = [accessions[i] for i in keep] + new
+        clusters = {}
+        loci = {}
+        for row in rows:
+            cells = row[14:]
+            del row[14:]
+            row.extend([cells[i] for i in keep] + [""] * len(new))
+            clusters.update({row[0]: row})
+            for cell in cells:
+                for locus in cell.split("\t"):
+                    if locus:
+                        loci.update({locus: row[0]})
+
+        proteins = {}
+        sequences = {}
+        products = {}
+        for name in new:
+            ffn_file = os.path.join(self.ffn_dir, name + ".ffn")
+            if not os.path.isfile(ffn_file):
+                info = "Warning: " + name + ".ffn not found, no genes added"
+                print(info)
+                G.logger("> " + info)
+                continue
+            cds = self.read_cds(os.path.join(self.gff_dir, name + ".gff"))
+            index = FastaIndex(ffn_file)
+            found = index.fetch([locus for locus, product in cds])
+            for locus, product in cds:
+                seq = found.get(locus, "")
+                protein = self.translate(seq)
+                if len(protein) == 0:
+                    continue
+                proteins.update({locus: protein})
+                sequences.update({locus: seq})
+                products.update({locus: [name, product]})
+
+        assigned, new_clusters = self.assign_genes(loci, clusters, proteins)
+        for name, representative in new_clusters.items():
+            clusters.update({name: [
+                name, "", products[representative][1], "0", "0", "0",
+                "", "", "", "", "", "", "", ""] + [""] * len(genomes)})
+        columns = {name: 14 + i for i, name in enumerate(genomes)}
+        for locus in sorted(assigned):
+            row = clusters[assigned[locus]]
+            column = columns[products[locus][0]]
+            row[column] = "\t".join(
+                [cell for cell in [row[column], locus] if cell != ""])
+        rows = [
+            row for row in clusters.values()
+            if self.count_row(row, len(genomes)) > 0]
+        self.update_group_sizes(rows, genomes)
+        self.remove_derived_files()
+        # representatives of the new clusters for the next update
+        with open(self.reference_file, "a") as f:
+            for name, representative in new_clusters.items():
+                f.write(
+                    ">" + representative + " " + name + "\n"
+                    + sequences[representative] + "\n")
+        self.write_pangenome(header[0:14] + genomes, rows)
+        if self.config.intermediate is False:
+            shutil.rmtree(self.update_dir)
+
+        duration = time.time() - start
+        added = [
+            locus for locus in assigned
+            if assigned[locus] not in new_clusters]
+        info = (
+            "pan-genome update: " + str(len(added))
+            + " genes added to existing clusters, " + str(len(new_clusters))
+            + " new clusters, " + str(len(genomes)) + " genomes ("
+            + str(timedelta(seconds=duration)).split(".")[0] + ")")
+        G.logger("> " + info)
+        print(info)
+        PipelineStatsCollector(self.target_dir).write_stat(info)
+        info = (
+            "The core gene alignment and tree of the Pangenome directory are "
+            "not updated, use --pangenome full for a new alignment")
+        G.logger("> " + info)
+        return 0
+
+
+class GenePresenceAbsence:
+    """ gene_presence_absence.csv of Roary as typed columns (gene names, No.
+    isolates, No. sequences) and the loci of the genes in a sparse (CSR)
+    layout: the cells of gene i are indptr[i]:indptr[i + 1] with their
+    genome in genome_idx and their loci in a string table. The columns
+    are parsed once and kept in a binary sidecar (.npz) that is rebuilt
+    whenever the csv file is newer """
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.sidecar = os.path.splitext(filepath)[0] + ".npz"
+        if not os.path.isfile(self.sidecar) or (
+                os.path.getmtime(self.sidecar)
+                < os.path.getmtime(self.filepath)):
+            self.build()
+        with np.load(self.sidecar) as data:
+            self.genomes = data["genomes"]
+            self.genes = data["genes"]
+            self.isolates = data["isolates"]
+            self.sequences = data["sequences"]
+            self.indptr = data["indptr"]
+            self.genome_idx = data["genome_idx"]
+            self.strings = data["strings"]
+            self.offsets = data["offsets"]
+
+    def build(self):
+        genes = []
+        isolates = array.array("i")
+        sequences = array.array("i")
+        indptr = array.array("q", [0])
+        genome_idx = array.array("i")
+        offsets = array.array("q", [0])
+        strings = bytearray()
+        with open(self.filepath, "r") as f:
+            reader = csv.reader(f)
+            header = next(reader)
+            genomes = header[14:]
+            for row in reader:
+                genes.append(row[0])
+                isolates.append(int(row[3]))
+                sequences.append(int(row[4]))
+                for i, cell in enumerate(row[14:14 + len(genomes)]):
+                    if cell != "":
+                        genome_idx.append(i)
+                        strings.extend(cell.encode())
+                        offsets.append(len(strings))
+                indptr.append(len(genome_idx))
+        tmp_file = self.sidecar + ".tmp"
+        with open(tmp_file, "wb") as f:
+            np.savez(
+                f, genomes=np.array(genomes, dtype=str),
+                genes=np.array(genes, dtype=str),
+                isolates=np.frombuffer(isolates, dtype=np.int32),
+                sequences=np.frombuffer(sequences, dtype=np.int32),
+                indptr=np.frombuffer(indptr, dtype=np.int64),
+                genome_idx=np.frombuffer(genome_idx, dtype=np.int32),
+                strings=np.frombuffer(bytes(strings), dtype=np.uint8),
+                offsets=np.frombuffer(offsets, dtype=np.int64))
+        os.replace(tmp_file, self.sidecar)
+
+    def get_cell(self, index):
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return self.strings[start:end].tobytes().decode()
+
+    def get_loci(self, row):
+        """ loci of a gene in the genome columns, "" if a genome has not
+        the gene """
+        loci = [""] * len(self.genomes)
+        for index in range(self.indptr[row], self.indptr[row + 1]):
+            loci[self.genome_idx[index]] = self.get_cell(index)
+        return loci
+
+    def select_core_genes(self, presence=1.0):
+        """ masks of the core genes (in at least the fraction presence of
+        the genomes) and of the single copy core genes """
+        required = max(math.ceil(presence * len(self.genomes) - 1e-9), 1)
+        core = self.isolates >= required
+        singlecopy = core & (self.sequences == self.isolates)
+        return core, singlecopy
+
 
 class CoreGenes:
     def __init__(self, configuration):
@@ -1347,44 +3708,27 @@ class CoreGenes:
         self.singlecopy = os.path.join(
                 self.pangenome_dir, "singlecopy_genes.csv")
         self.ffn_seqs = os.path.join(self.pangenome_dir, "ffn_sequences.csv")
+        # fraction of the genomes with a core gene
+        self.presence = 1.0
+        # number of genomes read at once to write the core gene fasta files
+        self.chunk_size = 50
 
     def get_singlecopy_genes(self, mode):
-        total_count = []
-        single_count = []
-        all_core = []
-        multi_annotated = []
         filepath = os.path.join(
                 self.pangenome_dir, "gene_presence_absence.csv")
-        newtabledata = []
-        with open(filepath, "r") as f:
-            reader = csv.reader(f)
-            header = next(reader)
-            accessions = header[14:]
-            genomes = len(accessions)
-            for row in reader:
-                data_row = []
-                gene_name = row[0]
-                number_isolates = int(row[3])
-                number_sequences = int(row[4])
-                average_seq_per_isolate = float(row[5])
-                loci = row[14:]
-                if number_isolates == genomes:
-                    total_count.append(gene_name)
-                    if number_sequences == genomes:
-                        if average_seq_per_isolate == 1:
-                            single_count.append(gene_name)
-                            data_row.append(gene_name)
-                            for locus in loci:
-                                data_row.append(locus)
-                            if "group" in gene_name:
-                                all_core.append(gene_name)
-                                newtabledata.append(data_row)
-                            if "group" not in gene_name:
-                                if len(gene_name.split("_")) > 1:
-                                    multi_annotated.append(gene_name)
-                                else:
-                                    all_core.append(gene_name)
-                                    newtabledata.append(data_row)
+        pan = GenePresenceAbsence(filepath)
+        core, singlecopy = pan.select_core_genes(self.presence)
+        total_count = pan.genes[core].tolist()
+        rows = np.nonzero(singlecopy)[0]
+        names = pan.genes[rows]
+        # genes with several annotations (dnaK_1, dnaK_2) are not used
+        multi = (
+            (np.char.find(names, "group") == -1)
+            & (np.char.count(names, "_") > 0))
+        multi_annotated = names[multi].tolist()
+        all_core = names[~multi].tolist()
+        newtabledata = [
+            [pan.genes[i]] + pan.get_loci(i) for i in rows[~multi]]
 
         if mode == "normal":
             G.csv_writer(self.singlecopy, newtabledata)
@@ -1406,37 +3750,34 @@ class CoreGenes:
         stats.write_stat("core genes: " + str(len(total_count)))
         stats.write_stat("single copy core genes: " + str(len(all_core)))
 
-    def get_sequences_from_ffn(self):
-        locustags = {}
-        if os.path.isfile(self.ffn_seqs):
-            msg = "Found ffn_sequences.csv file, read from file"
-            print("\n" + msg + "\n")
-            G.logger(msg)
-            with open(self.ffn_seqs, "r") as f:
-                r = csv.reader(f)
-                for row in r:
-                    locustags.update({row[1]: {"name": row[0], "seq": row[2]}})
-        else:
-            ffn_data = []
-            for files in os.listdir(self.ffn_dir):
-                if files.endswith(".ffn"):
-                    filepath = os.path.join(self.ffn_dir, files)
-                    with open(filepath) as f:
-                        records = SeqIO.parse(f, "fasta")
-                        for record in records:
-                            name = files.split(".ffn")[0]
-                            recid = record.id
-                            locus = recid.split(" ")[0]
-                            seq = str(record.seq)
-                            locustags.update(
-                                    {locus: {"name": name, "seq": seq}})
-                            ffn_data.append([name, locus, seq])
-
-            G.csv_writer(self.ffn_seqs, ffn_data)
-
-        return locustags
-
-    def get_fasta(self, locustags):
+    def get_genome_order(self):
+        """ ffn files in the column order of gene_presence_absence.csv,
+        files of genomes not in the pan-genome are added at the end """
+        ffn_files = sorted(
+            files for files in os.listdir(self.ffn_dir)
+            if files.endswith(".ffn"))
+        filepath = os.path.join(
+            self.pangenome_dir, "gene_presence_absence.csv")
+        if not os.path.isfile(filepath):
+            return ffn_files
+        columns = {
+            name + ".ffn": i for i, name in enumerate(
+                GenePresenceAbsence(filepath).genomes.tolist())}
+        return sorted(
+            ffn_files, key=lambda files: columns.get(files, len(columns)))
+
+    @staticmethod
+    def fasta_record(header, seq, linewidth=60):
+        lines = [">" + header]
+        lines.extend(
+            seq[i:i + linewidth] for i in range(0, len(seq), linewidth))
+        return "\n".join(lines) + "\n"
+
+    def get_fasta(self):
+        """ writes the fasta files of the single copy core genes, the ffn
+        files are read in chunks of chunk_size genomes through their .fai
+        indexes and the records of each chunk are appended to the gene
+        files with one write per file """
 
         def check_genename(gene):
             if "/" in gene:
@@ -1445,27 +3786,57 @@ class CoreGenes:
                 gene_name = "-".join(gene.split(" "))
             elif "'" in gene:
                 gene_name = str(gene)[0:-1]
-                gene = gene + "'"
             else:
                 gene_name = gene
 
             return gene_name
 
+        genes = []
+        loci = set()
         with open(self.singlecopy, "r") as f:
             reader = csv.reader(f)
             for row in reader:
-                gene = check_genename(row[0])
-                outfile = os.path.join(self.fasta_dir, gene + ".fasta")
-                with open(outfile, "w") as r:
-                    for item in row[1:]:
-                        name = locustags[item]["name"]
-                        seq = locustags[item]["seq"]
-                        record = SeqRecord(
-                            Seq(seq),
-                            name=item,
-                            id='{}|{}|{}'.format(name, item, gene),
-                            description="")
-                        SeqIO.write(record, r, "fasta")
+                gene_name = check_genename(row[0])
+                outfile = os.path.join(self.fasta_dir, gene_name + ".fasta")
+                # empty cells: genomes without the gene (presence < 1)
+                row = [locus for locus in row[1:] if locus != ""]
+                genes.append([outfile, gene_name, row])
+                loci.update(row)
+
+        for outfile, gene_name, row in genes:
+            open(outfile, "w").close()
+
+        ffn_files = self.get_genome_order()
+        for start in range(0, len(ffn_files), self.chunk_size):
+            names = {}
+            sequences = {}
+            for files in ffn_files[start:start + self.chunk_size]:
+                name = files.split(".ffn")[0]
+                index = FastaIndex(os.path.join(self.ffn_dir, files))
+                found = index.fetch(
+                    [locus for locus in index.index if locus in loci])
+                for locus in found:
+                    names.update({locus: name})
+                sequences.update(found)
+                loci.difference_update(found)
+            if len(sequences) == 0:
+                continue
+            for outfile, gene_name, row in genes:
+                records = [
+                    self.fasta_record(
+                        "|".join([names[locus], locus, gene_name]),
+                        sequences[locus])
+                    for locus in row if locus in sequences]
+                if records:
+                    with open(outfile, "a", buffering=1 << 20) as r:
+                        r.write("".join(records))
+
+        if len(loci) > 0:
+            msg = (
+                "> " + str(len(loci)) + " single copy core gene loci not "
+                "found in the ffn files")
+            print(msg)
+            G.logger(msg)
 
     def coregene_extract(self, mode="normal"):
         info = "Run: core_gene_extract(" + self.target + ")"
@@ -1473,14 +3844,14 @@ class CoreGenes:
         G.logger(info)
         self.get_singlecopy_genes(mode)
         if mode == "normal":
-            locustags = self.get_sequences_from_ffn()
-            self.get_fasta(locustags)
+            self.get_fasta()
 
     def remove_intermediatefiles(self):
         filelist = [self.singlecopy, self.ffn_seqs]
         for item in filelist:
             filepath = os.path.join(self.pangenome_dir, item)
-            os.remove(filepath)
+            if os.path.isfile(filepath):
+                os.remove(filepath)
 
     def run_CoreGenes(self):
         count = 0
@@ -1536,52 +3907,139 @@ class CoreGeneSequences:
         self.consensus_dir = os.path.join(self.results_dir, "consensus")
         self.blast_dir = os.path.join(self.results_dir, "blast")
         self.conserved_dict = {}
+        # prank jobs run at once, time limit of one alignment in seconds
+        # and reruns of a failed or timed out alignment
+        self.prank_workers = self.config.prank_workers
+        if self.prank_workers <= 0:
+            self.prank_workers = G.cpu_count()
+        self.prank_timeout = self.config.prank_timeout
+        self.prank_retries = max(0, self.config.prank_retries)
+        self.prank_runs = os.path.join(self.results_dir, "prank_runs.csv")
+
+    def get_alignment_jobs(self):
+        """ fasta files of the core genes and the files without a prank
+        alignment, largest file first """
+        fasta_files = []
+        jobs = []
+        for files in os.listdir(self.fasta_dir):
+            if files.endswith(".fasta"):
+                file_name = files.split(".")[0]
+                fasta_files.append(files)
+                result_path = os.path.join(
+                    self.alignments_dir, file_name + ".best.fas")
+                if not os.path.isfile(result_path):
+                    jobs.append(files)
+        jobs.sort(key=lambda files: (-os.path.getsize(
+            os.path.join(self.fasta_dir, files)), files))
+        return fasta_files, jobs
+
+    def run_prank(self, files):
+        """ aligns one core gene, a failed or timed out run is repeated
+        prank_retries times. Returns gene, status, attempts and runtime """
+        file_name = files.split(".")[0]
+        result_path = os.path.join(
+            self.alignments_dir, file_name + ".best.fas")
+        cmd = [
+            "prank", "-d=" + os.path.join("fasta", files),
+            "-o=" + os.path.join("alignments", file_name)]
+        start = time.time()
+        status = "failed"
+        attempts = 0
+        while status != "done" and attempts <= self.prank_retries:
+            attempts += 1
+            try:
+                returncode = self.prank_processes.run(
+                    cmd, timeout=self.prank_timeout, cwd=self.results_dir,
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                if returncode == 0 and os.path.isfile(result_path):
+                    status = "done"
+                else:
+                    status = "failed"
+            except subprocess.TimeoutExpired:
+                status = "timeout"
+            except OSError:
+                status = "failed"
+            if status != "done" and os.path.isfile(result_path):
+                os.remove(result_path)
+        return [file_name, status, attempts, round(time.time() - start, 1)]
+
+    def schedule_alignments(self, jobs):
+        records = []
+        start = time.time()
+        workers = min(self.prank_workers, len(jobs))
+        info = (
+            str(len(jobs)) + " alignment(s) required, run "
+            + str(workers) + " Prank job(s)")
+        G.logger("> " + info)
+        print(info)
 
-    def seq_alignments(self):
-
-        def get_run_commands(run_file):
-            cmds = []
-            for files in os.listdir(self.fasta_dir):
-                if files.endswith(".fasta"):
-                    file_name = files.split(".")[0]
-                    fasta_files.append(files)
-                    result_path = os.path.join(
-                        self.alignments_dir, file_name + ".best.fas")
-                    if not os.path.isfile(result_path):
-                        fasta_path = os.path.join("fasta", files)
-                        aligned_path = os.path.join("alignments", file_name)
-                        cmds.append(
-                            "prank -d=" + fasta_path + " -o=" + aligned_path)
-            if len(cmds) > 0:
-                with open(run_file, "w") as w:
-                    for cmd in cmds:
-                        w.write(cmd + "\n")
+        running = {}
+        self.prank_processes = ProcessGroup()
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        try:
+            for files in jobs:
+                future = executor.submit(self.run_prank, files)
+                running.update({future: files})
+            for future in concurrent.futures.as_completed(running):
+                record = future.result()
+                running.pop(future)
+                records.append(record)
+                info = (
+                    "Prank " + record[0] + " (" + str(len(records))
+                    + " of " + str(len(jobs)) + "): " + record[1] + " "
+                    + str(timedelta(seconds=record[3])).split(".")[0])
+                G.logger(info)
+                print(info)
+        except (KeyboardInterrupt, SystemExit):
+            for future in running:
+                future.cancel()
+            # stop the running prank jobs before their output is removed
+            self.prank_processes.terminate()
+            executor.shutdown(wait=True)
+            # remove the output of every job that did not finish
+            for files in running.values():
+                G.keyexit_rollback(
+                    "Prank MSA run", dp=self.alignments_dir,
+                    fn=files.split(".")[0] + ".best.fas")
+            raise
+        finally:
+            executor.shutdown(wait=False)
+
+        G.csv_writer(
+            self.prank_runs, records,
+            header=["gene", "status", "attempts", "runtime [s]"])
+        failed = [record[0] for record in records if record[1] != "done"]
+        duration = time.time() - start
+        info = (
+            "Prank alignment of " + str(len(records) - len(failed))
+            + " core gene(s): "
+            + str(timedelta(seconds=duration)).split(".")[0])
+        G.logger("> " + info)
+        PipelineStatsCollector(self.target_dir).write_stat(info)
+        if failed:
+            msg = (
+                "Prank alignment failed for " + str(len(failed))
+                + " core gene(s), check:\n" + self.prank_runs)
+            print(msg)
+            G.logger(msg)
+            errors.append([self.target, msg])
+        return records
 
-        fasta_files = []
+    def seq_alignments(self):
         print("Start alignment of core gene sequences")
         G.logger("> " + "Start alignment of core gene sequences")
         G.logger("Run: seq_alignments(" + self.target + ")")
         G.create_directory(self.alignments_dir)
-        run_file = os.path.join(self.results_dir, "run_prank")
         coregenes = os.path.join(self.results_dir, "fasta", "coregenes.txt")
-        if os.path.isfile(run_file):
-            os.remove(run_file)
         if os.path.isfile(coregenes):
-            info = "Skip " + " ".join(["parallel", "-a", run_file])
+            info = "Skip prank alignments, found " + coregenes
             print(info)
             G.logger(info)
             return
 
-        os.chdir(self.results_dir)
-        get_run_commands(run_file)
-        if os.path.isfile(run_file):
-            try:
-                G.run_subprocess(
-                    ["parallel", "-a", run_file], True, True, False)
-            except (KeyboardInterrupt, SystemExit):
-                G.keyexit_rollback(
-                    "Prank MSA run", dp=self.alignments_dir, fp=run_file)
-                raise
+        fasta_files, jobs = self.get_alignment_jobs()
+        if len(jobs) > 0:
+            self.schedule_alignments(jobs)
 
         with open(coregenes, "w") as f:
             for fastafile in fasta_files:
@@ -1590,9 +4048,6 @@ class CoreGeneSequences:
                     filepath = os.path.join(self.fasta_dir, fastafile)
                     os.remove(filepath)
 
-        if self.config.intermediate is False:
-            if os.path.isfile(run_file):
-                os.remove(run_file)
         os.chdir(self.target_dir)
 
     def get_consensus_input(self, cons_summary):
@@ -1844,7 +4299,7 @@ class BlastPrep():
         print("\nPreparing files for BLAST")
         self.create_listdict()
         self.get_equalgroups()
-        cores = multiprocessing.cpu_count()
+        cores = G.cpu_count()
         inputseqs = self.write_blastinput()
         return cores, inputseqs
 
@@ -1858,6 +4313,32 @@ class Blast:
         self.config_dir = os.path.join(self.config.path, self.target, "config")
         self.directory = directory
         self.mode = mode
+        self.qc_name = None
+
+    @staticmethod
+    def find_qc_db(config, qc_genes):
+        """ ([databases], version) of the QC databases built by getqcdb.py
+        from the BLAST DB of the run (<DB dir>/qcdb), None if there is no
+        complete QC database for every QC gene """
+        db_dirs, db_name = QCCache.get_db_dirs(config)
+        for db_dir in db_dirs:
+            state_file = os.path.join(db_dir, "qcdb", "qcdb.json")
+            if not os.path.isfile(state_file):
+                continue
+            try:
+                with open(state_file) as f:
+                    state = json.load(f)
+            except ValueError:
+                continue
+            if state.get("source") != db_name or not state.get("complete"):
+                continue
+            if all(
+                    qc_gene in state.get("databases", [])
+                    for qc_gene in qc_genes):
+                return [
+                    os.path.join(db_dir, "qcdb", qc_gene + "_qc")
+                    for qc_gene in qc_genes], state["version"]
+        return None
 
     def get_blast_cmd(self, blastfile, filename, cores):
         taxidlist = os.path.join(dict_path, "2.txids")
@@ -1889,8 +4370,18 @@ class Blast:
                     blast_cmd.append("-taxidlist")
                     blast_cmd.append(taxidlist)
 
+        qc_db = None
+        if self.mode == "quality_control":
+            # the QC genes of a combined QC or of the QC gene <name>
+            qc_genes = self.config.qc_gene
+            if self.qc_name in qc_genes:
+                qc_genes = [self.qc_name]
+            qc_db = self.find_qc_db(self.config, qc_genes)
+
         blast_cmd.append("-db")
-        if self.config.customdb:
+        if qc_db:
+            blast_cmd.append(" ".join(qc_db[0]))
+        elif self.config.customdb:
             blast_cmd.append(self.config.customdb)
         else:
             blast_cmd.append("nt")
@@ -1906,6 +4397,7 @@ class Blast:
 
     def run_blast(self, name, use_cores):
         G.logger("Run: run_blast - Start BLAST")
+        self.qc_name = name
         blastfiles = self.search_blastfiles(self.directory)
         if len(blastfiles) > 0:
             blastfiles.sort(key=lambda x: int(x.split("part-")[1]))
@@ -3074,7 +5566,7 @@ class PrimerQualityControl:
         info = "Preparing multiprocessing Pool for prepare_MFEprimer_Dbs"
         print(info)
 
-        pool = multiprocessing.Pool()
+        pool = multiprocessing.Pool(G.cpu_count())
         results = [
             pool.apply_async(P.index_database, args=(inputfilepath,))
             for inputfilepath in dblist]
@@ -3639,9 +6131,8 @@ class Summary:
                     reader = csv.reader(r)
                     next(reader, None)
                     for row in reader:
-                        accession = "_".join(row[0].split("_")[0:-1])
-                        if ("GCF" or "GCA") in row[0]:
-                            accession = ".".join(accession.split("v"))
+                        accession = GenomeManifest.get_accession(
+                            "_".join(row[0].split("_")[0:-1]))[0]
 
                         if accession not in self.g_info_dict.keys():
                             add_accession = {
@@ -3676,13 +6167,9 @@ class Summary:
     def get_genome_infos(self):
         G.logger("Run: get_genome_infos(" + self.target + ")")
         genome_data = []
-        genomedata = os.path.join(self.config_dir, "genomicdata.json")
-        if os.path.isfile(genomedata):
-            with open(genomedata) as q:
-                for line in q:
-                    records = json.loads(line)
-
-            for result in records['DocumentSummarySet']['DocumentSummary']:
+        metadata = AssemblyMetadata(self.config_dir)
+        if len(metadata.records) > 0:
+            for result in metadata.records.values():
                 accession = result["AssemblyAccession"]
                 name = result["AssemblyName"]
                 status = result["AssemblyStatus"]
@@ -3703,6 +6190,25 @@ class Summary:
                         "assemblystatus": item[2]}
                     self.g_info_dict[item[0]].update(ncbi_info)
 
+    def get_genome_stats(self):
+        G.logger("Run: get_genome_stats(" + self.target + ")")
+        fna_dir = os.path.join(self.target_dir, "fna_files")
+        if not os.path.isdir(fna_dir):
+            return
+        manifest = GenomeManifest(self.target_dir)
+        fasta_stats = FastaStats(
+            os.path.join(self.config_dir, "fasta_stats.json"))
+        for files in os.listdir(fna_dir):
+            if files.endswith(".fna"):
+                name = "_".join(files.split("_")[0:-1])
+                if manifest.get_state(name) == "excluded":
+                    continue
+                accession = GenomeManifest.get_accession(name)[0]
+                if accession in self.g_info_dict.keys():
+                    stats = fasta_stats.get(os.path.join(fna_dir, files))
+                    self.g_info_dict[accession].update({"stats": stats})
+        fasta_stats.save()
+
     def write_genome_info(self):
         G.logger("Run: write_genome_info(" + self.target + ")")
         file_name = self.aka + "_qc_sequences.csv"
@@ -3732,10 +6238,13 @@ class Summary:
                 "tuf", "tuf Blast", "Hit GI", "Hit DB_id",
                 "recA", "recA Blast", "Hit GI", "Hit DB_id",
                 "dnaK", "dnaK Blast", "Hit GI", "Hit DB_id",
-                "pheS", "pheS Blast", "Hit GI", "Hit DB_id"]
+                "pheS", "pheS Blast", "Hit GI", "Hit DB_id",
+                "Contigs", "Genome size", "N50", "GC content"]
         detailinfo = []
         for key in self.g_info_dict:
             k = self.g_info_dict[key]
+            stats = k.get(
+                "stats", {"contigs": "", "length": "", "n50": "", "gc": ""})
             infos = [
                 key, k["name"], k['assemblystatus'], k["strain"],
                 k["rRNA"]["status"], k["rRNA"]["hit"],
@@ -3747,7 +6256,8 @@ class Summary:
                 k["dnaK"]["status"], k["dnaK"]["hit"],
                 k["dnaK"]["GI"], k["dnaK"]["DB_id"],
                 k["pheS"]["status"], k["pheS"]["hit"],
-                k["pheS"]["GI"], k["pheS"]["DB_id"]]
+                k["pheS"]["GI"], k["pheS"]["DB_id"],
+                stats["contigs"], stats["length"], stats["n50"], stats["gc"]]
             detailinfo.append(infos)
         G.csv_writer(filepath, detailinfo, header)
 
@@ -3855,6 +6365,7 @@ class Summary:
             self.collect_qc_infos(qc_gene)
         self.copy_mostcommon_hits()
         self.get_genome_infos()
+        self.get_genome_stats()
         self.write_genome_info()
         if mode == "last":
             if self.config.nolist:
@@ -3926,6 +6437,22 @@ def commandline():
        "--skip_tree", action="store_true",
        help="Faster Pangenome analysis, no core gene alignment and tree for "
        "troubleshooting is generated.")
+    parser.add_argument(
+       "--pangenome", type=str, choices=["keep", "incremental", "full"],
+       default="keep", help="Existing Pangenome data, keep: continue with "
+       "the existing data, incremental: add the genes of new genomes to the "
+       "existing clusters, full: run Roary again with all genomes, "
+       "default=keep")
+    parser.add_argument(
+       "--dereplicate", type=float, default=0.0,
+       help="Cluster the genomes by MinHash (Mash) distance before the "
+       "pan-genome analysis and use one representative per cluster, e.g. "
+       "0.001 for near-clonal genomes, default=0 (off)")
+    parser.add_argument(
+       "--max_genomes", type=int, default=0,
+       help="With --dereplicate, add further genomes of the clusters to the "
+       "representatives up to this number of genomes, default=0 "
+       "(representatives only)")
     # primer3 amplicon size
     parser.add_argument(
        "--minsize", "-min", type=int, default=70,
@@ -3975,6 +6502,32 @@ def commandline():
     parser.add_argument(
         "--ignore_qc", action="store_true", help="Genomes which do not"
         " pass quality control are included in the analysis")
+    parser.add_argument(
+        "--preqc", action="store_true", help="Run the quality control "
+        "with the raw genome assemblies before the annotation, genomes "
+        "which fail QC are not annotated")
+    parser.add_argument(
+        "--annotation", type=str, choices=["prokka", "ncbi"],
+        default="prokka", help="Annotation of the genome assemblies, ncbi: "
+        "use the NCBI annotation of RefSeq assemblies and run Prokka only "
+        "for genomes without NCBI annotation, default=prokka")
+    parser.add_argument(
+        "--annotation_cores", type=int, default=0,
+        help="Cores for the genome annotation, shared by concurrent Prokka "
+        "jobs, default=0 (all cores)")
+    parser.add_argument(
+        "--prokka_cores", type=int, default=4,
+        help="Cores per Prokka job, default=4")
+    parser.add_argument(
+        "--prank_workers", type=int, default=0,
+        help="Prank alignments of core genes run at the same time, "
+        "default=0 (all cores)")
+    parser.add_argument(
+        "--prank_timeout", type=int, default=21600,
+        help="Time limit of one prank alignment in seconds, default=21600")
+    parser.add_argument(
+        "--prank_retries", type=int, default=1,
+        help="Reruns of a failed or timed out prank alignment, default=1")
     parser.add_argument(
         "--customdb", type=str, default=None,
         help="Absolute filepath of a custom database for blastn")
@@ -3993,6 +6546,11 @@ def commandline():
         '["p3settings", "p3parameters"], '
         '["excludedgis", "no_blast.gi"]'
         " The current settings files will be overwritten")
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=1,
+        help="Number of targets processed at the same time, the cores and "
+        "memory are shared between the targets, 0 = as many as the "
+        "available cores and memory allow (default = 1)")
     # Version
     parser.add_argument(
         "-V", "--version", action="version", version="%(prog)s 2.1.2")
@@ -4043,13 +6601,27 @@ def get_configuration_from_file(target, conf_from_file):
         nontargetlist = []
     else:
         nontargetlist = H.create_non_target_list(target)
+    preqc = conf_from_file.get_option(target, "preqc", False)
+    annotation = conf_from_file.get_option(target, "annotation", "prokka")
+    pangenome = conf_from_file.get_option(target, "pangenome", "keep")
+    dereplicate = conf_from_file.get_option(target, "dereplicate", 0.0)
+    max_genomes = conf_from_file.get_option(target, "max_genomes", 0)
+    annotation_cores = conf_from_file.get_option(
+        target, "annotation_cores", 0)
+    prokka_cores = conf_from_file.get_option(target, "prokka_cores", 4)
+    prank_workers = conf_from_file.get_option(target, "prank_workers", 0)
+    prank_timeout = conf_from_file.get_option(
+        target, "prank_timeout", 21600)
+    prank_retries = conf_from_file.get_option(target, "prank_retries", 1)
 
     config = CLIconf(
         minsize, maxsize, mpprimer, exception, target, path,
         intermediate, qc_gene, mfold, skip_download,
         assemblylevel, nontargetlist, skip_tree,
         nolist, offline, ignore_qc, mfethreshold, customdb,
-        blastseqs, probe, blastdbv5)
+        blastseqs, probe, blastdbv5, preqc, annotation, pangenome,
+        dereplicate, max_genomes, annotation_cores, prokka_cores,
+        prank_workers, prank_timeout, prank_retries)
 
     return config
 
@@ -4065,10 +6637,8 @@ def run_pipeline_for_target(target, config):
     newconfig = DataCollection(config).collect()
     if newconfig != 0:
         config = newconfig
-    qc_count = []
-    for qc_gene in config.qc_gene:
-        qc = QualityControl(config).quality_control(qc_gene)
-        qc_count.append(qc)
+    qc_count = CombinedQualityControl(config).quality_control(
+        config.qc_gene)
     if not sum(qc_count) == 0:
         total_results = []
         Summary(config, total_results).run_summary()
@@ -4080,6 +6650,7 @@ def run_pipeline_for_target(target, config):
         except FileNotFoundError:
             pass
         # end
+        GenomeDereplication(config).run_dereplication()
         PangenomeAnalysis(config).run_pangenome_analysis()
         CoreGenes(config).run_CoreGenes()
         conserved_seq_dict = CoreGeneSequences(
@@ -4112,7 +6683,10 @@ def get_configuration_from_args(target, args):
         args.assemblylevel, nontargetlist,
         args.skip_tree, args.nolist, args.offline,
         args.ignore_qc, args.mfethreshold, args.customdb,
-        args.blastseqs, args.probe, args.blastdbv5)
+        args.blastseqs, args.probe, args.blastdbv5, args.preqc,
+        args.annotation, args.pangenome, args.dereplicate, args.max_genomes,
+        args.annotation_cores, args.prokka_cores, args.prank_workers,
+        args.prank_timeout, args.prank_retries)
 
     if args.configfile:
         exitstat = H.advanced_pipe_config(args.configfile)
@@ -4121,6 +6695,150 @@ def get_configuration_from_args(target, args):
 
     return config
 
+def run_target(target, config, logfile):
+    today = time.strftime("%Y_%m_%d", time.localtime())
+    G.logger("> Start log: " + target + " " + today)
+    H.BLASTDB_check(config)
+    G.logger(config.__dict__)
+
+    try:
+        run_pipeline_for_target(target, config)
+    except Exception as exc:
+        msg = [
+            "fatal error while working on", target,
+            "check logfile", logfile]
+        target_dir = os.path.join(config.path, config.target)
+        PipelineStatsCollector(target_dir).write_stat(
+            "Error: " + str(time.ctime()))
+        print(" ".join(msg))
+        print(exc)
+        import traceback
+        traceback.print_exc()
+        G.logger(msg)
+        errors.append([target, " ".join(msg)])
+        logging.error(
+            "fatal error while working on " + target, exc_info=True)
+
+    except (KeyboardInterrupt, SystemExit):
+        logging.error(
+            "SpeciesPrimer was stopped while working on " + target,
+            exc_info=True)
+        raise
+
+
+def get_target_jobs(jobs, target_count, target_cores=2,
+                    target_memory=4 * 1024 ** 3):
+    # each target needs at least target_cores and target_memory (bytes)
+    limit = max(1, G.cpu_count() // target_cores)
+    memory = G.available_memory()
+    if memory:
+        limit = min(limit, max(1, memory // target_memory))
+    if jobs is None or jobs < 1:
+        jobs = limit
+    return max(1, min(jobs, limit, target_count))
+
+
+def target_process(target, config, logfile, cores, results, log_queue=None):
+    # runs in a child process with its own log file, errors list and
+    # share of the cores, log_queue forwards the log to the main log file
+    if cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    del errors[:]
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+    logging.basicConfig(
+        filename=logfile, level=logging.DEBUG, format="%(message)s")
+    if log_queue is not None:
+        handler = logging.handlers.QueueHandler(log_queue)
+        handler.setFormatter(logging.Formatter(target + ": %(message)s"))
+        root.addHandler(handler)
+    try:
+        run_target(target, config, logfile)
+    except (KeyboardInterrupt, SystemExit):
+        errors.append([target, "SpeciesPrimer was stopped"])
+    finally:
+        results.put([target, list(errors)])
+
+
+def run_targets_parallel(target_configs, jobs, logfile):
+    if hasattr(os, "sched_getaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = []
+    # split the cores in one group per concurrent target
+    core_groups = [cores[i::jobs] for i in range(jobs)]
+    info = (
+        "Run " + str(len(target_configs)) + " targets, "
+        + str(jobs) + " at the same time")
+    print(info)
+    G.logger("> " + info)
+    results = multiprocessing.Queue()
+    # the log of all targets is also written to the main log file, which
+    # is followed by the live log of the GUI (frontail)
+    log_queue = multiprocessing.Queue()
+    listener = logging.handlers.QueueListener(
+        log_queue, *logging.getLogger().handlers)
+    listener.start()
+    pending = list(target_configs)
+    running = {}
+    try:
+        while pending or running:
+            while pending and core_groups:
+                target, config = pending.pop(0)
+                group = core_groups.pop(0)
+                target_log = (
+                    os.path.splitext(logfile)[0] + "_" + target + ".log")
+                process = multiprocessing.Process(
+                    target=target_process,
+                    args=(
+                        target, config, target_log, group, results,
+                        log_queue))
+                process.start()
+                running.update({target: [process, group, target_log]})
+                info = "Start " + target + " (log: " + target_log + ")"
+                print(info)
+                G.logger("> " + info)
+
+            try:
+                target, target_errors = results.get(timeout=10)
+            except queue.Empty:
+                # a target process that ended without reporting back
+                stopped = [
+                    t for t in running if not running[t][0].is_alive()]
+                if len(stopped) == 0:
+                    continue
+                target, target_errors = stopped[0], []
+            if target not in running:
+                # late report of a process that was already collected
+                errors.extend(target_errors)
+                continue
+            process, group, target_log = running.pop(target)
+            process.join()
+            core_groups.append(group)
+            errors.extend(target_errors)
+            if process.exitcode != 0 and len(target_errors) == 0:
+                errors.append([
+                    target, "fatal error while working on " + target
+                    + " check logfile " + target_log])
+            info = "Finished " + target
+            print(info)
+            G.logger("> " + info)
+
+    except (KeyboardInterrupt, SystemExit):
+        for target in running:
+            process = running[target][0]
+            if process.is_alive():
+                process.terminate()
+            process.join()
+            logging.error(
+                "SpeciesPrimer was stopped while working on " + target)
+        raise
+    finally:
+        listener.stop()
+
+
 def exitatsigterm(signalNumber, frame):
     raise SystemExit('GUI stop')
 
@@ -4137,6 +6855,8 @@ def main(mode=None):
         logging.basicConfig(
             filename=logfile, level=logging.DEBUG, format="%(message)s")
         targets, conf_from_file, use_configfile = auto_run()
+        # batch runs process as many targets as cores and memory allow
+        jobs = 0
 
     else:
         parser = commandline()
@@ -4161,44 +6881,25 @@ def main(mode=None):
 
         if args.email:
             H.get_email_for_Entrez(args.email)
+        jobs = args.jobs
 
     G.logger(citation())
 
+    target_configs = []
     for target in targets:
         target = target.capitalize()
         if use_configfile:
             config = get_configuration_from_file(target, conf_from_file)
         else:
             config = get_configuration_from_args(target, args)
+        target_configs.append([target, config])
 
-        today = time.strftime("%Y_%m_%d", time.localtime())
-        G.logger("> Start log: " + target + " " + today)
-        H.BLASTDB_check(config)
-        G.logger(config.__dict__)
-
-        try:
-            run_pipeline_for_target(target, config)
-        except Exception as exc:
-            msg = [
-                "fatal error while working on", target,
-                "check logfile", logfile]
-            target_dir = os.path.join(config.path, config.target)
-            PipelineStatsCollector(target_dir).write_stat(
-                "Error: " + str(time.ctime()))
-            print(" ".join(msg))
-            print(exc)
-            import traceback
-            traceback.print_exc()
-            G.logger(msg)
-            errors.append([target, " ".join(msg)])
-            logging.error(
-                "fatal error while working on " + target, exc_info=True)
-
-        except (KeyboardInterrupt, SystemExit):
-            logging.error(
-                "SpeciesPrimer was stopped while working on " + target,
-                exc_info=True)
-            raise
+    jobs = get_target_jobs(jobs, len(target_configs))
+    if jobs > 1:
+        run_targets_parallel(target_configs, jobs, logfile)
+    else:
+        for target, config in target_configs:
+            run_target(target, config, logfile)
 
     if len(errors) > 0:
         print("Error report: ")
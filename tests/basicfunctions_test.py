@@ -5,9 +5,16 @@ import os
 import shutil
 import pytest
 import json
+import time
+import hashlib
 from Bio import Entrez
 from basicfunctions import HelperFunctions as H
 from basicfunctions import GeneralFunctions as G
+from basicfunctions import DownloadManager
+from basicfunctions import FastaStats
+from basicfunctions import TaxidSet
+from basicfunctions import FastaIndex
+from basicfunctions import ProcessGroup
 import filecmp
 
 msg = (
@@ -493,5 +500,306 @@ def test_rollback():
     shutil.rmtree(testdir)
 
 
+def test_DownloadManager():
+    import threading
+    import urllib.error
+    from socketserver import ThreadingMixIn
+    from http.server import HTTPServer, SimpleHTTPRequestHandler
+
+    servedir = os.path.join(tmpdir, "serve")
+    downdir = os.path.join(tmpdir, "download")
+    G.create_directory(servedir)
+    G.create_directory(downdir)
+
+    class RangeHandler(SimpleHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def translate_path(self, path):
+            return os.path.join(servedir, path.strip("/"))
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.startswith("/redirect/") or self.path == "/loop":
+                self.send_response(302)
+                self.send_header(
+                    "Location", self.path.replace("/redirect", "", 1))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            filepath = self.translate_path(self.path)
+            if not os.path.isfile(filepath):
+                self.send_error(404)
+                return
+            with open(filepath, "rb") as f:
+                data = f.read()
+            etag = '"' + hashlib.md5(data).hexdigest() + '"'
+            start = 0
+            if self.headers.get("Range") and (
+                    self.headers.get("If-Range", etag) == etag):
+                start = int(self.headers["Range"].split("=")[1].strip("-"))
+                self.send_response(206)
+            else:
+                self.send_response(200)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", str(len(data) - start))
+            self.end_headers()
+            self.wfile.write(data[start:])
+
+    class ThreadingServer(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    server = ThreadingServer(("127.0.0.1", 0), RangeHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    baseurl = "http://127.0.0.1:" + str(server.server_port) + "/"
+
+    jobs = []
+    for i in range(0, 6):
+        filename = "genome" + str(i) + ".fna"
+        with open(os.path.join(servedir, filename), "w") as f:
+            f.write(">contig" + str(i) + "\n" + "ACGT" * 10000 + "\n")
+        jobs.append([baseurl + filename, os.path.join(downdir, filename)])
+
+    # partial download from a previous run is resumed
+    with open(os.path.join(servedir, "genome0.fna"), "rb") as f:
+        data = f.read()
+    with open(os.path.join(downdir, "genome0.fna.part"), "wb") as f:
+        f.write(data[0:1000])
+    with open(os.path.join(downdir, "genome0.fna.part.validator"), "w") as f:
+        f.write('"' + hashlib.md5(data).hexdigest() + '"')
+
+    downloader = DownloadManager(max_workers=3, backoff=0)
+    downloaded = downloader.download_all(jobs)
+    downloader.close()
+    assert len(downloaded) == 6
+    for url, filepath in jobs:
+        servefile = os.path.join(servedir, os.path.basename(filepath))
+        assert filecmp.cmp(servefile, filepath, shallow=False) is True
+        assert os.path.isfile(filepath + ".part") is False
+    resumed = [stat for stat in downloader.stats if stat["resumed"]]
+    assert len(resumed) == 1
+    assert resumed[0]["bytes"] == os.path.getsize(jobs[0][1]) - 1000
+    assert downloader.summary().startswith("downloaded files: 6 (resumed: 1)")
+    assert not os.path.isfile(jobs[0][1] + ".part.validator")
+
+    # a partial file of a changed file is downloaded again
+    with open(jobs[1][1] + ".part", "wb") as f:
+        f.write(b"old file content")
+    with open(jobs[1][1] + ".part.validator", "w") as f:
+        f.write('"old"')
+    os.remove(jobs[1][1])
+    downloader = DownloadManager(max_workers=1, backoff=0)
+    downloader.download_all([jobs[1]])
+    servefile = os.path.join(servedir, os.path.basename(jobs[1][1]))
+    assert filecmp.cmp(servefile, jobs[1][1], shallow=False) is True
+    assert downloader.stats[0]["bytes"] == os.path.getsize(servefile)
+
+    # redirects are followed up to max_redirects
+    redirected = os.path.join(downdir, "redirected.fna")
+    downloader.download_all(
+        [[baseurl + "redirect/genome2.fna", redirected]])
+    assert filecmp.cmp(redirected, jobs[2][1], shallow=False) is True
+    with pytest.raises(urllib.error.HTTPError):
+        downloader.download_all(
+            [[baseurl + "loop", os.path.join(downdir, "loop.fna")]])
+    downloader.close()
+
+    # local files
+    localfile = os.path.join(downdir, "local.fna")
+    downloader = DownloadManager(max_workers=1, backoff=0)
+    downloader.download_all(
+        [["file://" + os.path.join(servedir, "genome1.fna"), localfile]])
+    assert filecmp.cmp(localfile, jobs[1][1], shallow=False) is True
+
+    # missing files are not retried
+    with pytest.raises(urllib.error.HTTPError):
+        downloader.download_all(
+            [[baseurl + "missing.fna", os.path.join(downdir, "missing.fna")]])
+    assert os.path.isfile(os.path.join(downdir, "missing.fna")) is False
+
+    # gzip files are extracted during the download
+    import gzip
+    gzjobs = []
+    for i in range(0, 3):
+        filename = "genome" + str(i) + ".fna"
+        with open(os.path.join(servedir, filename), "rb") as f:
+            with gzip.open(os.path.join(servedir, filename + ".gz"), "wb") as g:
+                g.write(f.read())
+        gzjobs.append(
+            [baseurl + filename + ".gz",
+             os.path.join(downdir, "gz_" + filename + ".gz")])
+    with open(os.path.join(servedir, "genome0.fna.gz"), "rb") as f:
+        partial = f.read(100)
+    with open(gzjobs[0][1] + ".part", "wb") as f:
+        f.write(partial)
+    ready = []
+    downloader = DownloadManager(max_workers=2, backoff=0, decompress=True)
+    downloaded = downloader.download_all(gzjobs, callback=ready.append)
+    downloader.close()
+    assert sorted(downloaded) == sorted(ready)
+    for i, job in enumerate(gzjobs):
+        fnafile = job[1].split(".gz")[0]
+        assert fnafile in downloaded
+        assert filecmp.cmp(fnafile, jobs[i][1], shallow=False) is True
+        assert os.path.isfile(job[1]) is False
+        assert os.path.isfile(job[1] + ".part") is False
+        assert os.path.isfile(fnafile + ".part") is False
+
+    # files already on disk
+    gzfile = os.path.join(downdir, "disk.fna.gz")
+    shutil.copy(os.path.join(servedir, "genome2.fna.gz"), gzfile)
+    assert G.gunzip_file(gzfile) == os.path.join(downdir, "disk.fna")
+    assert filecmp.cmp(
+        os.path.join(downdir, "disk.fna"), jobs[2][1], shallow=False) is True
+    assert os.path.isfile(gzfile) is False
+    # truncated archives do not leave an extracted file behind
+    with open(os.path.join(servedir, "genome2.fna.gz"), "rb") as f:
+        truncated = f.read()[:-20]
+    with open(gzfile, "wb") as f:
+        f.write(truncated)
+    os.remove(os.path.join(downdir, "disk.fna"))
+    with pytest.raises(EOFError):
+        G.gunzip_file(gzfile)
+    assert os.path.isfile(os.path.join(downdir, "disk.fna")) is False
+
+    assert DownloadManager.get_url(
+        "ftp://ftp.ncbi.nlm.nih.gov/genomes/all/GCF") == (
+        "https://ftp.ncbi.nlm.nih.gov/genomes/all/GCF")
+
+    server.shutdown()
+    server.server_close()
+    shutil.rmtree(servedir)
+    shutil.rmtree(downdir)
+
+
+def test_FastaStats():
+    testdir = os.path.join(tmpdir, "fastastats")
+    G.create_directory(testdir)
+    fasta = os.path.join(testdir, "genome.fna")
+    with open(fasta, "w") as f:
+        f.write(">contig_1 first\nATGCATGCAT\nGGCC\n")
+        f.write(">contig_2\r\nattaat\r\n")
+        f.write(">contig_3\nGGGGCCCCAA")
+    stats = FastaStats.scan(fasta)
+    assert stats == {"contigs": 3, "length": 30, "n50": 10, "gc": 53.33}
+    empty = os.path.join(testdir, "empty.fna")
+    open(empty, "w").close()
+    assert FastaStats.scan(empty) == {
+        "contigs": 0, "length": 0, "n50": 0, "gc": 0.0}
+
+    table = os.path.join(testdir, "fasta_stats.json")
+    fasta_stats = FastaStats(table)
+    assert fasta_stats.get(fasta) == stats
+    fasta_stats.save()
+    assert os.path.isfile(table)
+    # the table is reused as long as size and mtime are unchanged
+    fasta_stats = FastaStats(table)
+    fasta_stats.table[fasta]["stats"]["contigs"] = 100
+    assert fasta_stats.get(fasta)["contigs"] == 100
+    with open(fasta, "a") as f:
+        f.write("\n>contig_4\nAA\n")
+    assert fasta_stats.get(fasta)["contigs"] == 4
+    shutil.rmtree(testdir)
+
+
+def test_ProcessGroup():
+    import subprocess
+    import threading
+    group = ProcessGroup()
+    assert group.run(["true"]) == 0
+    assert group.run(["false"]) == 1
+    try:
+        group.run(["sleep", "10"], timeout=0.2)
+        assert False
+    except subprocess.TimeoutExpired:
+        pass
+    assert len(group.processes) == 0
+    codes = []
+    worker = threading.Thread(
+        target=lambda: codes.append(group.run(["sleep", "30"])))
+    start = time.time()
+    worker.start()
+    while len(group.processes) == 0:
+        time.sleep(0.01)
+    group.terminate()
+    worker.join()
+    assert codes[0] != 0
+    assert time.time() - start < 10
+    # no new processes after terminate
+    try:
+        group.run(["true"])
+        assert False
+    except ChildProcessError:
+        pass
+
+
+def test_FastaIndex():
+    from Bio import SeqIO
+    testdir = os.path.join(tmpdir, "fastaindex")
+    G.create_directory(testdir)
+    ffn = os.path.join(testdir, "GCF_004088235v1_20191001.ffn")
+    shutil.copy(
+        os.path.join(testfiles_dir, "GCF_004088235v1_20191001.ffn"), ffn)
+    records = {
+        record.id: str(record.seq) for record in SeqIO.parse(ffn, "fasta")}
+    index = FastaIndex(ffn)
+    assert os.path.isfile(ffn + ".fai")
+    assert len(index) == len(records)
+    names = list(records.keys())[::50] + ["unknown_00001"]
+    sequences = index.fetch(names)
+    assert "unknown_00001" not in sequences
+    for name, seq in sequences.items():
+        assert seq == records[name]
+    # the index file is reused
+    assert FastaIndex(ffn).index == index.index
+
+    fasta = os.path.join(testdir, "seqs.fas")
+    with open(fasta, "w") as f:
+        f.write(">seq_1 first\nATGCA\nGGC\n>empty\n")
+        f.write(">seq_2\r\nATTAA\r\nTTAAT\r\nA\r\n>seq_3\nGGGCC")
+    index = FastaIndex(fasta)
+    assert index.fetch(["seq_1", "empty", "seq_2", "seq_3"]) == {
+        "seq_1": "ATGCAGGC", "empty": "", "seq_2": "ATTAATTAATA",
+        "seq_3": "GGGCC"}
+    irregular = os.path.join(testdir, "irregular.fas")
+    with open(irregular, "w") as f:
+        f.write(">seq_1\nATG\nATGCA\n")
+    with pytest.raises(ValueError):
+        FastaIndex(irregular)
+    shutil.rmtree(testdir)
+
+
+def test_TaxidSet():
+    testdir = os.path.join(tmpdir, "taxidset")
+    G.create_directory(testdir)
+    txids = os.path.join(testdir, "2.txids")
+    with open(txids, "w") as f:
+        for taxid in [2, 6, 7, 9, 28038, 1578, 6]:
+            f.write(str(taxid) + "\n")
+    taxids = TaxidSet(txids)
+    assert os.path.isfile(txids + ".bin")
+    assert len(taxids) == 6
+    assert "28038" in taxids
+    assert 8 not in taxids
+    assert taxids.difference(["28038", "7", "3"]) == [2, 6, 9, 1578]
+    taxidlist = os.path.join(testdir, "taxidlist.txt")
+    taxids.write_difference([2, 28038], taxidlist)
+    with open(taxidlist) as f:
+        assert f.read() == "6\n7\n9\n1578\n"
+    taxids.close()
+    # the sidecar is rebuilt after the list was updated
+    time.sleep(0.01)
+    TaxidSet.write(["28038", "1", "2"], txids)
+    with open(txids) as f:
+        assert f.read() == "1\n2\n28038\n"
+    taxids = TaxidSet(txids)
+    assert taxids.difference([]) == [1, 2, 28038]
+    taxids.close()
+    shutil.rmtree(testdir)
+
+
 if __name__ == "__main__":
     print(msg)
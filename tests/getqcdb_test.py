@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import shutil
+import getqcdb
+from basicfunctions import GeneralFunctions as G
+
+
+msg = (
+    """
+    Works only in the Docker container!!!
+    - Start the container
+        sudo docker start {Containername}
+    - Start an interactive terminal in the container
+        sudo docker exec -it {Containername} bash
+    - Start the tests in the container terminal
+        cd /
+        pytest -vv --cov=pipeline /tests/
+    """
+)
+
+tmpdir = os.path.join("/", "blastdb", "tmp", "qcdb_test")
+
+
+def prepare_tmpdir():
+    if os.path.isdir(tmpdir):
+        shutil.rmtree(tmpdir)
+    G.create_directory(tmpdir)
+
+
+def test_commandline():
+    parser = getqcdb.commandline()
+    args = parser.parse_args([])
+    assert args.database == "nt"
+    assert args.qc_gene == getqcdb.qc_genes
+    assert args.all_taxa is False
+    args = parser.parse_args(
+        ["-dbpath", tmpdir, "-db", "ref_prok_rep_genomes", "-qc_gene", "rRNA"])
+    assert args.dbpath == tmpdir
+    assert args.database == "ref_prok_rep_genomes"
+    assert args.qc_gene == ["rRNA"]
+
+
+def test_get_volumes():
+    prepare_tmpdir()
+    assert getqcdb.get_volumes(tmpdir, "nt") == ["nt"]
+    with open(os.path.join(tmpdir, "nt.nal"), "w") as f:
+        f.write("#\nTITLE Nucleotide collection (nt)\n#\n")
+        f.write('DBLIST "nt.00" "nt.01" nt.02\n')
+    assert getqcdb.get_volumes(tmpdir, "nt") == ["nt.00", "nt.01", "nt.02"]
+
+
+def test_volume_version():
+    prepare_tmpdir()
+    for ext in [".nsq", ".nin"]:
+        with open(os.path.join(tmpdir, "nt.00" + ext), "w") as f:
+            f.write("x")
+    version = getqcdb.volume_version(tmpdir, "nt.00")
+    assert version == getqcdb.volume_version(tmpdir, "nt.00")
+    with open(os.path.join(tmpdir, "nt.00.nsq"), "a") as f:
+        f.write("y")
+    assert version != getqcdb.volume_version(tmpdir, "nt.00")
+    md5dir = os.path.join(tmpdir, "md5_files")
+    G.create_directory(md5dir)
+    with open(os.path.join(md5dir, "nt.00.tar.gz.md5"), "w") as f:
+        f.write("abc  nt.00.tar.gz\n")
+    version = getqcdb.volume_version(tmpdir, "nt.00")
+    with open(os.path.join(tmpdir, "nt.00.nsq"), "a") as f:
+        f.write("z")
+    assert version == getqcdb.volume_version(tmpdir, "nt.00")
+
+
+def test_match_qc_genes():
+    genes = getqcdb.qc_genes
+    assert getqcdb.match_qc_genes(
+        "Lactobacillus curvatus strain DSM 20019 16S ribosomal RNA, "
+        "partial sequence", genes) == ["rRNA"]
+    assert getqcdb.match_qc_genes(
+        "Lactobacillus sakei tuf gene for elongation factor Tu", genes
+        ) == ["tuf"]
+    assert getqcdb.match_qc_genes(
+        "Bacillus subtilis pheS gene for phenylalanine--tRNA ligase "
+        "alpha subunit", genes) == ["pheS"]
+    assert getqcdb.match_qc_genes(
+        "Lactobacillus curvatus recA gene, partial cds", genes) == ["recA"]
+    assert getqcdb.match_qc_genes(
+        "Lactobacillus curvatus dnaK gene, partial cds", ["rRNA"]) == []
+    assert getqcdb.match_qc_genes(
+        "Lactobacillus curvatus chromosome, complete genome", genes) == []
+
+
+def test_fasta_header():
+    assert getqcdb.fasta_header("AB123.1", "12345", "16S rRNA") == (
+        ">gi|12345|gb|AB123.1| 16S rRNA")
+    assert getqcdb.fasta_header("AB123.1", "N/A", "16S rRNA") == (
+        ">AB123.1 16S rRNA")
+
+
+def test_get_changes():
+    key = getqcdb.get_settings_key(["rRNA"], False)
+    assert key != getqcdb.get_settings_key(["rRNA"], True)
+    versions = {"nt.00": "a", "nt.01": "b"}
+    assert getqcdb.get_changes({}, versions, key) == (
+        ["nt.00", "nt.01"], [])
+    state = {"key": key, "volumes": {"nt.00": "a", "nt.01": "x", "nt.02": "c"}}
+    assert getqcdb.get_changes(state, versions, key) == (["nt.01"], ["nt.02"])
+    state.update({"key": "old"})
+    assert getqcdb.get_changes(state, versions, key) == (
+        ["nt.00", "nt.01"], [])
+
+
+def test_state():
+    prepare_tmpdir()
+    assert getqcdb.load_state(tmpdir) == {}
+    state = {
+        "source": "nt", "key": "k", "volumes": {"nt.00": "a"},
+        "complete": True}
+    getqcdb.save_state(tmpdir, state)
+    with open(os.path.join(tmpdir, getqcdb.statefile)) as f:
+        saved = json.load(f)
+    assert saved == getqcdb.load_state(tmpdir)
+    assert saved["version"] == state["version"]
+    getqcdb.save_state(tmpdir, dict(state, volumes={"nt.00": "b"}))
+    assert getqcdb.load_state(tmpdir)["version"] != state["version"]
+
+
+def test_up_to_date():
+    prepare_tmpdir()
+    with open(os.path.join(tmpdir, "nt.nsq"), "w") as f:
+        f.write("x")
+    qcdb_dir = getqcdb.get_qcdb_dir(tmpdir)
+    G.create_directory(qcdb_dir)
+    state = {
+        "source": "nt", "key": getqcdb.get_settings_key(["rRNA"], False),
+        "volumes": {"nt": getqcdb.volume_version(tmpdir, "nt")},
+        "databases": ["rRNA"], "complete": True}
+    getqcdb.save_state(qcdb_dir, state)
+    # nothing changed, no blastdbcmd run
+    assert getqcdb.build_qcdb(tmpdir, "nt", ["rRNA"]) == state
+    shutil.rmtree(tmpdir)
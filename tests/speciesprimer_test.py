@@ -6,6 +6,7 @@ import shutil
 import pytest
 import json
 import time
+import logging
 import csv
 import multiprocessing
 from Bio import SeqIO
@@ -145,11 +146,22 @@ def test_commandline():
     assert args.nolist is False
     assert args.offline is False
     assert args.path == '/'
+    assert args.preqc is False
+    assert args.annotation == "prokka"
+    assert args.pangenome == "keep"
+    assert args.dereplicate == 0.0
+    assert args.max_genomes == 0
+    assert args.annotation_cores == 0
+    assert args.prokka_cores == 4
+    assert args.prank_workers == 0
+    assert args.prank_timeout == 21600
+    assert args.prank_retries == 1
     assert args.probe is False
     assert args.qc_gene == ['rRNA']
     assert args.skip_download is False
     assert args.skip_tree is False
     assert args.target is None
+    assert args.jobs == 1
 
 
 def test_CLIconf(config):
@@ -340,10 +352,51 @@ def test_DataCollection(config, monkeypatch):
         filecont.sort()
         refcont.sort()
         assert filecont == refcont
+        for name in refcont:
+            assert DC.manifest.get_state(name) == "excluded"
+            assert DC.manifest.get_info(name) == "Max contigs"
 
         shutil.rmtree(DC.ex_dir)
         shutil.rmtree(DC.genomic_dir)
 
+    def test_genome_manifest(config):
+        from speciesprimer import GenomeManifest
+        DC = DataCollection(config)
+        for directory in [DC.genomic_dir, DC.gff_dir, DC.ffn_dir]:
+            G.create_directory(directory)
+        link = (
+            "https://ftp.ncbi.nlm.nih.gov/genomes/all/GCF/"
+            "GCF_000001.1_test_genomic.fna.gz")
+        assert GenomeManifest.genome_name(
+            "GCF_000001.1_test_genomic.fna.gz") == "GCF_000001v1"
+        assert GenomeManifest.get_accession(
+            "GCF_000001v1") == ("GCF_000001.1", 1)
+        DC.sync_manifest()
+        assert DC.check_download_files(link) is False
+        fna = os.path.join(DC.genomic_dir, "GCF_000001.1_test_genomic.fna")
+        with open(fna, "w") as f:
+            f.write(">contig\nATTAG\n")
+        DC.sync_manifest()
+        assert DC.check_download_files(link) == "Extracted"
+        for directory, ext in [[DC.gff_dir, ".gff"], [DC.ffn_dir, ".ffn"]]:
+            filepath = os.path.join(directory, "GCF_000001v1_20200101" + ext)
+            with open(filepath, "w") as f:
+                f.write("\n")
+        DC.sync_manifest()
+        assert DC.check_download_files(link) is True
+        # the manifest is kept between runs
+        manifest = GenomeManifest(DC.target_dir)
+        assert manifest.get_state("GCF_000001v1") == "annotated"
+        manifest.update("GCF_000001v1", "passed")
+        DC = DataCollection(config)
+        DC.sync_manifest()
+        assert DC.manifest.get_state("GCF_000001v1") == "passed"
+        assert DC.manifest.get_names("passed") == ["GCF_000001v1"]
+        for directory in [DC.genomic_dir, DC.gff_dir, DC.ffn_dir]:
+            shutil.rmtree(directory)
+        DC.sync_manifest()
+        assert DC.manifest.get_state("GCF_000001v1") is None
+
 
     def test_syn_exceptions(config):
         # standard case
@@ -409,7 +462,7 @@ def test_DataCollection(config, monkeypatch):
         import urllib.error
         import urllib.request
 
-        def mocked(url, data):
+        def mocked(url, data=None, timeout=None):
             raise urllib.error.HTTPError(url, 400, "Bad request", None, None)
 
         monkeypatch.setattr(urllib.request, "urlopen", mocked)
@@ -418,13 +471,17 @@ def test_DataCollection(config, monkeypatch):
             DC.ncbi_download()
 
     def test_ncbi_download(taxid, monkeypatch):
-        def mock_getsummary(db, term, retmax):
+        requests = []
+
+        def mock_getsummary(db, term, **kwargs):
+            requests.append(["esearch", kwargs])
             mockfile = os.path.join(
                     testfiles_dir, "entrezmocks", "getsummarymock.xml")
             f = open(mockfile)
             return f
 
-        def mock_getlinks(db, id, rettype, retmode):
+        def mock_getlinks(db, rettype, retmode, **kwargs):
+            requests.append(["efetch", kwargs])
             mockfile = os.path.join(
                     testfiles_dir, "entrezmocks", "getlinksmock.xml")
             f = open(mockfile)
@@ -433,7 +490,26 @@ def test_DataCollection(config, monkeypatch):
         monkeypatch.setattr(Entrez, "esearch", mock_getsummary)
         monkeypatch.setattr(Entrez, "efetch", mock_getlinks)
 
+        metadata = os.path.join(DC.config_dir, "assembly_metadata.json")
+        if os.path.isfile(metadata):
+            os.remove(metadata)
+        DC.get_ncbi_links(taxid, 1)
+        assert [r[0] for r in requests] == ["esearch", "efetch"]
+        assert requests[1][1]["id"] == ["4416701"]
+        # cached metadata is used until the ttl expires
+        DC.get_ncbi_links(taxid, 1)
+        assert len(requests) == 2
+        # afterwards only assemblies modified since the last update are
+        # fetched again
+        DC.metadata_ttl = 0
+        DC.entrez_delay = 0
         DC.get_ncbi_links(taxid, 1)
+        assert requests[3][1]["datetype"] == "mdat"
+        assert requests[-1] == ["efetch", {"id": ["4416701"]}]
+        DC.metadata_ttl = 24 * 60 * 60
+        DC.entrez_delay = 0.34
+        with open(os.path.join(DC.config_dir, "genomic_links.txt")) as f:
+            assert len(f.readlines()) == 1
         DC.ncbi_download()
         filepath = os.path.join(
             DC.target_dir, "genomic_fna",
@@ -484,6 +560,304 @@ def test_DataCollection(config, monkeypatch):
         G.create_directory(fna)
         os.chdir(config.path)
 
+    def test_create_taxidlist(monkeypatch):
+        searches = []
+
+        def mock_taxid(db, term):
+            searches.append(term)
+            mockfile = os.path.join(
+                    testfiles_dir, "entrezmocks", "esearchmock01.xml")
+            f = open(mockfile)
+            return f
+
+        monkeypatch.setattr(Entrez, "esearch", mock_taxid)
+        exception = DC.config.exception
+        DC.config.exception = ["Bacterium curvatum"]
+        taxidlist = DC.create_taxidlist("1578")
+        assert searches == ["Bacterium curvatum"]
+        with open(taxidlist) as f:
+            taxids = [line.strip() for line in f]
+        assert "1578" not in taxids
+        assert "28038" not in taxids
+        assert "2" in taxids
+        # the taxidlist is only created again if the exclusions change
+        mtime = os.path.getmtime(taxidlist)
+        DC.create_taxidlist("1578")
+        assert searches == ["Bacterium curvatum"]
+        assert os.path.getmtime(taxidlist) == mtime
+        DC.config.exception = exception
+        monkeypatch.undo()
+
+    def test_filter_assemblies():
+        meta = (
+            '<Stats> <Stat category="contig_count" sequence_tag="all">'
+            '{0}</Stat> <Stat category="contig_n50" sequence_tag="all">'
+            '{1}</Stat> </Stats>')
+        records = {
+            "link1": {
+                "AssemblyAccession": "GCF_000031.1",
+                "Meta": meta.format(101, 39114), "AnomalousList": [],
+                "ExclFromRefSeq": []},
+            "link2": {
+                "AssemblyAccession": "GCF_000032.1",
+                "Meta": meta.format(600, 2000), "AnomalousList": [],
+                "ExclFromRefSeq": []},
+            "link3": {
+                "AssemblyAccession": "GCF_000033.2",
+                "Meta": meta.format(10, 2000000),
+                "AnomalousList": [{"Reason": "fragmented assembly"}],
+                "ExclFromRefSeq": []},
+            "link4": {
+                "AssemblyAccession": "GCF_000034.1",
+                "Meta": meta.format(10, 2000000), "AnomalousList": [],
+                "ExclFromRefSeq": ["from large multi-isolate project"]}}
+        DC.link_records = records
+        stats = DC.get_assembly_stats(records["link1"])
+        assert stats == {"contig_count": 101, "contig_n50": 39114}
+        links = ["link1", "link2", "link3", "link4", "link5"]
+        assert DC.filter_assemblies(links) == ["link1", "link4", "link5"]
+        excluded = []
+        with open(os.path.join(DC.ex_dir, "excluded_list.txt")) as f:
+            for line in f:
+                excluded.append(line.strip())
+        assert excluded == ["GCF_000032v1", "GCF_000033v2"]
+        assert DC.manifest.get_state("GCF_000034v1") is None
+        assert DC.manifest.get_state("GCF_000033v2") == "excluded"
+        DC.config.ignore_qc = True
+        assert DC.filter_assemblies(links) == links
+        DC.config.ignore_qc = False
+        DC.link_records = {}
+        shutil.rmtree(DC.ex_dir)
+        DC.sync_manifest()
+
+    def test_get_prokka_version(monkeypatch):
+        bin_dir = os.path.join(tmpdir, "bin")
+        G.create_directory(bin_dir)
+        prokka = os.path.join(bin_dir, "prokka")
+        with open(prokka, "w") as f:
+            # prokka writes the version to stderr
+            f.write("#!/bin/sh\necho 'prokka 1.14.6' >&2\n")
+        os.chmod(prokka, 0o755)
+        monkeypatch.setenv("PATH", bin_dir + os.pathsep + os.environ["PATH"])
+        assert DC.get_prokka_version() == "1.14.6"
+        monkeypatch.setenv("PATH", bin_dir)
+        os.remove(prokka)
+        assert DC.get_prokka_version() is None
+        assert DC.get_annotation_cache() is None
+        monkeypatch.undo()
+        shutil.rmtree(bin_dir)
+
+    def test_schedule_prokka(monkeypatch):
+        G.create_directory(DC.genomic_dir)
+        jobs = []
+        for i, size in enumerate([10, 300, 20]):
+            fna = "GCF_00000" + str(i) + ".1_test_genomic.fna"
+            with open(os.path.join(DC.genomic_dir, fna), "w") as f:
+                f.write(">contig\n" + size * "A" + "\n")
+            jobs.append(["GCF_00000" + str(i) + "v1", fna])
+        started = []
+
+        def mock_prokka(filename, fna, cpus, date):
+            started.append([filename, cpus])
+            return filename + "_" + date, True, 0.1
+
+        monkeypatch.setattr(DC, "start_prokka", mock_prokka)
+        DC.annotation_cores = 8
+        DC.prokka_cores = 4
+        annotation_dirs = DC.schedule_prokka(jobs)
+        assert len(annotation_dirs) == 3
+        assert started[0] == ["GCF_000001v1", 4]
+        assert DC.manifest.get_state("GCF_000001v1") == "annotated"
+        DC.annotation_cores = 8
+        DC.prokka_cores = 2
+        started.clear()
+        DC.schedule_prokka(jobs[0:1])
+        assert started == [["GCF_000000v1", 8]]
+        # failed annotations are removed and not registered as annotated
+        date = time.strftime("%Y%m%d")
+        outdir = os.path.join(DC.target_dir, "GCF_000002v1_" + date)
+
+        def mock_failed(filename, fna, cpus, date):
+            G.create_directory(os.path.join(
+                DC.target_dir, filename + "_" + date))
+            return filename + "_" + date, False, 0.1
+
+        monkeypatch.setattr(DC, "start_prokka", mock_failed)
+        DC.manifest.update("GCF_000002v1", "extracted")
+        assert DC.schedule_prokka(jobs[2:3]) == []
+        assert DC.manifest.get_state("GCF_000002v1") == "extracted"
+        assert os.path.isdir(outdir) is False
+        from speciesprimer import errors
+        assert "Prokka annotation failed" in errors[-1][1]
+        errors.remove(errors[-1])
+        # pending jobs are cancelled when a job raises an exception
+        started.clear()
+
+        def mock_missing(filename, fna, cpus, date):
+            started.append(filename)
+            raise FileNotFoundError("prokka")
+
+        monkeypatch.setattr(DC, "start_prokka", mock_missing)
+        DC.annotation_cores = 1
+        DC.prokka_cores = 1
+        with pytest.raises(FileNotFoundError):
+            DC.schedule_prokka(jobs)
+        assert DC.prokka_processes.stopped is True
+        count = len(started)
+        time.sleep(0.2)
+        assert len(started) == count
+        monkeypatch.undo()
+        for job in jobs:
+            os.remove(os.path.join(DC.genomic_dir, job[1]))
+        DC.sync_manifest()
+
+    def test_annotation_cache(monkeypatch):
+        from speciesprimer import AnnotationCache
+        G.create_directory(DC.genomic_dir)
+        for directory in [DC.gff_dir, DC.ffn_dir, DC.fna_dir]:
+            G.create_directory(directory)
+        cachedir = os.path.join(tmpdir, "annotationcache")
+        if os.path.isdir(cachedir):
+            shutil.rmtree(cachedir)
+        outdir = os.path.join(DC.target_dir, "GCF_000010v1_20200101")
+        G.create_directory(outdir)
+        fna = "GCF_000010.1_test_genomic.fna"
+        with open(os.path.join(DC.genomic_dir, fna), "w") as f:
+            f.write(">contig\nATTAGATTAG\n")
+        for ext in AnnotationCache.extensions:
+            with open(os.path.join(
+                    outdir, "GCF_000010v1_20200101." + ext), "w") as f:
+                f.write(ext + " annotation\n")
+
+        DC.annotation_settings = ["1.14.6", "Lactobacillus"]
+        DC.annotation_keys = {}
+        cache = AnnotationCache(cachedir, 1024)
+        jobs = [["GCF_000010v1", fna]]
+        assert DC.fetch_annotations(cache, jobs) == jobs
+        DC.store_annotation(
+            cache, "GCF_000010v1", fna, "GCF_000010v1_20200101")
+        assert DC.fetch_annotations(cache, jobs) == []
+        date = time.strftime("%Y%m%d")
+        gff = os.path.join(DC.gff_dir, "GCF_000010v1_" + date + ".gff")
+        with open(gff) as f:
+            assert f.read() == "gff annotation\n"
+        assert DC.manifest.get_state("GCF_000010v1") == "annotated"
+        # another Prokka version is a cache miss
+        DC.annotation_keys = {}
+        DC.annotation_settings = ["1.14.5", "Lactobacillus"]
+        assert DC.fetch_annotations(cache, jobs) == jobs
+        # least recently used entries are evicted above the size cap
+        cache.max_size = 0
+        assert len(cache.evict()) == 1
+        DC.annotation_keys = {}
+        DC.annotation_settings = ["1.14.6", "Lactobacillus"]
+        assert DC.fetch_annotations(cache, jobs) == jobs
+        # only successful Prokka runs are stored, not partial output
+        cache.max_size = 1024
+        status = []
+
+        def mock_prokka(filename, fna, cpus, date):
+            prokka_dir = os.path.join(DC.target_dir, filename + "_" + date)
+            G.create_directory(prokka_dir)
+            for ext in AnnotationCache.extensions:
+                with open(os.path.join(
+                        prokka_dir, filename + "_" + date + "." + ext),
+                        "w") as f:
+                    f.write(ext + " annotation\n")
+            return filename + "_" + date, status[-1], 0.1
+
+        monkeypatch.setattr(DC, "start_prokka", mock_prokka)
+        status.append(False)
+        DC.schedule_prokka(jobs, cache)
+        assert DC.fetch_annotations(cache, jobs) == jobs
+        from speciesprimer import errors
+        errors.remove(errors[-1])
+        status.append(True)
+        DC.schedule_prokka(jobs, cache)
+        assert DC.fetch_annotations(cache, jobs) == []
+        monkeypatch.undo()
+        shutil.rmtree(os.path.join(DC.target_dir, "GCF_000010v1_" + date))
+        cache.close()
+        shutil.rmtree(cachedir)
+        shutil.rmtree(outdir)
+        for directory in [DC.gff_dir, DC.ffn_dir, DC.fna_dir]:
+            shutil.rmtree(directory)
+        os.remove(os.path.join(DC.genomic_dir, fna))
+        DC.sync_manifest()
+
+    def test_ncbi_annotation():
+        import gzip
+        from speciesprimer import NCBIAnnotation, QualityControl
+        link = (
+            "https://ftp.ncbi.nlm.nih.gov/genomes/all/GCF/000/000/010/"
+            "GCF_000010.1_test/GCF_000010.1_test_genomic.fna.gz")
+        assert NCBIAnnotation.get_links(link) == [
+            link.replace("_genomic.fna.gz", "_genomic.gff.gz"),
+            link.replace("_genomic.fna.gz", "_cds_from_genomic.fna.gz")]
+        G.create_directory(DC.genomic_dir)
+        G.create_directory(DC.ncbi_annotation_dir)
+        fna = "GCF_000010.1_test_genomic.fna"
+        contig = "ATGAAAGGC" * 20 + "TTTTTCCCCC" * 6 + "GGGAAA" * 10
+        with open(os.path.join(DC.genomic_dir, fna), "w") as f:
+            f.write(">NZ_TEST01.1 Lactobacillus curvatus\n" + contig + "\n")
+        gff_rows = [
+            ["gene", "1", "90", "+", "ID=gene-T_RS1;locus_tag=T_RS1"],
+            ["CDS", "1", "90", "+",
+                "ID=cds-WP_1;Parent=gene-T_RS1;gene=dnaK;"
+                "locus_tag=T_RS1;product=molecular chaperone DnaK"],
+            ["CDS", "91", "120", "+",
+                "ID=cds-T_RS2;locus_tag=T_RS2;pseudo=true;product=IS30"],
+            ["rRNA", "181", "240", "-",
+                "ID=rna-T_RS3;locus_tag=T_RS3;product=16S ribosomal RNA"],
+            ["CDS", "241", "270", "+",
+                "ID=cds-WP_4;locus_tag=T_RS4;product=DUF1%2C protein"],
+            ["CDS", "270", "300", "+",
+                "ID=cds-WP_4;locus_tag=T_RS4;product=DUF1%2C protein"]]
+        gz_gff = os.path.join(
+            DC.ncbi_annotation_dir, "GCF_000010.1_test_genomic.gff.gz")
+        with gzip.open(gz_gff, "wt") as f:
+            f.write("##gff-version 3\n")
+            for ftype, start, end, strand, attributes in gff_rows:
+                f.write("\t".join([
+                    "NZ_TEST01.1", "RefSeq", ftype, start, end, ".", strand,
+                    "0", attributes]) + "\n")
+        gz_cds = os.path.join(
+            DC.ncbi_annotation_dir,
+            "GCF_000010.1_test_cds_from_genomic.fna.gz")
+        with gzip.open(gz_cds, "wt") as f:
+            f.write(
+                ">lcl|NZ_TEST01.1_cds_WP_1_1 [gene=dnaK] [locus_tag=T_RS1]\n"
+                + contig[0:90] + "\n"
+                ">lcl|NZ_TEST01.1_cds_WP_4_2 [locus_tag=T_RS4]\n"
+                + contig[240:300] + "\n")
+        jobs = [["GCF_000010v1", fna], ["GCF_000020v1", "GCF_000020.fna"]]
+        annotation_dirs, remaining = DC.use_ncbi_annotation(jobs)
+        assert remaining == [["GCF_000020v1", "GCF_000020.fna"]]
+        date = time.strftime("%Y%m%d")
+        assert annotation_dirs == ["GCF_000010v1_" + date]
+        outfile = os.path.join(
+            DC.target_dir, annotation_dirs[0], annotation_dirs[0])
+        with open(outfile + ".ffn") as f:
+            ffn = f.read().splitlines()
+        assert ffn[0] == ">GCF_000010v1_00001 Chaperone protein DnaK"
+        assert ffn[3] == ">GCF_000010v1_00002 16S ribosomal RNA"
+        assert ffn[4] == "GGGGGAAAAA" * 6
+        assert ffn[5] == ">GCF_000010v1_00003 DUF1, protein"
+        index = QualityControl.index_gff(
+            outfile + ".gff", QualityControl.searchdict)[1]
+        assert index["dnaK"] == ["GCF_000010v1_00001"]
+        assert index["rRNA"] == ["GCF_000010v1_00002"]
+        with open(outfile + ".gff") as f:
+            gff = f.read()
+        assert "\t241\t300\t" in gff
+        assert "product=DUF1%2C protein" in gff
+        assert gff.split("##FASTA\n")[1].startswith(">NZ_TEST01.1\n")
+        assert DC.manifest.get_state("GCF_000010v1") == "annotated"
+        shutil.rmtree(os.path.join(DC.target_dir, annotation_dirs[0]))
+        shutil.rmtree(DC.ncbi_annotation_dir)
+        os.remove(os.path.join(DC.genomic_dir, fna))
+        DC.sync_manifest()
+
     def prepare_prokka(config):
         targetdir = os.path.join(config.path, config.target)
         fileformat = ["fna", "gff", "ffn"]
@@ -516,7 +890,14 @@ def test_DataCollection(config, monkeypatch):
 
     test_get_email_from_config(config)
     test_maxcontigs(config)
+    test_genome_manifest(config)
     DC.prepare_dirs()
+    test_create_taxidlist(monkeypatch)
+    test_filter_assemblies()
+    test_get_prokka_version(monkeypatch)
+    test_schedule_prokka(monkeypatch)
+    test_annotation_cache(monkeypatch)
+    test_ncbi_annotation()
     test_get_taxid(config.target, monkeypatch)
     test_ncbi_download("28038", monkeypatch)
     test_syn_exceptions(config)
@@ -657,6 +1038,30 @@ def test_QualityControl(config):
         assert len(QC.qc_gene_search) == 12
         return gff
 
+    def test_build_qc_index(gff):
+        indexfile = os.path.join(QC.config_dir, "qc_gene_index.json")
+        assert os.path.isfile(indexfile)
+        index = QC.build_qc_index(gff)
+        assert sorted(index.keys()) == sorted(gff)
+        for file_name in gff:
+            filepath = os.path.join(QC.gff_dir, file_name)
+            assert index[file_name] == QC.index_gff(
+                filepath, QC.searchdict)[1]
+        # results are read from the cache while the gff files are unchanged
+        with open(indexfile) as f:
+            cached = json.load(f)
+        name = gff[0]
+        cached[name]["genes"][qc_gene] = ["cached_00001"]
+        with open(indexfile, "w") as f:
+            json.dump(cached, f)
+        QC.qc_index = {}
+        assert QC.build_qc_index(gff)[name][qc_gene] == ["cached_00001"]
+        filepath = os.path.join(QC.gff_dir, name)
+        stat = os.stat(filepath)
+        os.utime(filepath, (stat.st_atime, stat.st_mtime + 1))
+        QC.qc_index = {}
+        assert QC.build_qc_index(gff)[name][qc_gene] != ["cached_00001"]
+
     def test_count_contigs(gff_list, contiglimit):
         gff_list = QC.count_contigs(gff_list, contiglimit)
         gff_list.sort()
@@ -675,6 +1080,23 @@ def test_QualityControl(config):
             'GCF_noseq_date.gff']
         return gff_list
 
+    def test_accession_index():
+        from speciesprimer import AccessionIndex
+        assert AccessionIndex.parse("GCF_004088235v12") == (
+            "GCF", "004088235", 12)
+        assert AccessionIndex.parse("GCF_noseq") is None
+        index = AccessionIndex([
+            "GCF_004088235v1", "GCF_004088235v3", "GCF_004088235v2",
+            "GCA_004088235v1", "GCF_noseq", "myv2"])
+        assert index.older_versions() == set([
+            "GCF_004088235v1", "GCF_004088235v2"])
+        assert index.lookup("GCF_004088235v2_20191001.ffn.fai") == (
+            "GCF_004088235v2")
+        assert index.lookup(
+            "GCF_004088235.1_ASM408823v1_genomic.fna.gz") == "GCF_004088235v1"
+        assert index.lookup("GCF_noseq_20191001") == "GCF_noseq"
+        assert index.lookup("GCF_004088235v4_20191001.gff") is None
+
     def test_check_no_sequence(qc_gene, gff):
         ffn = QC.check_no_sequence(qc_gene, gff)
         assert ffn == ['GCF_004088235v2_20191001.ffn']
@@ -741,6 +1163,192 @@ def test_QualityControl(config):
             passed = QC.qc_blast_parser(qc_gene)
         assert os.path.isfile(errfile) is False
 
+    def test_dedup_qc_seqs():
+        QC_dedup = QualityControl(QC.config)
+        unique = QC_dedup.dedup_qc_seqs([
+            ["GCF_1v1_00001", "ATGC"], ["GCF_2v1_00001", "ATGC"],
+            ["GCF_3v1_00001", "ATGG"]])
+        assert list(unique.values()) == [
+            ["GCF_1v1_00001", "ATGC"], ["GCF_3v1_00001", "ATGG"]]
+        assert QC_dedup.qc_queries == {
+            "GCF_1v1_00001": ["GCF_1v1_00001", "GCF_2v1_00001"],
+            "GCF_3v1_00001": ["GCF_3v1_00001"]}
+
+    def test_qc_cache():
+        from types import SimpleNamespace
+        from speciesprimer import QCCache
+        db_dir = os.path.join(tmpdir, "qccache")
+        G.create_directory(db_dir)
+        conf = SimpleNamespace(customdb=os.path.join(db_dir, "testdb"))
+        assert QCCache.get_db_version(conf) is None
+        with open(conf.customdb + ".nsq", "w") as f:
+            f.write("testdb")
+        version = QCCache.get_db_version(conf)
+        assert version[0] == "testdb"
+        cache_file = os.path.join(db_dir, "qc_classification.db")
+        cache = QCCache(cache_file, 2, version, ["2", "1"])
+        seq_hash = QualityControl.sequence_hash("ATGC")
+        key = cache.get_key("tuf", seq_hash)
+        assert cache.get([key]) == {}
+        cache.store([[key, "1234", "NR_1", "Lactobacillus curvatus"]])
+        assert cache.get([key]) == {
+            key: ["1234", "NR_1", "Lactobacillus curvatus"]}
+        # other excluded GIs are a cache miss
+        other = QCCache(cache_file, 2, version, ["1"])
+        assert other.get_key("tuf", seq_hash) != key
+        other.close()
+        # targets with other excluded taxids do not share entries
+        QC.config.blastdbv5 = True
+        keyfile = os.path.join(QC.config_dir, "taxidlist.key")
+        taxidlist = os.path.join(QC.config_dir, "taxidlist.txt")
+        with open(taxidlist, "w") as f:
+            f.write("1\n")
+        filters = []
+        for exclude in ["28038", "28038 1588"]:
+            with open(keyfile, "w") as f:
+                f.write("1.0 " + exclude)
+            filters.append(QC.get_taxid_filter())
+        os.remove(keyfile)
+        os.remove(taxidlist)
+        QC.config.blastdbv5 = False
+        assert filters[0] != filters[1]
+        target_a = QCCache(cache_file, 2, version, ["2", "1"], filters[0])
+        target_b = QCCache(cache_file, 2, version, ["2", "1"], filters[1])
+        key_a = target_a.get_key("tuf", seq_hash)
+        target_a.store([[key_a, "1234", "NR_1", "Lactobacillus curvatus"]])
+        assert target_b.get([target_b.get_key("tuf", seq_hash)]) == {}
+        assert key != key_a
+        target_a.close()
+        target_b.close()
+        cache.close()
+        # a BLAST DB update (new md5 files) removes the old entries
+        G.create_directory(os.path.join(db_dir, "md5_files"))
+        with open(os.path.join(
+                db_dir, "md5_files", "testdb.00.tar.gz.md5"), "w") as f:
+            f.write("d41d8cd98f00b204e9800998ecf8427e  testdb.00.tar.gz\n")
+        new_version = QCCache.get_db_version(conf)
+        assert new_version != version
+        cache = QCCache(cache_file, 2, new_version, ["1", "2"])
+        assert cache.conn.execute(
+            "SELECT COUNT(*) FROM qc_hits").fetchone()[0] == 0
+        # least recently used entries are evicted above max_entries
+        keys = [cache.get_key("tuf", str(i)) for i in range(3)]
+        cache.store([[key, "1", "NR_1", "species"] for key in keys])
+        assert len(cache.get(keys)) == 2
+        cache.close()
+        shutil.rmtree(db_dir)
+
+    def test_preqc_hits():
+        from speciesprimer import PreAnnotationQC
+        hits = os.path.join(tmpdir, "preqc_hits.tsv")
+        with open(hits, "w") as f:
+            f.write("tuf_1\tcontig_1\t1\t8\t3\t10\t10\t12.5\n")
+            f.write("tuf_2\tcontig_2\t2\t9\t20\t13\t10\t14.0\n")
+            f.write("rRNA_1\tcontig_1\t1\t10\t1\t10\t10\t18.2\n")
+        assert PreAnnotationQC.best_hits(hits) == {
+            "tuf": ["contig_2", 2, 9, 20, 13, 10],
+            "rRNA": ["contig_1", 1, 10, 1, 10, 10]}
+        contig = "AACCGGTTAAACCCGGGTTT"
+        # the hit is extended to the reference length
+        assert PreAnnotationQC.extract_region(
+            contig, [1, 8, 3, 10, 10]) == "CCGGTTAAAC"
+        # minus strand hit, clipped at the contig end
+        assert PreAnnotationQC.extract_region(
+            contig, [2, 9, 20, 13, 10]) == "AAACCCGGG"
+        os.remove(hits)
+
+    def test_reuse_qc_results():
+        # a rerun only needs QC for new and changed genomes
+        import copy
+        inc_config = copy.copy(QC.config)
+        inc_config.path = os.path.join(tmpdir, "incremental")
+        QC_first = QualityControl(inc_config)
+        qc_dir = os.path.join(QC_first.target_dir, qc_gene + "_QC")
+        G.create_directory(qc_dir)
+        G.create_directory(QC_first.gff_dir)
+        names = ["GCF_1v1", "GCF_2v1", "GCF_3v1", "GCF_4v1"]
+        gff = {
+            name: os.path.join(QC_first.gff_dir, name + "_20200101.gff")
+            for name in names}
+        for name in names[0:3]:
+            with open(gff[name], "w") as f:
+                f.write(name)
+        inputs = {name: gff[name] for name in names[0:3]}
+        assert QC_first.reuse_qc_results(qc_gene, inputs) == names[0:3]
+        expected = "Lactobacillus curvatus"
+        QC_first.passed = [
+            [name + "_00010", "1", "NR_1", expected, expected, "passed QC"]
+            for name in names[0:2]]
+        QC_first.problems = [[
+            "GCF_3v1_00010", "2", "NR_2", "Lactobacillus sakei", expected,
+            "failed QC"]]
+        G.csv_writer(
+            os.path.join(qc_dir, qc_gene + "_QC_report.csv"),
+            QC_first.passed + QC_first.problems,
+            ["Query", "GI", "DB ID", "Species", "Target species",
+             "QC status"])
+        QC_first.save_qc_state(qc_gene)
+        # GCF_3v1 was excluded, GCF_4v1 is new and GCF_2v1 changed
+        os.remove(gff["GCF_3v1"])
+        with open(gff["GCF_4v1"], "w") as f:
+            f.write("GCF_4v1")
+        with open(gff["GCF_2v1"], "a") as f:
+            f.write("changed")
+        inputs = {
+            name: gff[name] for name in ["GCF_1v1", "GCF_2v1", "GCF_4v1"]}
+        QC_rerun = QualityControl(inc_config)
+        assert QC_rerun.reuse_qc_results(qc_gene, inputs) == [
+            "GCF_2v1", "GCF_4v1"]
+        assert QC_rerun.passed == QC_first.passed[0:1]
+        assert QC_rerun.qc_history == QC_first.problems
+        # other settings, QC of all genomes
+        inc_config.exception = ["Lactobacillus_sakei"]
+        QC_settings = QualityControl(inc_config)
+        assert QC_settings.reuse_qc_results(qc_gene, inputs) == list(inputs)
+        shutil.rmtree(inc_config.path)
+
+    def test_qc_blast_parser_records():
+        # BLAST records of a combined QC search give the same QC report
+        from speciesprimer import BlastParser
+        qc_dir = os.path.join(QC.target_dir, qc_gene + "_QC")
+        report = os.path.join(qc_dir, qc_gene + "_QC_report.csv")
+        backup = os.path.join(tmpdir, "qc_backup")
+        G.create_directory(backup)
+        blapa = BlastParser(QC.config)
+        records = []
+        for filename in blapa.blastresult_files(qc_dir):
+            records.extend(blapa.parse_BLASTfile(filename))
+        for files in os.listdir(qc_dir):
+            shutil.move(os.path.join(qc_dir, files), backup)
+        shutil.copy(os.path.join(backup, qc_gene + "_seq"), qc_dir)
+        QC_records = QualityControl(QC.config)
+        QC_records.no_seq = list(QC.no_seq)
+        QC_records.contig_ex = list(QC.contig_ex)
+        QC_records.double = list(QC.double)
+        passed = QC_records.qc_blast_parser(qc_gene, records)
+        assert passed == [[
+            'GCF_004088235v2_00210', '343201711',
+            'NR_042437', 'Lactobacillus curvatus',
+            'Lactobacillus curvatus', 'passed QC']]
+        with open(report) as f:
+            combined_report = f.read()
+        os.remove(report)
+        # genomes with the same sequence get the result of one query
+        shutil.copy(os.path.join(backup, qc_gene + "_seq"), qc_dir)
+        QC_fanout = QualityControl(QC.config)
+        QC_fanout.qc_queries = {'GCF_004088235v2_00210': [
+            'GCF_004088235v2_00210', 'GCF_000000001v1_00210']}
+        passed = QC_fanout.qc_blast_parser(qc_gene, records)
+        assert [row[0] for row in passed] == [
+            'GCF_004088235v2_00210', 'GCF_000000001v1_00210']
+        assert passed[0][1:] == passed[1][1:]
+        os.remove(report)
+        for files in os.listdir(backup):
+            shutil.move(
+                os.path.join(backup, files), os.path.join(qc_dir, files))
+        shutil.rmtree(backup)
+        return combined_report
+
     def qc_blast_fail(qc_gene):
         qc_dir = os.path.join(QC.target_dir, qc_gene + "_QC")
         if os.path.isdir(qc_dir):
@@ -833,10 +1441,16 @@ def test_QualityControl(config):
 
     test_get_excluded_gis()
     gff_list = test_search_qc_gene()
+    test_build_qc_index(gff_list)
     gff_list = test_count_contigs(gff_list, QC.contiglimit)
     gff = test_identify_duplicates(gff_list)
+    test_accession_index()
     ffn_list = test_check_no_sequence(qc_gene, gff)
     qc_seqs = test_choose_sequence(qc_gene)
+    test_dedup_qc_seqs()
+    test_qc_cache()
+    test_preqc_hits()
+    test_reuse_qc_results()
     qc_blast(qc_gene)
     test_qc_blast_parser()
     if os.path.isdir(QC.ex_dir):
@@ -855,7 +1469,11 @@ def test_QualityControl(config):
     ffn_list = test_check_no_sequence(qc_gene, gff)
     qc_seqs = test_choose_sequence(qc_gene)
     qc_blast(qc_gene)
+    combined_report = test_qc_blast_parser_records()
     test_qc_blast_parser(gi_list=True)
+    with open(os.path.join(
+            QC.target_dir, qc_gene + "_QC", qc_gene + "_QC_report.csv")) as f:
+        assert f.read() == combined_report
     if os.path.isdir(QC.ex_dir):
         shutil.rmtree(QC.ex_dir)
     prepare_QC_testfiles(config)
@@ -897,6 +1515,175 @@ def test_skip_pangenome_analysis(config):
             "-cd", "100", "-e", "-n", "./gff_files/*.gff"]
 
 
+def test_GenomeDereplication(config):
+    import copy
+    import random
+    from Bio.Seq import Seq
+    from speciesprimer import GenomeDereplication
+    from speciesprimer import PangenomeAnalysis
+    random.seed(2)
+
+    def random_seq(length):
+        return "".join(random.choice("ACGT") for i in range(length))
+
+    def mutate(seq, count):
+        seq = list(seq)
+        for i in random.sample(range(len(seq)), count):
+            seq[i] = random.choice("ACGT".replace(seq[i], ""))
+        return "".join(seq)
+
+    # canonical k-mers, k-mers with N are skipped
+    seq = random_seq(200)
+    revcomp = str(Seq(seq).reverse_complement())
+    hashes = GenomeDereplication.kmer_hashes(seq.encode(), 21)
+    assert len(hashes) == 180
+    assert sorted(hashes.tolist()) == sorted(GenomeDereplication.kmer_hashes(
+        revcomp.encode(), 21).tolist())
+    assert len(GenomeDereplication.kmer_hashes(b"ACGTN" * 10, 5)) == 0
+    assert len(GenomeDereplication.kmer_hashes(b"acgtacgtac", 5)) == 6
+
+    derep_config = copy.copy(config)
+    derep_config.path = os.path.join(tmpdir, "dereplication")
+    derep_config.dereplicate = 0.01
+    derep_config.max_genomes = 0
+    GD = GenomeDereplication(derep_config)
+    G.create_directory(GD.gff_dir)
+    G.create_directory(GD.fna_dir)
+    base = random_seq(200000)
+    genomes = {
+        "GCF_1v1_20200101": base,
+        "GCF_2v1_20200101": mutate(base, 20),
+        "GCF_3v1_20200101": mutate(base, 40),
+        "GCF_4v1_20200101": random_seq(200000)}
+    for name, seq in genomes.items():
+        with open(os.path.join(GD.gff_dir, name + ".gff"), "w") as f:
+            f.write("##gff-version 3\n")
+        with open(os.path.join(GD.fna_dir, name + ".fna"), "w") as f:
+            f.write(">contig_1\n" + seq[0:120000] + "\n")
+            f.write(">contig_2\n" + seq[120000:] + "\n")
+    GD.run_dereplication()
+    with open(GD.report) as f:
+        reader = csv.reader(f)
+        next(reader)
+        status = {row[0]: [row[1], row[3]] for row in reader}
+    assert status == {
+        "GCF_1v1_20200101": ["GCF_1v1_20200101", "representative"],
+        "GCF_2v1_20200101": ["GCF_1v1_20200101", "dropped"],
+        "GCF_3v1_20200101": ["GCF_1v1_20200101", "dropped"],
+        "GCF_4v1_20200101": ["GCF_4v1_20200101", "representative"]}
+    PA = PangenomeAnalysis(derep_config)
+    assert PA.get_input_files() == [
+        "GCF_1v1_20200101.gff", "GCF_4v1_20200101.gff"]
+    # the dropped genomes are kept
+    assert len(os.listdir(GD.fna_dir)) == 4
+    # representatives and the most distant genome
+    derep_config.max_genomes = 3
+    GD.run_dereplication()
+    assert PA.get_input_files() == [
+        "GCF_1v1_20200101.gff", "GCF_3v1_20200101.gff",
+        "GCF_4v1_20200101.gff"]
+    derep_config.dereplicate = 0.0
+    GD.run_dereplication()
+    assert len(PA.get_input_files()) == 4
+    assert not os.path.isfile(GD.selection_file)
+    shutil.rmtree(derep_config.path)
+
+
+def test_update_pangenome(config, monkeypatch):
+    import copy
+    import random
+    from speciesprimer import PangenomeAnalysis
+    random.seed(1)
+
+    def random_cds(length):
+        # no stop codons without T
+        return "ATG" + "".join(
+            random.choice("ACG") for i in range(length * 3)) + "TAA"
+
+    inc_config = copy.copy(config)
+    inc_config.path = os.path.join(tmpdir, "pangenome_update")
+    inc_config.pangenome = "incremental"
+    inc_config.intermediate = False
+    PA = PangenomeAnalysis(inc_config)
+    for directory in [PA.gff_dir, PA.ffn_dir, PA.pangenome_dir]:
+        G.create_directory(directory)
+    core = random_cds(100)
+    accessory = random_cds(80)
+    new_gene = random_cds(120)
+    paralog = new_gene[0:30] + "C" + new_gene[31:]
+    if new_gene[30] == "C":
+        paralog = new_gene[0:30] + "G" + new_gene[31:]
+    header = [
+        "Gene", "Non-unique Gene name", "Annotation", "No. isolates",
+        "No. sequences", "Avg sequences per isolate", "Genome Fragment",
+        "Order within Fragment", "Accessory Fragment",
+        "Accessory Order with Fragment", "QC", "Min group size nuc",
+        "Max group size nuc", "Avg group size nuc",
+        "GCF_1v1_20200101", "GCF_2v1_20200101"]
+    rows = [
+        ["coreA", "", "core protein", "2", "2", "1", "1", "1", "", "", "",
+         "306", "306", "306", "GCF_1v1_00001", "GCF_2v1_00001"],
+        ["group_5", "", "hypothetical protein", "2", "2", "1", "1", "2",
+         "", "", "", "246", "300", "273", "GCF_1v1_00002", "GCF_2v1_00002"]]
+    G.csv_writer(PA.pangenome_file, rows, header)
+    with open(PA.reference_file, "w") as f:
+        f.write(">GCF_1v1_00001 coreA\n" + core + "\n")
+        f.write(">GCF_1v1_00002 group_5\n" + accessory + "\n")
+    # GCF_2v1 was removed and GCF_3v1 is new
+    with open(os.path.join(PA.gff_dir, "GCF_1v1_20200101.gff"), "w") as f:
+        f.write("##gff-version 3\n")
+    with open(os.path.join(PA.ffn_dir, "GCF_1v1_20200101.ffn"), "w") as f:
+        f.write(">GCF_1v1_00001 core protein\n" + core + "\n")
+        f.write(">GCF_1v1_00002 hypothetical protein\n" + accessory + "\n")
+    with open(os.path.join(PA.gff_dir, "GCF_3v1_20200101.gff"), "w") as f:
+        f.write("##gff-version 3\n")
+        for i in range(1, 4):
+            f.write(
+                "contig_1\tProdigal:2.6\tCDS\t1\t10\t.\t+\t0\t"
+                "ID=GCF_3v1_0000" + str(i) + ";product=protein%2C "
+                + str(i) + "\n")
+    with open(os.path.join(PA.ffn_dir, "GCF_3v1_20200101.ffn"), "w") as f:
+        f.write(">GCF_3v1_00001 core protein\n" + core + "\n")
+        f.write(">GCF_3v1_00002 protein, 2\n" + new_gene + "\n")
+        f.write(">GCF_3v1_00003 protein, 3\n" + paralog + "\n")
+    assert PA.read_cds(os.path.join(PA.gff_dir, "GCF_3v1_20200101.gff"))[
+        1] == ["GCF_3v1_00002", "protein, 2"]
+    assert PA.format_average(1.0) == "1"
+    assert PA.format_average(21 / 20) == "1.05"
+    G.create_directory(os.path.join(PA.pangenome_dir, "results"))
+
+    assert PA.run_pangenome_analysis() == 0
+    with open(PA.pangenome_file) as f:
+        reader = csv.reader(f)
+        assert next(reader)[14:] == ["GCF_1v1_20200101", "GCF_3v1_20200101"]
+        result = [row for row in reader]
+    # group sizes without the removed genome GCF_2v1
+    assert result == [
+        ["coreA", "", "core protein", "2", "2", "1", "1", "1", "", "", "",
+         "306", "306", "306", "GCF_1v1_00001", "GCF_3v1_00001"],
+        ["group_5", "", "hypothetical protein", "1", "1", "1", "1", "2",
+         "", "", "", "246", "246", "246", "GCF_1v1_00002", ""],
+        ["group_6", "", "protein, 2", "1", "2", "2", "", "", "", "", "",
+         "366", "366", "366", "", "GCF_3v1_00002\tGCF_3v1_00003"]]
+    # the core genes of the old pan-genome are removed
+    assert not os.path.isdir(os.path.join(PA.pangenome_dir, "results"))
+    assert not os.path.isdir(PA.update_dir)
+    # no new genomes
+    assert PA.run_pangenome_analysis() == 2
+    # without pan_genome_reference.fa Roary runs with all genomes
+    os.remove(PA.reference_file)
+    with open(os.path.join(PA.gff_dir, "GCF_4v1_20200101.gff"), "w") as f:
+        f.write("##gff-version 3\n")
+    calls = []
+    monkeypatch.setattr(PA, "run_roary", lambda: calls.append("roary"))
+    monkeypatch.setattr(PA, "run_fasttree", lambda: calls.append("tree"))
+    assert PA.run_pangenome_analysis() == 0
+    assert calls == ["roary", "tree"]
+    assert not os.path.isdir(PA.pangenome_dir)
+    monkeypatch.undo()
+    shutil.rmtree(inc_config.path)
+
+
 def test_CoreGenes(config):
     from speciesprimer import CoreGenes
     CG = CoreGenes(config)
@@ -911,6 +1698,42 @@ def test_CoreGenes(config):
         coregenesummary = CG.get_singlecopy_genes(mode="normal")
         assert coregenesummary == [8, 14, 2, 8]
 
+    def test_gene_presence_absence():
+        from speciesprimer import GenePresenceAbsence
+        filepath = os.path.join(
+            CG.pangenome_dir, "gene_presence_absence.csv")
+        pan = GenePresenceAbsence(filepath)
+        assert os.path.isfile(pan.sidecar)
+        core, singlecopy = pan.select_core_genes()
+        assert core.sum() == 14
+        assert singlecopy.sum() == 10
+        with open(CG.singlecopy) as f:
+            first = next(csv.reader(f))
+        row = pan.genes.tolist().index(first[0])
+        assert [first[0]] + pan.get_loci(row) == first
+        # a lower presence adds accessory genes to the core genes
+        core, singlecopy = pan.select_core_genes(presence=0.5)
+        assert core.sum() > 14
+        # loci stay in their genome column, "" for absent genes
+        with open(filepath) as f:
+            reader = csv.reader(f)
+            next(reader)
+            rows = [row[14:] for row in reader]
+        accessory = next(
+            i for i, count in enumerate(pan.isolates.tolist())
+            if count < len(pan.genomes))
+        loci = pan.get_loci(accessory)
+        row = rows[accessory] + [""] * (len(loci) - len(rows[accessory]))
+        assert loci == row
+        assert "" in loci
+        assert len(pan.genome_idx) == sum(
+            1 for row in rows for cell in row if cell != "")
+        # the sidecar is rebuilt if the csv file is newer
+        mtime = os.path.getmtime(pan.sidecar)
+        os.utime(filepath, (mtime + 10, mtime + 10))
+        GenePresenceAbsence(filepath)
+        assert os.path.getmtime(pan.sidecar) > mtime
+
     def test_coregene_extract():
         G.create_directory(CG.results_dir)
         fasta_dir = os.path.join(CG.results_dir, "fasta")
@@ -920,9 +1743,46 @@ def test_CoreGenes(config):
         fasta_dir = os.path.join(CG.results_dir, "fasta")
         compare_ref_files(fasta_dir, ref_dir)
 
+    def test_get_fasta_chunks():
+        # genomes read in several chunks give the same fasta files
+        CG.chunk_size = 4
+        fasta_dir = os.path.join(CG.results_dir, "fasta")
+        with open(os.path.join(fasta_dir, "rplS.fasta")) as f:
+            before = f.read()
+        CG.get_fasta()
+        with open(os.path.join(fasta_dir, "rplS.fasta")) as f:
+            assert f.read() == before
+        compare_ref_files(fasta_dir, os.path.join(ref_data, "fasta"))
+        CG.chunk_size = 50
+
+    def test_get_fasta_genenames():
+        # "/", " " and "'" in gene names are removed from file and record
+        fasta_dir = os.path.join(CG.results_dir, "fasta")
+        shutil.copy(CG.singlecopy, CG.singlecopy + ".bak")
+        with open(CG.singlecopy) as f:
+            row = next(row for row in csv.reader(f) if row[0] == "rplS")
+        G.csv_writer(CG.singlecopy, [
+            ["rplS/A"] + row[1:], ["rplS B"] + row[1:],
+            ["rplT'"] + row[1:]])
+        CG.get_fasta()
+        ref_file = os.path.join(ref_data, "fasta", "rplS.fasta")
+        ref_ids = sorted(
+            record.id for record in SeqIO.parse(ref_file, "fasta"))
+        for gene_name in ["rplS-A", "rplS-B", "rplT"]:
+            filepath = os.path.join(fasta_dir, gene_name + ".fasta")
+            ids = sorted(
+                record.id for record in SeqIO.parse(filepath, "fasta"))
+            assert ids == [
+                item[:-len("rplS")] + gene_name for item in ref_ids]
+            os.remove(filepath)
+        shutil.move(CG.singlecopy + ".bak", CG.singlecopy)
+
     prepare_tests()
     test_get_singlecopy_genes()
+    test_gene_presence_absence()
     test_coregene_extract()
+    test_get_fasta_chunks()
+    test_get_fasta_genenames()
 
 def test_CoreGeneSequences(config):
     from speciesprimer import CoreGeneSequences
@@ -933,6 +1793,15 @@ def test_CoreGeneSequences(config):
     config.blastdbv5 = False
     CGS = CoreGeneSequences(config)
 
+    def test_get_alignment_jobs():
+        fasta_files, jobs = CGS.get_alignment_jobs()
+        assert len(fasta_files) == 8
+        assert sorted(jobs) == sorted(fasta_files)
+        sizes = [
+            os.path.getsize(os.path.join(CGS.fasta_dir, files))
+            for files in jobs]
+        assert sizes == sorted(sizes, reverse=True)
+
     def test_seq_alignments():
         # skip this test because of variation in alignments
         # CGS.seq_alignments()
@@ -940,6 +1809,8 @@ def test_CoreGeneSequences(config):
         ref_dir = os.path.join(ref_data, "alignments")
         # compare_ref_files(results_dir, ref_dir)
         shutil.copytree(ref_dir, CGS.alignments_dir)
+        # genes with an alignment are not aligned again
+        assert CGS.get_alignment_jobs()[1] == []
 
     def test_seq_consenus():
         CGS.seq_consensus()
@@ -1024,6 +1895,7 @@ def test_CoreGeneSequences(config):
         shutil.rmtree(tmpdir)
         return conserved_seq_dict
 
+    test_get_alignment_jobs()
     test_seq_alignments()
     test_seq_consenus()
     test_conserved_seqs()
@@ -1270,6 +2142,36 @@ def test_BLASTsettings(config):
                 # there should not be any other modes
                 assert cmd[2] == "error"
             assert cmd[-1] == db_outcome[i]
+
+    # QC databases of getqcdb.py next to the custom DB
+    qcdb_dir = os.path.join(tmpdir, "qcdb")
+    G.create_directory(qcdb_dir)
+    state = {
+        "source": "customdb.fas", "databases": ["rRNA", "tuf"],
+        "complete": True, "version": "v1"}
+    with open(os.path.join(qcdb_dir, "qcdb.json"), "w") as f:
+        json.dump(state, f)
+    config.blastdbv5 = False
+    config.customdb = os.path.join(tmpdir, "customdb.fas")
+    config.qc_gene = ["rRNA", "tuf"]
+    bl = Blast(config, tmpdir, "quality_control")
+    bl.qc_name = "tuf"
+    cmd = bl.get_blast_cmd(blastfile, blastfile + "_results.xml", cores)
+    assert cmd[-1] == os.path.join(qcdb_dir, "tuf_qc")
+    bl.qc_name = "combined"
+    cmd = bl.get_blast_cmd(blastfile, blastfile + "_results.xml", cores)
+    assert cmd[-1] == " ".join([
+        os.path.join(qcdb_dir, "rRNA_qc"), os.path.join(qcdb_dir, "tuf_qc")])
+    assert Blast.find_qc_db(config, ["rRNA", "tuf"])[1] == "v1"
+    # no QC database of pheS, search the full DB
+    config.qc_gene = ["rRNA", "pheS"]
+    cmd = bl.get_blast_cmd(blastfile, blastfile + "_results.xml", cores)
+    assert cmd[-1] == config.customdb
+    bl = Blast(config, tmpdir, "conserved")
+    cmd = bl.get_blast_cmd(blastfile, blastfile + "_results.xml", cores)
+    assert cmd[-1] == config.customdb
+    config.qc_gene = ["rRNA"]
+    config.customdb = None
     if os.path.isdir(tmpdir):
         shutil.rmtree(tmpdir)
 
@@ -1834,6 +2736,68 @@ def test_summary(config):
     assert files == ref_files
 
 
+def test_run_targets_parallel(config, monkeypatch):
+    import speciesprimer
+    from speciesprimer import errors
+    from speciesprimer import get_target_jobs, run_targets_parallel
+    assert get_target_jobs(1, 5) == 1
+    assert get_target_jobs(8, 1) == 1
+    assert get_target_jobs(0, 1000) == get_target_jobs(1000, 1000)
+    assert get_target_jobs(0, 1000) <= max(1, G.cpu_count() // 2)
+
+    def mock_pipeline(target, config):
+        G.logger("pipeline for " + target)
+        if target == "Lactobacillus_sakei":
+            raise ValueError("mock failure")
+        speciesprimer.errors.append([target, "mock error"])
+
+    def mock_blastdb_check(config):
+        pass
+
+    monkeypatch.setattr(
+        speciesprimer, "run_pipeline_for_target", mock_pipeline)
+    monkeypatch.setattr(H, "BLASTDB_check", mock_blastdb_check)
+    del errors[:]
+    logdir = os.path.join(tmpdir, "targetlogs")
+    G.create_directory(logdir)
+    logfile = os.path.join(logdir, "speciesprimer.log")
+    target_configs = [
+        ["Lactobacillus_curvatus", config], ["Lactobacillus_sakei", config],
+        ["Lactobacillus_casei", config]]
+    # the target logs are forwarded to the main log (GUI live log)
+    root = logging.getLogger()
+    main_log = logging.FileHandler(logfile)
+    root.addHandler(main_log)
+    level = root.level
+    root.setLevel(logging.DEBUG)
+    try:
+        run_targets_parallel(target_configs, 2, logfile)
+    finally:
+        root.removeHandler(main_log)
+        main_log.close()
+        root.setLevel(level)
+    with open(logfile) as f:
+        lines = f.read()
+    for target, config in target_configs:
+        assert target + ": " in lines
+        assert "pipeline for " + target in lines
+    errors.sort()
+    assert errors[0] == ["Lactobacillus_casei", "mock error"]
+    assert errors[1] == ["Lactobacillus_curvatus", "mock error"]
+    assert errors[2][0] == "Lactobacillus_sakei"
+    assert "fatal error" in errors[2][1]
+    for target, config in target_configs:
+        target_log = os.path.join(logdir, "speciesprimer_" + target + ".log")
+        with open(target_log) as f:
+            lines = f.read()
+        assert "pipeline for " + target in lines
+        for other, config in target_configs:
+            if other != target:
+                assert "pipeline for " + other not in lines
+    del errors[:]
+    shutil.rmtree(logdir)
+
+
 def test_end(config):
     def remove_test_files(config):
         test = config.path